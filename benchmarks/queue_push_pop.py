@@ -0,0 +1,72 @@
+#!/usr/bin/env python3
+""" Measure push and pop throughput of a queue class with redis
+or embedded SQLite storage (which needs no running server).
+
+Usage::
+
+    python benchmarks/queue_push_pop.py --redis-url sqlite://
+    python benchmarks/queue_push_pop.py --redis-url redis://localhost
+"""
+import argparse
+import time
+
+from redis.client import StrictRedis
+from scrapy import Request, Spider
+from scrapy.crawler import Crawler
+from scrapy.settings import Settings
+from scrapy.utils.misc import load_object
+from scrapy_redis.defaults import SCHEDULER_QUEUE_KEY
+
+import dd_crawler.settings
+from dd_crawler.storage import SQLiteStorage
+
+
+class BenchmarkSpider(Spider):
+    name = 'benchmark_dd_spider'
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    arg = parser.add_argument
+    arg('--redis-url', default='sqlite://')
+    arg('--queue-cls', default='dd_crawler.queue.BatchSoftmaxQueue')
+    arg('--n-domains', type=int, default=1000)
+    arg('--n-requests', type=int, default=50000)
+    args = parser.parse_args()
+
+    redis_cls = (SQLiteStorage if args.redis_url.startswith('sqlite:')
+                 else StrictRedis)
+    server = redis_cls.from_url(args.redis_url)
+    settings = Settings()
+    settings.setmodule(dd_crawler.settings)
+    crawler = Crawler(BenchmarkSpider, settings=settings)
+    spider = BenchmarkSpider.from_crawler(crawler)
+    queue = load_object(args.queue_cls)(
+        server=server, spider=spider, key=SCHEDULER_QUEUE_KEY, slots_mock={})
+    queue.clear()
+    requests = [Request('http://domain-{}.com/{}'.format(
+                            i % args.n_domains, i), priority=i % 100)
+                for i in range(args.n_requests)]
+
+    t0 = time.time()
+    for request in requests:
+        queue.push(request)
+    push_time = time.time() - t0
+
+    t0 = time.time()
+    n_popped = 0
+    while True:
+        if queue.pop() is not None:
+            n_popped += 1
+        elif not len(queue):
+            break
+    pop_time = time.time() - t0
+    queue.clear()
+
+    print('{}, {}: push {:,.0f} rps, pop {:,.0f} rps ({:,} popped)'.format(
+        args.redis_url, args.queue_cls.rsplit('.', 1)[-1],
+        len(requests) / push_time, n_popped / pop_time, n_popped))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,58 @@
+#!/usr/bin/env python3
+""" Compare queue sampling with np.random.choice over softmax probabilities
+(computed for each batch) with a precomputed SoftmaxSampler.
+
+Usage::
+
+    python benchmarks/softmax_sampling.py --batch-size 100
+"""
+import argparse
+import time
+
+import numpy as np
+from scrapy.settings import Settings
+
+import dd_crawler.settings
+from dd_crawler.queue import SoftmaxSampler, get_softmax_p
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    arg = parser.add_argument
+    arg('--n-domains', type=int, nargs='+', default=[10000, 100000, 1000000])
+    arg('--batch-size', type=int, default=100)
+    arg('--n-batches', type=int, default=20)
+    args = parser.parse_args()
+
+    settings = Settings()
+    settings.setmodule(dd_crawler.settings)
+    print('{:>10}\t{:>12}\t{:>12}\t{:>12}'.format(
+        'Domains', 'choice, ms', 'build, ms', 'sampler, ms'))
+    for n_domains in args.n_domains:
+        queues = ['domain:{}'.format(i).encode('ascii')
+                  for i in range(n_domains)]
+        multiplier = settings.getfloat('DD_PRIORITY_MULTIPLIER')
+        scores = -np.random.random(n_domains) * 10 * multiplier
+
+        t0 = time.time()
+        for _ in range(args.n_batches):
+            p = get_softmax_p(scores, settings)
+            np.random.choice(queues, p=p, size=args.batch_size)
+        choice_time = (time.time() - t0) / args.n_batches
+
+        t0 = time.time()
+        sampler = SoftmaxSampler(queues, scores, settings)
+        build_time = time.time() - t0
+
+        t0 = time.time()
+        for _ in range(args.n_batches):
+            sampler.choice(args.batch_size)
+        sampler_time = (time.time() - t0) / args.n_batches
+
+        print('{:>10,}\t{:>12.3f}\t{:>12.3f}\t{:>12.3f}'.format(
+            n_domains, 1000 * choice_time, 1000 * build_time,
+            1000 * sampler_time))
+
+
+if __name__ == '__main__':
+    main()
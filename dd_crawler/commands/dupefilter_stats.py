@@ -0,0 +1,68 @@
+import json
+
+from scrapy.commands import ScrapyCommand
+from scrapy.exceptions import UsageError
+
+from dd_crawler.scheduler import Scheduler
+
+
+class Command(ScrapyCommand):
+    requires_project = True
+
+    def syntax(self):
+        return '<spider>'
+
+    def add_options(self, parser):
+        ScrapyCommand.add_options(self, parser)
+        arg = parser.add_option
+        arg('-n', '--top', type=int, default=10,
+            help='number of largest domains to print')
+        arg('--expire', type=int,
+            help='drop fingerprints of domains not checked for given '
+                 'number of seconds')
+        arg('-o', '--output',
+            help='dump per-domain stats into json file (use - for stdout)')
+
+    def process_options(self, args, opts):
+        ScrapyCommand.process_options(self, args, opts)
+        self.settings.set('DUPEFILTER_PER_DOMAIN', True, priority='cmdline')
+
+    def short_desc(self):
+        return 'Print dupefilter size and memory usage per domain'
+
+    def run(self, args, opts):
+        if len(args) != 1:
+            raise UsageError()
+
+        crawler = self.crawler_process.create_crawler(args[0])
+        scheduler = Scheduler.from_settings(self.settings)
+        spider = crawler.spidercls.from_crawler(crawler)
+        scheduler.open(spider)
+        df = scheduler.df
+        if not getattr(df, 'per_domain', False):
+            raise UsageError('Dupefilter does not use per-domain sets')
+
+        if opts.expire is not None:
+            n_dropped = df.expire_domains(opts.expire)
+            print('Dropped {:,} fingerprints'.format(n_dropped))
+
+        stats = sorted(df.domain_stats(),
+                       key=lambda s: s['fingerprints'], reverse=True)
+        has_memory = any(s['memory'] is not None for s in stats)
+        print('\nDomains: {:,}, fingerprints: {:,}{}\n'.format(
+            len(stats), sum(s['fingerprints'] for s in stats),
+            ', memory: {:,} bytes'.format(sum(s['memory'] or 0 for s in stats))
+            if has_memory else ''))
+        print('{:<50}\tFingerprints\tMemory'.format('Domain'))
+        for s in stats[:opts.top]:
+            print('{:<50}\t{:>12}\t{}'.format(
+                s['domain'], s['fingerprints'],
+                '-' if s['memory'] is None else s['memory']))
+        if len(stats) > opts.top:
+            print('...')
+
+        if opts.output:
+            with open(opts.output, 'w') as f:
+                json.dump(stats, f,
+                          ensure_ascii=False, indent=True, sort_keys=True)
+            print('Stats dumped to {}'.format(opts.output))
@@ -0,0 +1,39 @@
+from scrapy.commands import ScrapyCommand
+from scrapy.exceptions import UsageError
+
+from dd_crawler.scheduler import Scheduler
+
+
+class Command(ScrapyCommand):
+    requires_project = True
+
+    def syntax(self):
+        return '<spider>'
+
+    def add_options(self, parser):
+        ScrapyCommand.add_options(self, parser)
+        parser.add_option('--delete', action='store_true',
+                          help='delete the dupefilter set after migration')
+
+    def process_options(self, args, opts):
+        ScrapyCommand.process_options(self, args, opts)
+        self.settings.set('DUPEFILTER_BLOOM', True, priority='cmdline')
+
+    def short_desc(self):
+        return 'Add fingerprints from the dupefilter set to the bloom filter'
+
+    def run(self, args, opts):
+        if len(args) != 1:
+            raise UsageError()
+
+        crawler = self.crawler_process.create_crawler(args[0])
+        scheduler = Scheduler.from_settings(self.settings)
+        spider = crawler.spidercls.from_crawler(crawler)
+        scheduler.open(spider)
+        df = scheduler.df
+        if not hasattr(df, 'migrate_to_bloom'):
+            raise UsageError('Dupefilter does not support bloom filter')
+        n_migrated = df.migrate_to_bloom(delete=opts.delete)
+        print('Migrated {:,} fingerprints'.format(n_migrated))
+        for name, value in sorted(df.bloom_stats().items()):
+            print('{}: {}'.format(name, value))
@@ -0,0 +1,51 @@
+from redis.client import StrictRedis
+from scrapy.commands import ScrapyCommand
+from scrapy.exceptions import UsageError
+
+from dd_crawler.snapshot import Progress, dump, snapshot_patterns, \
+    snapshot_servers
+
+
+class Command(ScrapyCommand):
+    requires_project = True
+
+    def syntax(self):
+        return '<spider> <file>'
+
+    def add_options(self, parser):
+        ScrapyCommand.add_options(self, parser)
+        arg = parser.add_option
+        arg('--chunk-size', type=int, default=1000,
+            help='number of keys (and values of large keys) read at once')
+        arg('--compress-level', type=int, default=3,
+            help='gzip compression level (1 is fastest, 9 is smallest)')
+        arg('--ignore-spill', action='store_true',
+            help='dump even if QUEUE_SPILL_DIR is set: requests spilled '
+                 'to local files of workers are not included')
+
+    def short_desc(self):
+        return 'Dump crawl frontier, dupefilter and login state into a file'
+
+    def run(self, args, opts):
+        if len(args) != 2:
+            raise UsageError()
+        spider_name, path = args
+
+        crawler = self.crawler_process.create_crawler(spider_name)
+        servers = snapshot_servers(self.settings)
+        if not all(isinstance(server, StrictRedis) for server in servers):
+            raise UsageError('Only redis storage can be dumped')
+        header = {'spider': crawler.spidercls.name}
+        if self.settings.get('QUEUE_SPILL_DIR'):
+            if not opts.ignore_spill:
+                raise UsageError(
+                    'QUEUE_SPILL_DIR is set, but requests spilled to local '
+                    'files of workers are not included in the snapshot: '
+                    'use --ignore-spill to dump without them')
+            print('WARNING: requests spilled to QUEUE_SPILL_DIR '
+                  'are not included in the snapshot')
+            header['spill_ignored'] = True
+        dump(servers, snapshot_patterns(self.settings, crawler.spidercls.name),
+             path, header=header,
+             chunk_size=opts.chunk_size, compress_level=opts.compress_level,
+             progress=Progress('Dumped'))
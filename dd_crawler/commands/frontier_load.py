@@ -0,0 +1,68 @@
+from redis.client import StrictRedis
+from scrapy.commands import ScrapyCommand
+from scrapy.exceptions import UsageError
+
+from dd_crawler.snapshot import Progress, existing_keys, load, read_header, \
+    snapshot_patterns, snapshot_servers
+
+
+class Command(ScrapyCommand):
+    requires_project = True
+
+    def syntax(self):
+        return '<spider> <file>'
+
+    def add_options(self, parser):
+        ScrapyCommand.add_options(self, parser)
+        arg = parser.add_option
+        arg('--chunk-size', type=int, default=1000,
+            help='number of commands sent in one pipeline')
+        arg('--clear', action='store_true',
+            help='delete existing keys of the crawl before loading')
+
+    def short_desc(self):
+        return 'Load crawl frontier dumped with frontier_dump'
+
+    def run(self, args, opts):
+        if len(args) != 2:
+            raise UsageError()
+        spider_name, path = args
+
+        crawler = self.crawler_process.create_crawler(spider_name)
+        name = crawler.spidercls.name
+        servers = snapshot_servers(self.settings)
+        if not all(isinstance(server, StrictRedis) for server in servers):
+            raise UsageError('Snapshots can be loaded only into redis')
+        try:
+            header = read_header(path)
+        except ValueError as e:
+            raise UsageError(str(e))
+        if header['spider'] != name:
+            raise UsageError('Snapshot is for spider "{}", not "{}"'
+                             .format(header['spider'], name))
+        if header.get('spill_ignored'):
+            print('WARNING: snapshot does not include requests spilled '
+                  'to QUEUE_SPILL_DIR')
+
+        patterns = snapshot_patterns(self.settings, name)
+        if opts.clear:
+            n_deleted = 0
+            to_delete = {}
+            for server, key in existing_keys(servers, patterns):
+                keys = to_delete.setdefault(server, [])
+                keys.append(key)
+                if len(keys) >= opts.chunk_size:
+                    n_deleted += server.delete(*keys)
+                    keys.clear()
+            for server, keys in to_delete.items():
+                if keys:
+                    n_deleted += server.delete(*keys)
+            print('Deleted {:,} existing keys'.format(n_deleted))
+        elif next(existing_keys(servers, patterns), None) is not None:
+            raise UsageError('Redis already has keys of this crawl: '
+                             'use --clear to delete them')
+        try:
+            load(servers, path, chunk_size=opts.chunk_size,
+                 progress=Progress('Loaded'))
+        except ValueError as e:
+            raise UsageError(str(e))
@@ -0,0 +1,203 @@
+import json
+import random
+import sys
+from typing import Dict, Iterator, List, Optional
+
+from redis.exceptions import ResponseError
+from scrapy.commands import ScrapyCommand
+from scrapy.exceptions import UsageError
+
+from dd_crawler.queue import BaseRequestQueue, CompactQueue
+from dd_crawler.scheduler import Scheduler
+
+
+class Command(ScrapyCommand):
+    requires_project = True
+
+    def syntax(self):
+        return '<spider>'
+
+    def add_options(self, parser):
+        ScrapyCommand.add_options(self, parser)
+        arg = parser.add_option
+        arg('--sample', type=int,
+            help='measure only a random sample of domain queues '
+                 'and extrapolate (all queues are measured by default)')
+        arg('--chunk-size', type=int, default=1000,
+            help='number of keys measured in one pipeline')
+        arg('--samples', type=int, default=5,
+            help='number of sampled elements for MEMORY USAGE '
+                 '(0 to measure all elements, which is slow)')
+        arg('-n', '--top', type=int, default=10,
+            help='number of largest domains to print')
+        arg('--json-lines', action='store_true',
+            help='write a json line for each domain and structure to stdout '
+                 'as soon as it is measured')
+
+    def short_desc(self):
+        return 'Report redis memory used by domain queues, index and dupefilter'
+
+    def run(self, args, opts):
+        if len(args) != 1:
+            raise UsageError()
+
+        crawler = self.crawler_process.create_crawler(args[0])
+        scheduler = Scheduler.from_settings(self.settings)
+        spider = crawler.spidercls.from_crawler(crawler)
+        scheduler.open(spider)
+        queue = scheduler.queue
+        try:
+            memory_usage(queue.server, [queue.len_key], opts.samples)
+        except (AttributeError, ResponseError):
+            raise UsageError('MEMORY USAGE command is not supported '
+                             '(redis 4.0 or newer is required)')
+
+        queue_keys = queue.get_queues()
+        n_queues = len(queue_keys)
+        if opts.sample and opts.sample < n_queues:
+            queue_keys = random.sample(queue_keys, opts.sample)
+        emit = _print_json_line if opts.json_lines else lambda record: None
+
+        domains = []
+        for record in domain_memory(
+                queue, queue_keys, opts.chunk_size, opts.samples):
+            emit(record)
+            domains.append(record)
+        domain_bytes = sum(d['bytes'] for d in domains)
+        n_requests = sum(d['requests'] for d in domains)
+        scale = n_queues / len(domains) if domains else 1
+        structures = [{
+            'type': 'structure',
+            'structure': 'domain queues',
+            'keys': n_queues,
+            'bytes': int(domain_bytes * scale),
+            'bytes_per_request': domain_bytes / n_requests if n_requests
+                                 else None,
+            'estimated': len(domains) < n_queues,
+        }]
+        emit(structures[0])
+        for name, keys_by_server in structure_keys(queue, scheduler.df):
+            keys = bytes_ = 0
+            for server, server_keys in keys_by_server:
+                for i in range(0, len(server_keys), opts.chunk_size):
+                    chunk = server_keys[i: i + opts.chunk_size]
+                    usage = [x for x in memory_usage(
+                        server, chunk, opts.samples) if x is not None]
+                    keys += len(usage)
+                    bytes_ += sum(usage)
+            record = {'type': 'structure', 'structure': name,
+                      'keys': keys, 'bytes': bytes_}
+            emit(record)
+            structures.append(record)
+        total = {'type': 'total',
+                 'bytes': sum(s['bytes'] for s in structures),
+                 'requests': len(queue)}
+        emit(total)
+
+        if not opts.json_lines:
+            print('\n{:<20}\t{:>10}\t{:>15}'.format('Structure', 'Keys', 'Bytes'))
+            for s in structures:
+                print('{:<20}\t{:>10,}\t{:>15,}{}'.format(
+                    s['structure'], s['keys'], s['bytes'],
+                    ' (estimated)' if s.get('estimated') else ''))
+            print('{:<20}\t{:>10}\t{:>15,}'.format('total', '', total['bytes']))
+            if structures[0]['bytes_per_request']:
+                print('\nBytes per queued request: {:.1f}'.format(
+                    structures[0]['bytes_per_request']))
+            print('\n{:<50}\tRequests\tBytes\tBytes per request'
+                  .format('Domain'))
+            for d in sorted(domains, key=lambda d: d['bytes'],
+                            reverse=True)[:opts.top]:
+                print('{:<50}\t{}\t{}\t{:.1f}'.format(
+                    d['domain'], d['requests'], d['bytes'],
+                    d['bytes_per_request']))
+
+
+def memory_usage(server, keys: List, samples: int) -> List[Optional[int]]:
+    """ MEMORY USAGE of each key (None for missing keys) in one pipeline.
+    """
+    pipe = server.pipeline(transaction=False)
+    for key in keys:
+        pipe.execute_command('MEMORY', 'USAGE', key, 'SAMPLES', samples)
+    return pipe.execute()
+
+
+def domain_memory(queue: BaseRequestQueue, queue_keys: List[bytes],
+                  chunk_size: int, samples: int) -> Iterator[Dict]:
+    """ Yield memory usage and number of requests for each domain queue,
+    measuring queues in chunks (in one pipeline for each partition).
+    """
+    for i in range(0, len(queue_keys), chunk_size):
+        by_partition = {}
+        for queue_key in queue_keys[i: i + chunk_size]:
+            by_partition.setdefault(
+                queue.queue_partition(queue_key), []).append(queue_key)
+        for partition, partition_keys in by_partition.items():
+            pipe = queue.partitions[partition].pipeline(transaction=False)
+            for queue_key in partition_keys:
+                pipe.zcard(queue_key)
+                pipe.execute_command(
+                    'MEMORY', 'USAGE', queue_key, 'SAMPLES', samples)
+            results = pipe.execute()
+            for domain, n_requests, bytes_ in zip(
+                    queue.queue_keys_domains(partition_keys),
+                    results[::2], results[1::2]):
+                if not n_requests:  # removed while we were measuring
+                    continue
+                yield {
+                    'type': 'domain',
+                    'domain': domain,
+                    'requests': n_requests,
+                    'bytes': bytes_,
+                    'bytes_per_request': bytes_ / n_requests,
+                }
+
+
+def structure_keys(queue: BaseRequestQueue, df):
+    """ Yield structure name and a list of (server, keys) pairs
+    for the queue index, counters, leases, dupefilter and other queue keys.
+    """
+    index_keys = [queue.queues_key, queue.relevant_queues_key,
+                  queue.n_shards_key, queue.index_generation_key,
+                  queue.index_log_key]
+    index_keys.extend(queue.shard_key(shard) for shard in range(queue.n_shards))
+    index_keys.extend([queue.selected_relevant_key,
+                       queue.restrict_progress_key])
+    yield 'index', [(server, index_keys) for server in queue.partitions]
+    yield 'admitted', [(queue.server, [queue.admitted_key])]
+    counter_keys = [queue.queued_key, queue.pushed_key, queue.popped_key,
+                    queue.counters_key]
+    yield 'counters', [(server, counter_keys) for server in queue.partitions]
+    yield 'leases', [
+        (server, list(server.scan_iter(match=queue._lease_key('*'))))
+        for server in queue.partitions]
+
+    df_keys = [df.key]
+    if hasattr(df, 'bloom_key'):
+        n_filters = int(df.server.hget(df.bloom_key, 'filters') or 1)
+        df_keys.append(df.bloom_key)
+        df_keys.extend('{}:{}'.format(df.bloom_key, i)
+                       for i in range(n_filters))
+    if hasattr(df, 'domains_key'):
+        df_keys.extend([df.domains_key, df.reclaim_log_key,
+                        df.reclaim_generation_key])
+        df_keys.extend(
+            df.domain_key(domain.decode('utf8'))
+            for domain in df.server.zrange(df.domains_key, 0, -1))
+    yield 'dupefilter', [(df.server, df_keys)]
+
+    # workers, logins and url tables are kept only on the main server
+    main_keys = [queue.workers_key, queue.worker_id_key,
+                 queue.has_login_form_key, queue.login_credentials_key,
+                 queue.domain_ids_key, queue.domain_names_key,
+                 queue.domain_id_counter_key]
+    if isinstance(queue, CompactQueue):
+        main_keys.extend([queue.url_tables_key, queue.url_table_id_key])
+    yield 'other', [(queue.server, main_keys)] + [
+        (server, [queue.len_key, queue.did_restrict_key, queue.trimmed_key])
+        for server in queue.partitions]
+
+
+def _print_json_line(record: Dict):
+    sys.stdout.write(json.dumps(record, ensure_ascii=False) + '\n')
+    sys.stdout.flush()
@@ -35,9 +35,11 @@ class Command(ScrapyCommand):
         printed_count = 0
         queues = stats['queues']
         print('{:<50}\tCount\tScore'.format('Domain'))
-        for queue, score, count in queues[:print_top]:
+        top_domains = scheduler.queue.queue_keys_domains(
+            [queue for queue, _, _ in queues[:print_top]])
+        for (queue, score, count), domain in zip(
+                queues[:print_top], top_domains):
             printed_count += count
-            domain = queue.rsplit(':')[-1]
             print('{:<50}\t{}\t{:.0f}'.format(domain, count, score))
         others_count = sum(count for _, _, count in queues) - printed_count
         if others_count:
@@ -45,6 +47,10 @@ class Command(ScrapyCommand):
             print('{:<50}\t{}'.format(
                 'other {}:'.format(len(queues) - print_top), others_count))
             print()
+        trimmed = stats['trimmed']
+        if trimmed:
+            print('Trimmed {} requests in {} domains\n'.format(
+                sum(trimmed.values()), len(trimmed)))
 
         if opts.output:
             with open(opts.output, 'w') as f:
@@ -0,0 +1,92 @@
+import sys
+import time
+from typing import Dict, Optional, Tuple
+
+from scrapy.commands import ScrapyCommand
+from scrapy.exceptions import UsageError
+
+from dd_crawler.queue import BaseRequestQueue
+from dd_crawler.scheduler import Scheduler
+
+
+class Command(ScrapyCommand):
+    requires_project = True
+
+    def syntax(self):
+        return '<spider>'
+
+    def add_options(self, parser):
+        ScrapyCommand.add_options(self, parser)
+        arg = parser.add_option
+        arg('-n', '--top', type=int, default=20,
+            help='number of longest domain queues to show')
+        arg('-i', '--interval', type=float, default=5, help='refresh interval')
+        arg('--once', action='store_true', help='print once and exit')
+
+    def short_desc(self):
+        return 'Show live queue counters, push and pop rates ' \
+               'and longest domain queues'
+
+    def run(self, args, opts):
+        if len(args) != 1:
+            raise UsageError()
+
+        crawler = self.crawler_process.create_crawler(args[0])
+        scheduler = Scheduler.from_settings(self.settings)
+        spider = crawler.spidercls.from_crawler(crawler)
+        scheduler.open(spider)
+        queue = scheduler.queue
+        # The queue registers itself as a worker, but this command
+        # must not own any shards.
+        queue.leave()
+
+        prev = None
+        while True:
+            t = time.time()
+            top = queue.get_top_queues(opts.top)
+            workers = live_workers(queue)
+            if sys.stdout.isatty() and not opts.once:
+                sys.stdout.write('\x1b[2J\x1b[H')  # clear screen
+            print_top(queue, top, workers, prev and (t - prev[0], prev[1]))
+            sys.stdout.flush()
+            if opts.once:
+                break
+            prev = t, top
+            time.sleep(opts.interval)
+
+
+def live_workers(queue: BaseRequestQueue) -> Tuple[int, ...]:
+    """ Live worker ids, read without sending a heartbeat.
+    """
+    return tuple(sorted(map(int, queue.server.zrangebyscore(
+        queue.workers_key, time.time() - queue.alive_timeout, '+inf'))))
+
+
+def print_top(queue: BaseRequestQueue, top: Dict, workers: Tuple[int, ...],
+              prev: Optional[Tuple[float, Dict]]):
+    dt, prev_top = prev if prev else (None, None)
+
+    def rate(value, prev_value):
+        if dt is None or prev_value is None:
+            return '-'
+        return '{:.1f}'.format((value - prev_value) / dt)
+
+    print('{}  queued: {:,}  domains: {:,}  workers: {}'.format(
+        time.strftime('%H:%M:%S'), top['len'], top['n_domains'], len(workers)))
+    print('pushed: {:,} ({}/s)  popped: {:,} ({}/s)\n'.format(
+        top['pushed'], rate(top['pushed'], prev_top and prev_top['pushed']),
+        top['popped'], rate(top['popped'], prev_top and prev_top['popped'])))
+    owners = queue.get_shard_owners(workers) if workers else None
+    prev_queues = {d['domain']: d for d in prev_top['queues']} \
+        if prev_top else {}
+    print('{:<40}\t{:>8}\t{:>8}\t{:>8}\t{:>7}\t{:>7}\t{:>9}\t{:>6}'.format(
+        'Domain', 'Queued', 'Pushed', 'Popped', 'Push/s', 'Pop/s',
+        'Relevance', 'Worker'))
+    for d in top['queues']:
+        prev_d = prev_queues.get(d['domain'], {})
+        print('{:<40}\t{:>8}\t{:>8}\t{:>8}\t{:>7}\t{:>7}\t{:>9}\t{:>6}'.format(
+            d['domain'][:40], d['queued'], d['pushed'], d['popped'],
+            rate(d['pushed'], prev_d.get('pushed')),
+            rate(d['popped'], prev_d.get('popped')),
+            '-' if d['relevance'] is None else '{:.2f}'.format(d['relevance']),
+            owners[d['shard']] if owners else '-'))
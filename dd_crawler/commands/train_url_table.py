@@ -0,0 +1,122 @@
+import random
+from typing import List
+
+import json_lines
+from scrapy.commands import ScrapyCommand
+from scrapy.exceptions import UsageError
+from scrapy_redis.scheduler import Scheduler
+
+from dd_crawler.queue import CompactQueue, default_url_table, \
+    domain_relative_url
+from dd_crawler.url_table import UrlTable, train_url_table, \
+    compression_report, MAX_TABLE_SIZE
+from dd_crawler.utils import get_domain
+
+
+class Command(ScrapyCommand):
+    requires_project = True
+
+    def syntax(self):
+        return '<spider>'
+
+    def add_options(self, parser):
+        ScrapyCommand.add_options(self, parser)
+        arg = parser.add_option
+        arg('--log', action='append',
+            help='sample urls from response log (can be given several times), '
+                 'instead of the queue')
+        arg('-n', '--n-urls', type=int, default=10000, help='sample size')
+        arg('--size', type=int, default=MAX_TABLE_SIZE, help='table size')
+        arg('--test-size', type=float, default=0.2,
+            help='fraction of urls used only to report compression')
+        arg('--dry-run', action='store_true',
+            help='only report compression, do not save the table')
+
+    def short_desc(self):
+        return 'Train url compression table on crawl urls and save it to redis'
+
+    def run(self, args, opts):
+        if len(args) != 1:
+            raise UsageError()
+
+        crawler = self.crawler_process.create_crawler(args[0])
+        scheduler = Scheduler.from_settings(self.settings)
+        spider = crawler.spidercls.from_crawler(crawler)
+        scheduler.open(spider)
+        queue = scheduler.queue
+        if not isinstance(queue, CompactQueue):
+            raise UsageError('Url tables are used only by CompactQueue '
+                             'and its subclasses')
+
+        if opts.log:
+            urls = sample_log_urls(opts.log, opts.n_urls)
+        else:
+            urls = sample_queue_urls(queue, opts.n_urls)
+        # the part of the url that CompactQueue compresses
+        parts = []
+        for url in urls:
+            relative_url = domain_relative_url(url, get_domain(url))
+            part = url if relative_url is None else relative_url[1]
+            try:
+                part.encode('latin1')
+            except UnicodeEncodeError:
+                continue
+            parts.append(part)
+        if len(parts) < 10:
+            raise UsageError('Not enough urls: {}'.format(len(parts)))
+        random.shuffle(parts)
+        n_test = max(1, int(len(parts) * opts.test_size))
+        test_parts, train_parts = parts[:n_test], parts[n_test:]
+        print('Training on {:,} urls, testing on {:,} urls'.format(
+            len(train_parts), len(test_parts)))
+
+        decode = train_url_table(train_parts, size=opts.size)
+        tables = {'default': default_url_table}
+        current_id = queue.current_url_table_id()
+        if current_id:
+            tables['current ({})'.format(current_id)] = \
+                queue.get_url_table(current_id)
+        tables['trained'] = UrlTable(decode)
+        print('{:<15}\t{:>8}\t{:>10}\t{:>10}'.format(
+            'Table', 'Ratio', 'Encode, us', 'Decode, us'))
+        for row in compression_report(test_parts, tables):
+            print('{table:<15}\t{ratio:>8.3f}\t{encode_us:>10.1f}\t'
+                  '{decode_us:>10.1f}'.format(**row))
+
+        if not opts.dry_run:
+            table_id = queue.save_url_table(decode)
+            print('Saved table with id {}'.format(table_id))
+
+
+def sample_queue_urls(queue: CompactQueue, n_urls: int,
+                      per_queue: int=10) -> List[str]:
+    """ Sample urls from the top of random domain queues.
+    """
+    queue_keys = queue.get_queues()
+    random.shuffle(queue_keys)
+    urls = []
+    for queue_key in queue_keys:
+        if len(urls) >= n_urls:
+            break
+        for data in queue.queue_server(queue_key).zrange(
+                queue_key, 0, per_queue - 1):
+            urls.append(queue._decode_request(data, queue_key).url)
+    return urls[:n_urls]
+
+
+def sample_log_urls(filenames: List[str], n_urls: int) -> List[str]:
+    """ Reservoir sample of urls from response logs.
+    """
+    urls = []
+    n_seen = 0
+    for filename in filenames:
+        with json_lines.open(filename, broken=True) as f:
+            for item in f:
+                n_seen += 1
+                if len(urls) < n_urls:
+                    urls.append(item['url'])
+                else:
+                    idx = random.randrange(n_seen)
+                    if idx < n_urls:
+                        urls[idx] = item['url']
+    return urls
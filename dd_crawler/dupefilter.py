@@ -1,21 +1,432 @@
+from collections import OrderedDict
 import hashlib
+import logging
+import math
+import struct
+import time
+from typing import Dict, List, Tuple
 
+from redis.exceptions import ResponseError
 from scrapy_redis.dupefilter import RFPDupeFilter
 from scrapy.utils.python import to_bytes
 from w3lib.url import canonicalize_url
 
+from . import queue_scripts
+from .signals import domains_removed
+from .storage import SQLiteStorage
+from .utils import get_domain
+
+
+logger = logging.getLogger(__name__)
+
+
+# Fingerprints in per-domain sets are truncated: collisions are only
+# possible within one domain, and 64 bits are enough for that.
+DOMAIN_FINGERPRINT_LENGTH = 8
+
 
 class LoginAwareDupefilter(RFPDupeFilter):
+    """ Dupefilter which also takes login state into account.
+
+    Fingerprints are kept in a redis set by default. With DUPEFILTER_BLOOM
+    setting, a scalable bloom filter is used instead (see BLOOM_ADD script),
+    with DUPEFILTER_BLOOM_CAPACITY initial capacity and
+    DUPEFILTER_BLOOM_ERROR_RATE false positive rate: it takes a fixed number
+    of bits per fingerprint (about 14 for 0.001 error rate) instead of
+    a hex digest in a set, at the cost of dropping a small fraction of new
+    requests. Use "scrapy dupefilter_to_bloom" command to add fingerprints
+    from the set to the bloom filter when switching an existing crawl.
+
+    With DUPEFILTER_PER_DOMAIN setting (not supported together with
+    the bloom filter), fingerprints are kept in a separate set for each domain,
+    so that they can be dropped in bulk: when the domain is removed by
+    domain restriction (see QUEUE_MAX_RELEVANT_DOMAINS), when its queue is
+    exhausted (only with DUPEFILTER_RECLAIM_EXHAUSTED, as links to this domain
+    found later are crawled again), or when the domain has not been checked
+    for DUPEFILTER_DOMAIN_TTL seconds. Use "scrapy dupefilter_stats" command
+    to see memory used by each domain.
+
+    Requests already seen by this worker are remembered in a local LRU cache
+    of DUPEFILTER_LOCAL_CACHE_SIZE entries (0 to disable), keyed by
+    the url and other fields used in the fingerprint, so that repeated
+    checks (e.g. of navigation links) need neither fingerprint computation
+    nor a redis round-trip. Only requests which are already in redis
+    are cached. With DUPEFILTER_PER_DOMAIN, reclaimed domains are recorded
+    in a log in redis, which each worker reads not more often than each
+    reclaim_check_interval seconds, evicting cached requests of these
+    domains, so requests of domains reclaimed by other workers can be
+    reported as duplicates only during this interval.
+
+    Settings are passed by dd_crawler.scheduler.Scheduler via open_spider.
+    """
+    local_cache_size = 100000
+    per_domain = False
+    reclaim_exhausted = False
+    domain_ttl = 0  # seconds, 0 to keep fingerprints of idle domains
+    expire_each = 600  # seconds
+    reclaim_check_interval = 1  # seconds
+    reclaim_log_length = 10000
+    bloom = False
+    bloom_capacity = 10000000
+    bloom_error_rate = 0.001
+    stats = None
+    stats_each = 10000  # checks
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.bloom_key = self.key + ':bloom'
+        self.domains_key = self.key + ':domains'  # domain -> last check time
+        # reclaimed domains, and number of domains ever added to the log
+        self.reclaim_log_key = self.key + ':reclaim-log'
+        self.reclaim_generation_key = self.key + ':reclaim-generation'
+        self.reclaim_generation = 0
+        self.last_reclaim_check = 0
+        self.n_checks = 0
+        self.check_legacy_set = False
+        self.last_expire = time.time()
+        # cache key -> domain (with DUPEFILTER_PER_DOMAIN, else None)
+        self.local_cache = OrderedDict()
+        # domain -> cache keys, so that they are evicted when the domain
+        # fingerprints are dropped
+        self.local_cache_domains = {}  # type: Dict[str, set]
+
+    def open_spider(self, spider):
+        settings = spider.settings
+        self.stats = spider.crawler.stats
+        self.local_cache_size = settings.getint(
+            'DUPEFILTER_LOCAL_CACHE_SIZE', self.local_cache_size)
+        self.bloom = settings.getbool('DUPEFILTER_BLOOM')
+        self.bloom_capacity = settings.getint(
+            'DUPEFILTER_BLOOM_CAPACITY', self.bloom_capacity)
+        self.bloom_error_rate = settings.getfloat(
+            'DUPEFILTER_BLOOM_ERROR_RATE', self.bloom_error_rate)
+        if self.bloom:
+            if isinstance(self.server, SQLiteStorage):
+                raise ValueError('DUPEFILTER_BLOOM is not supported '
+                                 'with SQLite storage')
+            self._bloom_add_script = self.server.register_script(
+                queue_scripts.BLOOM_ADD)
+            if self.server.exists(self.key):
+                logger.warning(
+                    'Dupefilter set {} exists, but bloom filter is used: '
+                    'run "scrapy dupefilter_to_bloom" to migrate it'
+                    .format(self.key))
+        self.per_domain = settings.getbool('DUPEFILTER_PER_DOMAIN')
+        self.reclaim_exhausted = settings.getbool(
+            'DUPEFILTER_RECLAIM_EXHAUSTED')
+        self.domain_ttl = settings.getint(
+            'DUPEFILTER_DOMAIN_TTL', self.domain_ttl)
+        if self.per_domain and self.bloom:
+            logger.warning('DUPEFILTER_PER_DOMAIN is ignored because '
+                           'bloom filter is used')
+            self.per_domain = False
+        if self.per_domain:
+            spider.crawler.signals.connect(
+                self.on_domains_removed, domains_removed)
+            self._reclaim_changes_script = self.server.register_script(
+                queue_scripts.INDEX_CHANGES)
+            self.reclaim_generation = int(
+                self.server.get(self.reclaim_generation_key) or 0)
+            # Fingerprints added before switching to per-domain sets
+            # are still checked, but the old set does not grow.
+            self.check_legacy_set = bool(self.server.exists(self.key))
+
     def request_seen(self, request):
-        fp = self._request_fingerprint(request)
-        added = self.server.sadd(self.key, fp)
-        return not added
+        return self.requests_seen([request])[0]
+
+    def requests_seen(self, requests: List) -> List[bool]:
+        """ Check several requests in one round-trip
+        (or without it, if all of them are in the local cache).
+        """
+        seen = [True] * len(requests)
+        to_check = []
+        if (self.per_domain and self.local_cache and
+                time.time() - self.last_reclaim_check >
+                self.reclaim_check_interval):
+            self._evict_reclaimed()
+        for idx, request in enumerate(requests):
+            cache_key = self._local_cache_key(request)
+            if cache_key in self.local_cache:
+                self.local_cache.move_to_end(cache_key)
+            else:
+                to_check.append((idx, request, cache_key))
+        if to_check:
+            if self.bloom:
+                added = self._bloom_add([self._request_digest(request)
+                                         for _, request, _ in to_check])
+            elif self.per_domain:
+                added = self._per_domain_add(
+                    [request for _, request, _ in to_check])
+            else:
+                pipe = self.server.pipeline(transaction=False)
+                for _, request, _ in to_check:
+                    pipe.sadd(self.key, self._request_fingerprint(request))
+                added = pipe.execute()
+            for (idx, request, cache_key), is_added in zip(to_check, added):
+                seen[idx] = not is_added
+                self._cache_seen(cache_key, request)
+        self._checked(len(requests), n_cache_hits=len(requests) - len(to_check))
+        if (self.per_domain and self.domain_ttl and
+                time.time() - self.last_expire > self.expire_each):
+            self.last_expire = time.time()
+            self.expire_domains(self.domain_ttl)
+        return seen
+
+    def domain_key(self, domain: str) -> str:
+        return '{}:domain:{}'.format(self.key, domain)
+
+    def _per_domain_add(self, requests: List) -> List[bool]:
+        pipe = self.server.pipeline(transaction=False)
+        domains = set()
+        for request in requests:
+            domain = get_domain(request.url)
+            domains.add(domain)
+            digest = self._request_digest(request)
+            pipe.sadd(self.domain_key(domain),
+                      digest[:DOMAIN_FINGERPRINT_LENGTH])
+            if self.check_legacy_set:
+                pipe.sismember(self.key, digest.hex())
+        now = time.time()
+        pipe.zadd(self.domains_key,
+                  *[x for domain in domains for x in [now, domain]])
+        results = pipe.execute()[:-1]
+        if self.check_legacy_set:
+            return [added and not in_legacy for added, in_legacy
+                    in zip(results[::2], results[1::2])]
+        else:
+            return [bool(added) for added in results]
+
+    def on_domains_removed(self, domains: List[str], reason: str):
+        if reason == 'restricted' or (
+                reason == 'exhausted' and self.reclaim_exhausted):
+            self.reclaim_domains(domains, reason=reason)
+
+    def expire_domains(self, ttl: int) -> int:
+        """ Drop fingerprints of domains not checked for ttl seconds,
+        return number of dropped fingerprints.
+        """
+        domains = self.server.zrangebyscore(
+            self.domains_key, '-inf', time.time() - ttl)
+        return self.reclaim_domains(
+            [domain.decode('utf8') for domain in domains], reason='expired')
+
+    def reclaim_domains(self, domains: List[str], reason: str) -> int:
+        """ Drop all fingerprints of given domains,
+        return number of dropped fingerprints.
+        """
+        if not domains:
+            return 0
+        pipe = self.server.pipeline()
+        pipe.multi()
+        for domain in domains:
+            pipe.scard(self.domain_key(domain))
+        pipe.delete(*map(self.domain_key, domains))
+        pipe.zrem(self.domains_key, *domains)
+        # other workers evict these domains from their local caches
+        pipe.rpush(self.reclaim_log_key, *domains)
+        pipe.ltrim(self.reclaim_log_key, -self.reclaim_log_length, -1)
+        pipe.incrby(self.reclaim_generation_key, len(domains))
+        n_fingerprints = sum(pipe.execute()[:len(domains)])
+        self._evict_domains(domains)
+        logger.info('Dropped {:,} fingerprints of {:,} {} domains'.format(
+            n_fingerprints, len(domains), reason))
+        if self.stats is not None:
+            self.stats.inc_value(
+                'dd_crawler/dupefilter/reclaimed_domains', len(domains))
+            self.stats.inc_value(
+                'dd_crawler/dupefilter/reclaimed_fingerprints', n_fingerprints)
+        return n_fingerprints
+
+    def domain_stats(self, chunk_size: int=1000) -> List[Dict]:
+        """ Number of fingerprints, last check time and memory usage
+        in bytes (if supported by the server, else None) for each domain.
+        """
+        domains = self.server.zrange(self.domains_key, 0, -1, withscores=True)
+        stats = []
+        for i in range(0, len(domains), chunk_size):
+            chunk = domains[i: i + chunk_size]
+            keys = [self.domain_key(domain.decode('utf8'))
+                    for domain, _ in chunk]
+            pipe = self.server.pipeline(transaction=False)
+            for key in keys:
+                pipe.scard(key)
+            counts = pipe.execute()
+            memory = [None] * len(keys)
+            if hasattr(self.server, 'execute_command'):
+                pipe = self.server.pipeline(transaction=False)
+                for key in keys:
+                    pipe.execute_command('MEMORY', 'USAGE', key)
+                try:
+                    memory = pipe.execute()
+                except ResponseError:  # MEMORY command needs redis 4
+                    pass
+            stats.extend(
+                {'domain': domain.decode('utf8'),
+                 'fingerprints': count,
+                 'last_checked': last_checked,
+                 'memory': memory_usage}
+                for (domain, last_checked), count, memory_usage
+                in zip(chunk, counts, memory))
+        return stats
+
+    def _evict_reclaimed(self):
+        """ Evict cached requests of domains reclaimed since the last check
+        (possibly by other workers), or clear the cache if the reclaim log
+        does not go back far enough.
+        """
+        self.last_reclaim_check = time.time()
+        generation, *changes = self._reclaim_changes_script(
+            keys=[self.reclaim_generation_key, self.reclaim_log_key],
+            args=[self.reclaim_generation])
+        if generation != self.reclaim_generation:
+            if changes:
+                self._evict_domains(
+                    [domain.decode('utf8') for domain in changes[0]])
+            else:
+                self.local_cache.clear()
+                self.local_cache_domains.clear()
+        self.reclaim_generation = generation
+
+    def _evict_domains(self, domains: List[str]):
+        for domain in domains:
+            for cache_key in self.local_cache_domains.pop(domain, ()):
+                self.local_cache.pop(cache_key, None)
+
+    def _local_cache_key(self, request):
+        return (request.url, request.method, request.body,
+                request.meta.get('logged-in'))
+
+    def _cache_seen(self, cache_key, request):
+        if self.local_cache_size > 0:
+            domain = get_domain(request.url) if self.per_domain else None
+            self.local_cache[cache_key] = domain
+            if domain is not None:
+                self.local_cache_domains.setdefault(domain, set())\
+                    .add(cache_key)
+            if len(self.local_cache) > self.local_cache_size:
+                cache_key, domain = self.local_cache.popitem(last=False)
+                if domain is not None:
+                    domain_keys = self.local_cache_domains[domain]
+                    domain_keys.discard(cache_key)
+                    if not domain_keys:
+                        del self.local_cache_domains[domain]
+
+    def _checked(self, n_checks: int, n_cache_hits: int):
+        prev_n_checks = self.n_checks
+        self.n_checks += n_checks
+        if self.stats is not None:
+            if n_cache_hits:
+                self.stats.inc_value(
+                    'dd_crawler/dupefilter/local_cache_hits', n_cache_hits)
+            if n_checks > n_cache_hits:
+                self.stats.inc_value(
+                    'dd_crawler/dupefilter/local_cache_misses',
+                    n_checks - n_cache_hits)
+        if (self.bloom and self.stats is not None and
+                self.n_checks // self.stats_each !=
+                prev_n_checks // self.stats_each):
+            for name, value in self.bloom_stats().items():
+                self.stats.set_value(
+                    'dd_crawler/dupefilter/bloom_{}'.format(name), value)
+
+    def _bloom_add(self, digests: List[bytes]) -> List[int]:
+        args = [self.bloom_capacity, self.bloom_error_rate]
+        for digest in digests:
+            args.extend(_bloom_hashes(digest))
+        return self._bloom_add_script(keys=[self.bloom_key], args=args)
+
+    def bloom_stats(self) -> Dict[str, float]:
+        """ Number of filters, items (approximate for older filters),
+        fill ratio of the last filter and estimated false positive rate.
+        """
+        n_filters, count = self.server.hmget(
+            self.bloom_key, 'filters', 'count')
+        n_filters = int(n_filters or 1)
+        pipe = self.server.pipeline(transaction=False)
+        for i in range(n_filters):
+            pipe.bitcount('{}:{}'.format(self.bloom_key, i))
+        n_not_fp = 1.
+        fill_ratio = 0.
+        for i, n_set in enumerate(pipe.execute()):
+            _, m, k = bloom_filter_params(
+                self.bloom_capacity, self.bloom_error_rate, i)
+            fill_ratio = n_set / m
+            n_not_fp *= 1 - fill_ratio ** k
+        n_items = int(count or 0) + sum(
+            bloom_filter_params(
+                self.bloom_capacity, self.bloom_error_rate, i)[0]
+            for i in range(n_filters - 1))
+        return {
+            'filters': n_filters,
+            'items': n_items,
+            'fill_ratio': fill_ratio,
+            'fp_rate': 1 - n_not_fp,
+        }
+
+    def migrate_to_bloom(self, delete: bool=False, chunk_size: int=10000
+                         ) -> int:
+        """ Add fingerprints from the set to the bloom filter,
+        optionally deleting the set, return number of migrated fingerprints.
+        """
+        n_migrated = 0
+        chunk = []
+        for fingerprint in self.server.sscan_iter(self.key, count=chunk_size):
+            chunk.append(bytes.fromhex(fingerprint.decode('ascii')))
+            if len(chunk) == chunk_size:
+                self._bloom_add(chunk)
+                n_migrated += len(chunk)
+                chunk = []
+        if chunk:
+            self._bloom_add(chunk)
+            n_migrated += len(chunk)
+        if delete:
+            self.server.delete(self.key)
+        return n_migrated
+
+    def clear(self):
+        self.local_cache.clear()
+        self.local_cache_domains.clear()
+        domains = self.server.zrange(self.domains_key, 0, -1)
+        if domains:
+            self.server.delete(*[self.domain_key(domain.decode('utf8'))
+                                 for domain in domains])
+        self.server.delete(self.domains_key, self.reclaim_log_key,
+                           self.reclaim_generation_key)
+        self.reclaim_generation = 0
+        n_filters = int(self.server.hget(self.bloom_key, 'filters') or 1)
+        self.server.delete(
+            self.bloom_key,
+            *['{}:{}'.format(self.bloom_key, i) for i in range(n_filters)])
+        super().clear()
 
     def _request_fingerprint(self, request):
+        return self._request_digest(request).hex()
+
+    def _request_digest(self, request) -> bytes:
         fp = hashlib.sha1()
         fp.update(to_bytes(request.method))
         fp.update(to_bytes(canonicalize_url(request.url)))
         fp.update(request.body or b'')
         # FIXME - proper field name
         fp.update(to_bytes('login={}'.format(request.meta.get('logged-in'))))
-        return fp.hexdigest()
+        return fp.digest()
+
+
+def bloom_filter_params(capacity: int, error_rate: float, i: int)\
+        -> Tuple[int, int, int]:
+    """ Capacity, number of bits and number of hashes of i-th filter
+    (must match BLOOM_ADD script).
+    """
+    n = capacity * 2 ** i
+    p = error_rate * 0.5 ** (i + 1)
+    m = min(math.ceil(-n * math.log(p) / math.log(2) ** 2), 2 ** 32)
+    k = max(1, math.floor(m / n * math.log(2) + 0.5))
+    return n, m, k
+
+
+def _bloom_hashes(digest: bytes) -> Tuple[int, int]:
+    """ Two 32 bit hashes (for double hashing) from the first 8 bytes
+    of the fingerprint digest.
+    """
+    h1, h2 = struct.unpack('>II', digest[:8])
+    return h1, h2 | 1  # second hash must not be zero
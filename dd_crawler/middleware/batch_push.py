@@ -0,0 +1,80 @@
+import logging
+from typing import List
+
+from scrapy import Request
+from scrapy.exceptions import NotConfigured
+
+
+logger = logging.getLogger(__name__)
+
+
+class BatchPushMiddleware:
+    """ Push all requests extracted from one response to the queue at once:
+    they are checked against the dupefilter together and pushed with
+    queue.push_many, which turns hundreds of redis round-trips into a few.
+    Requests bypass the scheduler, so scheduler stats are updated here,
+    but request_scheduled signal is not sent. All requests are held
+    until the callback finishes.
+    If the queue or dupefilter do not support bulk operations,
+    requests are passed on unchanged.
+
+    Usage:
+
+    QUEUE_BATCH_PUSH = True
+    SPIDER_MIDDLEWARES = {
+        'dd_crawler.middleware.batch_push.BatchPushMiddleware': 10,
+    }
+
+    Order should be lower than that of all other spider middlewares,
+    so that it gets requests after they are processed by all of them.
+    """
+    def __init__(self, stats):
+        self.stats = stats
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        if not crawler.settings.getbool('QUEUE_BATCH_PUSH'):
+            raise NotConfigured
+        return cls(crawler.stats)
+
+    def process_spider_output(self, response, result, spider):
+        requests = []
+        for item in result:
+            if isinstance(item, Request):
+                requests.append(item)
+            else:
+                yield item
+        if requests:
+            yield from self.push_requests(requests, spider)
+
+    def push_requests(self, requests: List[Request], spider) -> List[Request]:
+        """ Push requests to the queue, return requests
+        that must be passed to the scheduler instead.
+        """
+        try:
+            scheduler = spider.crawler.engine.slot.scheduler
+        except AttributeError:
+            return requests
+        queue, df = scheduler.queue, scheduler.df
+        if not (hasattr(queue, 'push_many') and hasattr(df, 'requests_seen')):
+            return requests
+        to_check = [r for r in requests if not r.dont_filter]
+        seen = dict(zip(map(id, to_check), df.requests_seen(to_check)))
+        new_requests = []
+        for request in requests:
+            if seen.get(id(request)):
+                df.log(request, spider)
+            else:
+                new_requests.append(request)
+        if new_requests:
+            self.stats.inc_value('scheduler/enqueued/redis',
+                                 count=len(new_requests), spider=spider)
+            pushed = queue.push_many(new_requests)
+            n_pushed = sum(pushed)
+            self.stats.inc_value('dd_crawler/queue/batch_pushed',
+                                 count=n_pushed, spider=spider)
+            if n_pushed < len(pushed):
+                self.stats.inc_value('dd_crawler/queue/push_rejected',
+                                     count=len(pushed) - n_pushed,
+                                     spider=spider)
+        return []
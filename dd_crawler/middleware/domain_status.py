@@ -58,8 +58,7 @@ class DomainStatusMiddleware:
             self._log_new_entry()
 
     def on_queues_changed(self, queue: BaseRequestQueue):
-        self._open_queues = [
-            queue.queue_key_domain(q) for q in queue.get_queues()]
+        self._open_queues = queue.queue_keys_domains(queue.get_queues())
 
     def _log_new_entry(self):
         entry = {
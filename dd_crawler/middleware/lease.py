@@ -0,0 +1,32 @@
+from scrapy.exceptions import NotConfigured
+
+
+class LeaseAckMiddleware:
+    """ Acknowledge requests leased from the queue when they are crawled
+    (or failed), so that they are not returned to the queue when the worker
+    stops.
+
+    Usage:
+
+    QUEUE_LEASES = True
+    DOWNLOADER_MIDDLEWARES = {
+        'dd_crawler.middleware.lease.LeaseAckMiddleware': 950,
+    }
+    """
+    @classmethod
+    def from_crawler(cls, crawler):
+        if not crawler.settings.getbool('QUEUE_LEASES'):
+            raise NotConfigured
+        return cls()
+
+    def process_response(self, request, response, spider):
+        self._ack(request, spider)
+        return response
+
+    def process_exception(self, request, exception, spider):
+        self._ack(request, spider)
+
+    def _ack(self, request, spider):
+        queue = spider.queue
+        if queue is not None and hasattr(queue, 'ack'):
+            queue.ack(request)
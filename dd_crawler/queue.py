@@ -1,12 +1,16 @@
-from collections import Counter
+from collections import Counter, OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
 import gzip
+import hashlib
+import heapq
 import json
 import logging
 import math
 import random
+import re
 import struct
 import time
-from typing import Optional, List, Tuple, Union, Dict
+from typing import Any, Callable, Optional, List, Tuple, Union, Dict, Set
 from zlib import crc32
 
 from deepdeep.utils import softmax
@@ -14,9 +18,13 @@ import lib.smaz as smaz
 import numpy as np
 from redis.client import StrictRedis
 from scrapy import Request
+from scrapy.utils.httpobj import urlparse_cached
 from scrapy_redis.queue import Base
 
-from .signals import queues_changed
+from . import queue_scripts
+from .signals import queues_changed, domains_removed
+from .spill import SpillStore
+from .url_table import UrlTable
 from .utils import warn_if_slower, cacheforawhile, get_domain
 
 
@@ -32,78 +40,330 @@ class BaseRequestQueue(Base):
     """ Request queue where each domain has a separate queue,
     and each domain is crawled only by one worker to be polite.
 
+    Each worker caches queues it owns: added and removed queues are tracked
+    via index generation and index log, and are applied incrementally.
     QUEUE_CACHE_TIME setting determines the time queues are cached for,
-    when workers do not change (stale cache only leads to missing new domains
-    for a while, so it's safe to set it to higher values).
+    before they are re-read to update their scores (stale scores only lead
+    to slightly worse queue selection, so it's safe to set it to higher values).
+
+    Besides the global queues index, queues are also kept in
+    QUEUE_INDEX_SHARDS shard sorted sets (by crc32 of queue key),
+    and each worker owns whole shards, so that it reads only its own shards.
+
+    Domain queues can be spread over several redis instances, listed in
+    QUEUE_REDIS_PARTITIONS setting: each partition keeps a complete frontier
+    (queues, index, length, relevant domains and leases) for its domains,
+    so all scripts still run on one instance. Workers and login state are
+    kept on the main redis server. Number of partitions must not be changed
+    during the crawl.
+
+    Server can also be an embedded dd_crawler.storage.SQLiteStorage
+    (set with REDIS_PARAMS['redis_cls']) for single-node crawls.
+
+    With QUEUE_SPILL_DIR setting, only QUEUE_SPILL_HIGH_WATER requests
+    with highest priorities are kept in redis for each domain: the rest
+    is spilled to local segment files (see dd_crawler.spill), and reloaded
+    by the worker which spilled them once the domain has less than
+    QUEUE_SPILL_LOW_WATER requests in redis.
     """
     def __init__(self, *args, slots_mock=None, skip_cache=False, **kwargs):
         super().__init__(*args, **kwargs)
-        assert isinstance(self.server, StrictRedis)
         logging.info('Init {} queue with key {}'.format(type(self), self.key))
         self.len_key = self.fkey('len')  # int
         self.queues_key = self.fkey('queues')  # sorted set
         self.relevant_queues_key = self.fkey('relevant-queues')  # sorted set
+        self.n_shards_key = self.fkey('index-shards')  # int
+        # incremented on each change of queues in the index or of workers
+        self.index_generation_key = self.fkey('index-generation')  # int
+        self.index_log_key = self.fkey('index-log')  # list
         self.did_restrict_key = self.fkey('did-restrict-domains')  # bool
+        # set of selected relevant queues, and a hash with progress
+        # of removing other queues (see try_to_restrict_domains)
+        self.selected_relevant_key = self.fkey('selected-relevant-queues')
+        self.restrict_progress_key = self.fkey('restrict-progress')
+        # hash with queue key as key and number of trimmed requests as value
+        self.trimmed_key = self.fkey('trimmed')
+        # Counters maintained by PUSH and POP_MULTI scripts:
+        # sorted set with queue key as key and queue length as score,
+        # hashes with queue key as key and number of pushed (popped)
+        # requests as value, and a hash with total pushed and popped counts
+        self.queued_key = self.fkey('queued')
+        self.pushed_key = self.fkey('pushed')
+        self.popped_key = self.fkey('popped')
+        self.counters_key = self.fkey('counters')
         # set of domains with login form found
         self.has_login_form_key = self.fkey('login-form-domains')
         # hash with domain as key and json-encoded credentials as value
         self.login_credentials_key = self.fkey('login-credentials')
-        self.workers_key = self.fkey('workers')  # set
+        # sorted set with worker ids and last heartbeat time as score
+        self.workers_key = self.fkey('worker-heartbeats')
         self.worker_id_key = self.fkey('worker-id')  # int
+        # Domain dictionary (used with QUEUE_DOMAIN_IDS): hashes with
+        # domain -> id and id -> domain mapping, and last assigned id
+        self.domain_ids_key = self.fkey('domain-ids')
+        self.domain_names_key = self.fkey('domain-names')
+        self.domain_id_counter_key = self.fkey('domain-id-counter')
         self.worker_id = self.server.incr(self.worker_id_key)
         self.alive_timeout = 120  # seconds
-        self.im_alive()
+        self.heartbeat_interval = self.alive_timeout / 4  # seconds
+        # hash with requests popped by this worker, but not yet acknowledged
+        self.lease_key = self._lease_key(self.worker_id)
         self.n_pops = 0
         self.stat_each = 1000  # requests
         self.slots_mock = slots_mock
         self.skip_cache = skip_cache
         settings = self.spider.settings
+        self.domain_ids = settings.getbool('QUEUE_DOMAIN_IDS')
+        self.queue_key_prefix = self.fkey(
+            'd:' if self.domain_ids else 'domain:')
+        # domain <-> queue key mapping never changes, so it is cached forever
+        self._domain_queue_keys = {}  # type: Dict[str, str]
+        self._queue_key_domains = {}  # type: Dict[bytes, str]
+        self._domain_ids_script = self.server.register_script(
+            queue_scripts.DOMAIN_IDS)
+        self.partitions = [
+            type(self.server).from_url(url)
+            for url in settings.getlist('QUEUE_REDIS_PARTITIONS')
+        ] or [self.server]
+        self._executor = (ThreadPoolExecutor(max_workers=len(self.partitions))
+                          if len(self.partitions) > 1 else None)
         self.max_domains = settings.getint('QUEUE_MAX_DOMAINS')
+        # set of queues admitted under max_domains limit, on the main server:
+        # without partitions, queues are admitted by PUSH script, else
+        # by ADMIT script before pushing (see _admit_queues)
+        self.admitted_key = self.fkey('admitted-queues')
+        self._admit_in_push = (len(self.partitions) == 1 and
+                               self.partitions[0] is self.server)
+        self._admit_script = self.server.register_script(queue_scripts.ADMIT)
+        self._admitted_queues = set()  # type: Set[str]
         if self.max_domains:
-            logging.warning(
-                'QUEUE_MAX_DOMAINS has a bug: '
-                'domains which queue becomes empty during crawling '
-                'can disappear from the domain queue.')
+            self._init_admitted()
         self.max_relevant_domains = \
             settings.getint('QUEUE_MAX_RELEVANT_DOMAINS')
+        self.max_per_domain = settings.getint('QUEUE_MAX_PER_DOMAIN')
+        spill_dir = settings.get('QUEUE_SPILL_DIR')
+        self.spill_store = SpillStore(spill_dir) if spill_dir else None
+        self.spill_high_water = settings.getint('QUEUE_SPILL_HIGH_WATER', 1000)
+        self.spill_low_water = settings.getint(
+            'QUEUE_SPILL_LOW_WATER', self.spill_high_water // 10)
+        self.spill_check_interval = 10  # seconds
+        self.spill_check_chunk = 1000  # queues
+        self._spill_check_time = 0
+        self._spill_check_keys = deque()  # type: deque
+        self.restrict_chunk_size = settings.getint(
+            'QUEUE_RESTRICT_CHUNK_SIZE', 1000)
+        self.restrict_chunks_per_call = 10
+        self._restriction_done = False
         self.set_spider_domain_limit()
+        self._push_script = self.server.register_script(queue_scripts.PUSH)
+        self._pop_multi_script = self.server.register_script(
+            queue_scripts.POP_MULTI)
+        self._remove_queues_script = self.server.register_script(
+            queue_scripts.REMOVE_QUEUES)
+        self._advance_restriction_script = self.server.register_script(
+            queue_scripts.ADVANCE_RESTRICTION)
         self.start_time = time.time()
         self.restrict_delay = settings.getint('RESTRICT_DELAY', 3600)  # seconds
+        self.n_shards = settings.getint('QUEUE_INDEX_SHARDS', 256)
+        self.init_shards()
+        self.ownership = settings.get('QUEUE_OWNERSHIP', 'modulo')
+        if self.ownership not in {'modulo', 'rendezvous'}:
+            raise ValueError(
+                'Invalid QUEUE_OWNERSHIP value: {}'.format(self.ownership))
+        self._workers = self._shard_owners = self._my_shards = None
+        self.cache_time = settings.getfloat('QUEUE_CACHE_TIME', 600)  # seconds
+        self.index_check_interval = 1  # seconds
+        self.cache_version = 0
+        self._index_shards = None
+        self._index_load_time = self._index_check_time = 0
+        self._index_changes_script = self.server.register_script(
+            queue_scripts.INDEX_CHANGES)
+        self._sampler = None
+        self.use_leases = settings.getbool('QUEUE_LEASES')
+        self._acks = []
+        self._live_workers = self.im_alive()
 
     def __len__(self):
-        return int(self.server.get(self.len_key) or '0')
+        return sum(self._fan_out(
+            lambda server: int(server.get(self.len_key) or '0')))
+
+    def _fan_out(self, fn: Callable[[StrictRedis], Any]) -> List[Any]:
+        """ Call fn for each partition (in parallel if there are several),
+        return a list of results.
+        """
+        if self._executor is None:
+            return [fn(server) for server in self.partitions]
+        else:
+            return list(self._executor.map(fn, self.partitions))
+
+    def _execute_pipelines(self, pipes: Dict[int, Any]) -> Dict[int, List]:
+        """ Execute pipelines for several partitions (given by their index),
+        in parallel if there are several.
+        """
+        items = list(pipes.items())
+        if self._executor is None or len(items) == 1:
+            results = [pipe.execute() for _, pipe in items]
+        else:
+            results = list(self._executor.map(
+                lambda item: item[1].execute(), items))
+        return {partition: result
+                for (partition, _), result in zip(items, results)}
 
     def push(self, request: Request) -> bool:
         """ Push request to queue. Return False if it has not been pushed.
         """
-        queue_key = self.url_queue_key(request.url)
-        if (self.max_domains and
-                self.server.zcard(self.queues_key) >= self.max_domains and
-                self.server.zrank(self.queues_key, queue_key) is None):
-            # Do not add new queue, limit has been reached
-            return False
-        if (self.did_restrict_domains and
-                self.server.zrank(self.relevant_queues_key, queue_key) is None):
-            # Such requests could come from the time we selected
-            # relevant domains: some requests were in fly or in batches.
-            return False
-        data = self._encode_request(request)
-        score = -min(request.priority,
-                     self.spider.settings.getfloat('DD_MAX_SCORE', np.inf))
-        added = self.server.zadd(queue_key, score, data)
-        if added:
-            self.server.incr(self.len_key)
-        top = self.server.zrange(queue_key, 0, 0, withscores=True)
-        if top:
-            (_, queue_score), = top
-        else:  # a race during domain re-balancing: do not care about score much
-            logger.warning('Placing a possibly incorrect queue score')
-            queue_score = score
-        self.add_queue(queue_key, queue_score)
-        return True
+        return self.push_many([request])[0]
+
+    def push_many(self, requests: List[Request]) -> List[bool]:
+        """ Push several requests (e.g. all requests extracted from one
+        response) to the queue, in one round-trip.
+        Return a list of flags telling which requests have been pushed.
+        """
+        by_queue = OrderedDict()
+        queue_keys = self.url_queue_keys([request.url for request in requests])
+        for idx, queue_key in enumerate(queue_keys):
+            by_queue.setdefault(queue_key, []).append(idx)
+        results = self._push_queues(OrderedDict(
+            (queue_key, self._encode_items([requests[idx] for idx in idxs]))
+            for queue_key, idxs in by_queue.items()))
+        pushed = [False] * len(requests)
+        any_queue_added = False
+        n_trimmed = 0
+        for (queue_key, idxs), (queue_pushed, queue_added, queue_trimmed, _) \
+                in zip(by_queue.items(), results):
+            for idx in idxs:
+                pushed[idx] = bool(queue_pushed)
+            if queue_added:
+                any_queue_added = True
+                logger.debug('ADD queue {}'.format(queue_key))
+            n_trimmed += queue_trimmed
+        if n_trimmed:
+            self.spider.crawler.stats.inc_value(
+                'dd_crawler/queue/trimmed', n_trimmed)
+        if any_queue_added:
+            self.update_queue_stats()
+        return pushed
+
+    def _encode_items(self, requests: List[Request]
+                      ) -> List[Tuple[float, bytes]]:
+        """ Encode requests as (score, data) pairs.
+        """
+        max_score = self.spider.settings.getfloat('DD_MAX_SCORE', np.inf)
+        return [(-min(request.priority, max_score),
+                 self._encode_request(request)) for request in requests]
+
+    def _push_queues(self, by_queue: Dict[str, List[Tuple[float, bytes]]],
+                     count_pushed: bool=True, admitted: bool=False
+                     ) -> List[List]:
+        """ Push encoded requests to several queues (in one round-trip
+        for each partition), and store requests spilled by PUSH script.
+        Return PUSH script results for each queue. count_pushed is False
+        for requests returned to the queue, so that they are not counted
+        in pushed counters again. admitted is True when queues have
+        already been admitted under max_domains limit.
+        """
+        if self.max_domains and not self._admit_in_push and not admitted:
+            admitted = self._admit_queues(list(by_queue))
+            results = self._push_queues(
+                OrderedDict((queue_key, items)
+                            for queue_key, items in by_queue.items()
+                            if queue_key in admitted),
+                count_pushed=count_pushed, admitted=True)
+            admitted_results = iter(results)
+            return [next(admitted_results) if queue_key in admitted
+                    else [0, 0, 0, []] for queue_key in by_queue]
+        if not by_queue:
+            return []
+        if len(by_queue) == 1:
+            (queue_key, items), = by_queue.items()
+            results = [self._push_encoded(queue_key, items, count_pushed)]
+        else:
+            pipes = {}
+            for queue_key, items in by_queue.items():
+                partition = self.queue_partition(queue_key)
+                if partition not in pipes:
+                    pipes[partition] = self.partitions[partition]\
+                        .pipeline(transaction=False)
+                self._push_encoded(queue_key, items, count_pushed,
+                                   client=pipes[partition])
+            partition_results = {
+                partition: iter(results) for partition, results
+                in self._execute_pipelines(pipes).items()}
+            results = [next(partition_results[self.queue_partition(queue_key)])
+                       for queue_key in by_queue]
+        n_spilled = 0
+        for queue_key, (_, _, _, spilled) in zip(by_queue, results):
+            if spilled:
+                if isinstance(queue_key, str):
+                    queue_key = queue_key.encode('utf8')
+                self.spill_store.append(queue_key, [
+                    (float(score), data)
+                    for data, score in zip(spilled[::2], spilled[1::2])])
+                n_spilled += len(spilled) // 2
+        if n_spilled:
+            self.spider.crawler.stats.inc_value(
+                'dd_crawler/queue/spilled', n_spilled)
+        return results
+
+    def _push_encoded(self, queue_key: str, items: List[Tuple[float, bytes]],
+                      count_pushed: bool=True, client=None):
+        """ Push encoded requests, given as (score, data) pairs, to given
+        queue with the PUSH script: admission checks, insert, length
+        accounting and queue score update are done atomically.
+        """
+        args = [self.max_domains if self.max_domains and self._admit_in_push
+                else -1,
+                int(self.restrict_domanis), self.max_per_domain,
+                self.spill_high_water if self.spill_store else 0,
+                int(count_pushed)]
+        for score, data in items:
+            args.extend([score, data])
+        if client is None:
+            client = self.queue_server(queue_key)
+        return self._push_script(
+            keys=[queue_key, self.queues_key, self.relevant_queues_key,
+                  self.len_key, self.did_restrict_key,
+                  self.queue_shard_key(queue_key),
+                  self.index_generation_key, self.index_log_key,
+                  self.trimmed_key, self.queued_key, self.pushed_key,
+                  self.counters_key, self.admitted_key],
+            args=args, client=client)
+
+    def _admit_queues(self, queue_keys: List[str]) -> Set[str]:
+        """ Admit queues under max_domains limit, shared by all partitions,
+        with ADMIT script on the main server, and return admitted ones.
+        Admitted queues are cached, as they stay admitted.
+        """
+        unknown = [queue_key for queue_key in queue_keys
+                   if queue_key not in self._admitted_queues]
+        if unknown:
+            admitted = self._admit_script(
+                keys=[self.admitted_key], args=[self.max_domains] + unknown)
+            self._admitted_queues.update(
+                queue_key for queue_key, is_admitted in zip(unknown, admitted)
+                if is_admitted)
+        return {queue_key for queue_key in queue_keys
+                if queue_key in self._admitted_queues}
+
+    def _init_admitted(self):
+        """ Admit existing queues of all partitions when resuming a crawl
+        started before admitted queues were tracked.
+        """
+        if self.server.exists(self.admitted_key):
+            return
+        for server in self.partitions:
+            cursor = None
+            while cursor != 0:
+                cursor, items = server.zscan(
+                    self.queues_key, cursor or 0, count=1000)
+                if items:
+                    self.server.sadd(
+                        self.admitted_key, *[q for q, _ in items])
 
     def pop(self, timeout=0) -> Optional[Request]:
+        self.heartbeat()
         self.update_queue_stats()
+        self.reload_spilled()
         queue_key = self.select_queue_key()
         if queue_key:
             results = self.pop_from_queue(queue_key, 1)
@@ -114,10 +374,14 @@ class BaseRequestQueue(Base):
         crawler = self.spider.crawler
         stats = crawler.stats
         stats.set_value('dd_crawler/queue/urls', len(self))
+        if self.spill_store is not None:
+            stats.set_value('dd_crawler/queue/spilled_urls',
+                            len(self.spill_store))
         if update_domains:
             n_domains_key = 'dd_crawler/queue/domains'
             prev_n_domains = stats.get_value(n_domains_key)
-            n_domains = self.server.zcard(self.queues_key)
+            n_domains = sum(self._fan_out(
+                lambda server: server.zcard(self.queues_key)))
             if prev_n_domains != n_domains:
                 # In theory it can happen that domains changed but count stayed
                 # the same due to a race conditions with other workers.
@@ -126,37 +390,193 @@ class BaseRequestQueue(Base):
                     signal=queues_changed, queue=self)
                 stats.set_value(n_domains_key, n_domains)
             if self.max_relevant_domains:
-                stats.set_value('dd_crawler/queue/relevant_domains',
-                                self.server.zcard(self.relevant_queues_key))
+                stats.set_value(
+                    'dd_crawler/queue/relevant_domains',
+                    sum(self._fan_out(
+                        lambda server: server.zcard(self.relevant_queues_key))))
 
     def clear(self):
         logging.info('Clearing all keys for {}'.format(self.key))
-        keys = {self.len_key, self.queues_key, self.relevant_queues_key,
-                self.did_restrict_key, self.workers_key, self.worker_id_key}
-        keys.update(self.get_workers())
-        keys.update(self.get_queues())
-        self.server.delete(*keys)
+        self._fan_out(self._clear_partition)
+        self.server.delete(self.workers_key, self.worker_id_key,
+                           self.domain_ids_key, self.domain_names_key,
+                           self.domain_id_counter_key, self.admitted_key)
+        self._admitted_queues.clear()
+        self._domain_queue_keys.clear()
+        self._queue_key_domains.clear()
+        if self.spill_store is not None:
+            self.spill_store.clear()
         super().clear()
 
+    def _clear_partition(self, server: StrictRedis):
+        keys = {self.len_key, self.queues_key, self.relevant_queues_key,
+                self.did_restrict_key, self.selected_relevant_key,
+                self.restrict_progress_key, self.trimmed_key, self.queued_key,
+                self.pushed_key, self.popped_key, self.counters_key}
+        keys.update(self.shard_key(shard) for shard in range(self.n_shards))
+        keys.update([self.n_shards_key, self.index_generation_key,
+                     self.index_log_key])
+        keys.update(server.zrange(self.queues_key, 0, -1))
+        keys.update(server.scan_iter(match=self._lease_key('*')))
+        server.delete(*keys)
+
     def get_queues(self, withscores=False
                    ) -> Union[List[bytes], List[Tuple[bytes, float]]]:
-        return self.server.zrange(self.queues_key, 0, -1, withscores=withscores)
+        if len(self.partitions) == 1:
+            return self.server.zrange(
+                self.queues_key, 0, -1, withscores=withscores)
+        queues = list(heapq.merge(
+            *self._fan_out(lambda server: server.zrange(
+                self.queues_key, 0, -1, withscores=True)),
+            key=lambda x: x[1]))
+        return queues if withscores else [q for q, _ in queues]
 
     def try_to_restrict_domains(self):
-        if (self.restrict_domanis
-            and not self.did_restrict_domains
-            and time.time() - self.start_time > self.restrict_delay
-            and self.server.zcard(self.relevant_queues_key) >=
+        """ Select relevant domains and remove all other domain queues,
+        once the restriction delay has passed and enough relevant domains
+        are found. Queues are removed incrementally: each call processes
+        at most restrict_chunks_per_call chunks of restrict_chunk_size queues
+        (found with ZSCAN) in each partition, and any worker can continue
+        the restriction started by another one.
+        """
+        if not self.restrict_domanis or self._restriction_done:
+            return
+        flags = self._restrict_flags()
+        if any(flags):
+            if not all(flags):
+                self._complete_restriction_start(flags)
+            self._continue_restriction()
+        elif (time.time() - self.start_time > self.restrict_delay
+              and sum(self._fan_out(
+                  lambda server: server.zcard(self.relevant_queues_key))) >=
                 self.max_relevant_domains):
-            selected_relevant = set(self.server.zrange(
-                self.relevant_queues_key, 0, self.max_relevant_domains - 1))
-            irrelevant = (set(self.server.zrange(self.queues_key, 0, -1)) -
-                          selected_relevant)
-            logger.info(
-                'Removing {:,} irrelevant domains. {:,} relevant domains left'
-                .format(len(irrelevant), len(selected_relevant)))
-            self.server.zrem(self.queues_key, *irrelevant)
-            self.server.set(self.did_restrict_key, b'1')
+            selected_relevant = {q for q, _ in heapq.nsmallest(
+                self.max_relevant_domains,
+                heapq.merge(*self._fan_out(lambda server: server.zrange(
+                    self.relevant_queues_key, 0, self.max_relevant_domains - 1,
+                    withscores=True)), key=lambda x: x[1]),
+                key=lambda x: x[1])}
+            self._fan_out(lambda server: self._start_partition_restriction(
+                server, selected_relevant))
+            logger.info('Selected {:,} relevant domains, removing others'
+                        .format(len(selected_relevant)))
+            self._continue_restriction()
+
+    def _start_partition_restriction(
+            self, server: StrictRedis, selected_relevant: Set[bytes]):
+        pipe = server.pipeline()
+        pipe.multi()
+        pipe.delete(self.selected_relevant_key, self.restrict_progress_key)
+        if selected_relevant:
+            pipe.sadd(self.selected_relevant_key, *selected_relevant)
+        pipe.hset(self.restrict_progress_key, 'total',
+                  server.zcard(self.queues_key))
+        pipe.set(self.did_restrict_key, b'1')
+        pipe.execute()
+
+    def _complete_restriction_start(self, flags: List[bool]):
+        """ Start the restriction in partitions where it was not started
+        (e.g. the worker which started it was stopped midway),
+        with relevant domains selected in other partitions.
+        """
+        selected_relevant = set()
+        for server, flag in zip(self.partitions, flags):
+            if flag:
+                selected_relevant.update(
+                    server.smembers(self.selected_relevant_key))
+        for server, flag in zip(self.partitions, flags):
+            if not flag:
+                self._start_partition_restriction(server, selected_relevant)
+
+    def _continue_restriction(self):
+        results = self._fan_out(self._restrict_partition_chunks)
+        progress = Counter()
+        removed = []
+        for partition_progress, partition_removed in results:
+            progress.update(partition_progress)
+            removed.extend(partition_removed)
+        done = progress['done'] == len(self.partitions)
+        stats = self.spider.crawler.stats
+        for name in ['scanned', 'removed_domains', 'removed_requests']:
+            stats.set_value('dd_crawler/queue/restrict_{}'.format(name),
+                            progress[name])
+        stats.set_value('dd_crawler/queue/restrict_progress',
+                        1 if done else
+                        progress['scanned'] / max(1, progress['total']))
+        if removed:
+            if not self._admit_in_push:
+                # admitted queues are kept on the main server
+                self.server.srem(self.admitted_key, *removed)
+            self._admitted_queues.difference_update(
+                queue_key.decode('utf8') for queue_key in removed)
+            self._send_domains_removed(removed, reason='restricted')
+            self.update_queue_stats()
+        if done:
+            self._restriction_done = True
+            logger.info('Removed {:,} irrelevant domains with {:,} requests'
+                        .format(progress['removed_domains'],
+                                progress['removed_requests']))
+
+    def _restrict_partition_chunks(self, server: StrictRedis
+                                   ) -> Tuple[Dict[str, int], List[bytes]]:
+        """ Remove irrelevant queues found in the next chunks of the queues
+        index, returning restriction progress and removed queues.
+        Several workers can scan the same chunk: removal has no effect
+        for already removed queues, and the cursor is advanced (and the chunk
+        counted as scanned) only by the first one.
+        """
+        progress = server.hgetall(self.restrict_progress_key)
+        removed = []
+        if not progress:
+            # restriction was done by an older version all at once
+            return {'done': 1}, removed
+        if not progress.get(b'done'):
+            selected_relevant = server.smembers(self.selected_relevant_key)
+            cursor = int(progress.get(b'cursor', 0))
+            for _ in range(self.restrict_chunks_per_call):
+                next_cursor, items = server.zscan(
+                    self.queues_key, cursor, count=self.restrict_chunk_size)
+                irrelevant = [queue_key for queue_key, _ in items
+                              if queue_key not in selected_relevant]
+                n_removed_domains = n_removed_requests = 0
+                for i in range(0, len(irrelevant), self.restrict_chunk_size):
+                    chunk_removed, n_requests = self._remove_queues_script(
+                        keys=[self.len_key, self.queues_key, self.queued_key,
+                              self.index_generation_key, self.index_log_key,
+                              self.pushed_key, self.popped_key,
+                              self.trimmed_key, self.admitted_key] +
+                             [key for queue_key in irrelevant[
+                                 i: i + self.restrict_chunk_size]
+                              for key in [queue_key,
+                                          self.queue_shard_key(queue_key)]],
+                        client=server)
+                    removed.extend(chunk_removed)
+                    n_removed_domains += len(chunk_removed)
+                    n_removed_requests += n_requests
+                advanced = self._advance_restriction_script(
+                    keys=[self.restrict_progress_key],
+                    args=[cursor, next_cursor, len(items),
+                          n_removed_domains, n_removed_requests],
+                    client=server)
+                if advanced:
+                    cursor = next_cursor
+                else:
+                    # another worker has scanned this chunk
+                    progress = server.hgetall(self.restrict_progress_key)
+                    if progress.get(b'done'):
+                        break
+                    cursor = int(progress.get(b'cursor', 0))
+                if cursor == 0:
+                    break
+            progress = server.hgetall(self.restrict_progress_key)
+        return ({k.decode('utf8'): int(v) for k, v in progress.items()},
+                removed)
+
+    def _send_domains_removed(self, queue_keys: List[bytes], reason: str):
+        if queue_keys:
+            self.spider.crawler.signals.send_catch_log(
+                signal=domains_removed, reason=reason,
+                domains=self.queue_keys_domains(queue_keys))
 
     def set_spider_domain_limit(self):
         """ Set domain_limit attribute on the spider: it is read by middlewares
@@ -167,176 +587,691 @@ class BaseRequestQueue(Base):
 
     @property
     def did_restrict_domains(self) -> bool:
-        """ Relevant domains have already been selected.
+        """ Relevant domains have already been selected (in any partition).
         """
-        return self.restrict_domanis and self.server.get(self.did_restrict_key)
+        return self.restrict_domanis and any(self._restrict_flags())
+
+    def _restrict_flags(self) -> List[bool]:
+        return [bool(flag) for flag in self._fan_out(
+            lambda server: server.get(self.did_restrict_key))]
 
     def page_is_relevant(self, url: str, score: float):
         """ Mark page domain as relevant, if max_relevant_domains is set.
         """
         if self.max_relevant_domains:
             queue_key = self.url_queue_key(url)
-            self.server.zincrby(self.relevant_queues_key, queue_key, -score**2)
+            self.queue_server(queue_key).zincrby(
+                self.relevant_queues_key, queue_key, -score**2)
 
     def get_workers(self) -> List[bytes]:
-        return self.server.smembers(self.workers_key)
+        return self.server.zrange(self.workers_key, 0, -1)
 
     @warn_if_slower(0.1, logger)
     def select_queue_key(self) -> Optional[bytes]:
         """ Select which queue (domain) to use next.
         """
-        idx, n_idx = self.discover()
-        self.get_my_queues(idx, n_idx)  # This is a caching trick:
-        # the trick above is needed because get_available_queues calls
-        # get_my_queues, which is also cached, but we want independent
-        # runtime estimates for them. So we cache get_my_queues here, and
-        # runtime of get_available_queues does not include get_my_queues.
-        # TODO - track this in cacheforawhile
-        queue = self.select_best_queue(idx, n_idx)
+        shards = self.get_my_shards()
+        # Update queues before get_available_queues: it is cached
+        # until queues change (or for a while).
+        self.get_my_queues(shards)
+        queue = self.select_best_queue(shards)
         if queue:
-            if self.server.zcard(queue):
+            if self.queue_server(queue).zcard(queue):
                 return queue
             else:
                 self.remove_queue(queue)
 
-    def select_best_queue(self, idx: int, n_idx: int) -> Optional[bytes]:
+    def select_best_queue(self, shards: Tuple[int, ...]) -> Optional[bytes]:
         """ Select queue to crawl from, taking free slots into account.
         """
-        available_queues, scores = self.get_available_queues(idx, n_idx)
+        available_queues, scores = self.get_available_queues(
+            shards, self.cache_version)
         if available_queues:
             return random.choice(available_queues)
 
     @cacheforawhile
-    def get_available_queues(self, idx: int, n_idx: int)\
+    def get_available_queues(self, shards: Tuple[int, ...],
+                             cache_version: int)\
             -> Tuple[List[bytes], np.ndarray]:
         """ Return all queues with free slots (or just all) and their weights.
+        cache_version is a part of the cache key, so that the result is
+        recomputed when local queues change.
         """
-        all_queues, all_scores = self.get_my_queues(idx, n_idx)
+        all_queues, all_scores = self.get_my_queues(shards)
         slots = self.get_slots()
         available_queues, scores = [], []
-        for q, s in zip(all_queues, all_scores):
-            domain = self.queue_key_domain(q)
-            if domain not in slots or slots[domain].free_transfer_slots():
+        for q, s, domain in zip(all_queues, all_scores,
+                                self.queue_keys_domains(all_queues)):
+            if self.slot_is_free(domain, slots):
                 available_queues.append(q)
                 scores.append(s)
         return ((available_queues, np.array(scores)) if available_queues else
                 (all_queues, all_scores))
 
+    def get_sampler(self, queues: List[bytes], scores: np.ndarray)\
+            -> 'SoftmaxSampler':
+        """ Return a softmax sampler for given queues: it is re-used while
+        queues are the same list object. get_my_queues and
+        get_available_queues return the same list until it is recomputed
+        (after index changes, or when available slots are re-checked),
+        so the sampler never draws from a stale list.
+        """
+        if self._sampler is None or self._sampler.queues is not queues:
+            self._sampler = SoftmaxSampler(queues, scores, self.spider.settings)
+        return self._sampler
+
     def get_slots(self) -> Dict:
         return (self.spider.crawler.engine.downloader.slots
                 if self.slots_mock is None else self.slots_mock)
 
     def has_free_slots(self, queue: bytes, slots: Dict) -> bool:
-        domain = self.queue_key_domain(queue)
-        return domain not in slots or slots[domain].free_transfer_slots()
+        return self.slot_is_free(self.queue_key_domain(queue), slots)
 
-    @cacheforawhile
-    def get_my_queues(self, idx: int, n_idx: int)\
+    @staticmethod
+    def slot_is_free(slot_key: str, slots: Dict) -> bool:
+        """ Check free transfer slots of a downloader slot: popped requests
+        have registered domain as download_slot (see _decode_request_priority),
+        so queue domains can be used as slot keys.
+        """
+        slot = slots.get(slot_key)
+        return slot is None or bool(slot.free_transfer_slots())
+
+    def get_my_queues(self, shards: Tuple[int, ...])\
             -> Tuple[List[bytes], np.ndarray]:
-        """ Get queues belonging to this worker.
-        Here we cache not only expensive redis call, but queue selection too.
+        """ Get queues belonging to this worker (from the shards it owns).
+        Queues are cached: the cache is updated incrementally when index
+        generation changes (this is checked not more often than each
+        index_check_interval seconds), and is re-read each QUEUE_CACHE_TIME
+        seconds to update queue scores.
+        """
+        t = time.time()
+        if (self.skip_cache or shards != self._index_shards or
+                t - self._index_load_time > self.cache_time):
+            self.load_index(shards)
+        elif t - self._index_check_time > self.index_check_interval:
+            self.update_index()
+        return self._index_snapshot
+
+    def load_index(self, shards: Tuple[int, ...]):
+        """ Read all queues from given shards, together with index generation
+        (from each partition).
         """
         self.try_to_restrict_domains()
         self.set_spider_domain_limit()
-        queues = self.get_queues(withscores=True)
-        my_queues, my_scores = [], []
-        for q, s in queues:
-            if crc32(q) % n_idx == idx:
-                my_queues.append(q)
-                my_scores.append(s)
-        return my_queues, np.array(my_scores)
-
-    def discover(self) -> Tuple[int, int]:
-        """ Return a tuple of (my index, total number of workers).
+
+        def load(server):
+            pipe = server.pipeline()
+            pipe.multi()
+            pipe.get(self.index_generation_key)
+            for shard in shards:
+                pipe.zrange(self.shard_key(shard), 0, -1, withscores=True)
+            return pipe.execute()
+
+        self._index = {self.shard_key(shard).encode('utf8'): {}
+                       for shard in shards}
+        self._index_generations = []
+        for generation, *shard_queues in self._fan_out(load):
+            self._index_generations.append(int(generation or 0))
+            for shard, queues in zip(shards, shard_queues):
+                self._index[self.shard_key(shard).encode('utf8')]\
+                    .update(queues)
+        self._index_shards = shards
+        self._index_load_time = self._index_check_time = time.time()
+        self._update_index_snapshot()
+
+    def update_index(self):
+        """ Apply index changes since the last seen index generation
+        to queues of this worker.
+        """
+        self._index_check_time = time.time()
+        results = [self._index_changes_script(
+            keys=[self.index_generation_key, self.index_log_key],
+            args=[generation], client=server)
+            for server, generation in zip(
+                self.partitions, self._index_generations)]
+        generations = [generation for generation, *_ in results]
+        if generations == self._index_generations:
+            return
+        if not all(changes for _, *changes in results):
+            # we are too far behind
+            self.load_index(self._index_shards)
+            return
+        self.try_to_restrict_domains()
+        self.set_spider_domain_limit()
+        changed = False
+        for entry in (entry for _, changes in results for entry in changes):
+            op, *args = entry.split(b'\t')
+            if op == b'w':
+                self._live_workers = None  # refresh on next discover
+            elif op == b'*':
+                self.load_index(self._index_shards)
+                return
+            else:
+                shard_key, queue_key = args[:2]
+                queues = self._index.get(shard_key)
+                if queues is not None:
+                    if op == b'+':
+                        queues[queue_key] = float(args[2])
+                    else:
+                        queues.pop(queue_key, None)
+                    changed = True
+        self._index_generations = generations
+        if changed:
+            self._update_index_snapshot()
+
+    def _update_index_snapshot(self):
+        self._index_snapshot = (
+            [q for queues in self._index.values() for q in queues],
+            np.array([s for queues in self._index.values()
+                      for s in queues.values()]))
+        self.cache_version += 1
+
+    def _log_index_changes(self, pipe, entries: List[str]):
+        """ Record index changes (see queue_scripts for the format)
+        in a MULTI pipeline.
+        """
+        pipe.incrby(self.index_generation_key, len(entries))\
+            .rpush(self.index_log_key, *entries)\
+            .ltrim(self.index_log_key, -queue_scripts.INDEX_LOG_LENGTH, -1)
+
+    def get_my_shards(self) -> Tuple[int, ...]:
+        """ Return shards owned by this worker: whole shards are
+        assigned to workers, and re-assigned when workers change.
+        """
+        workers = self.discover()
+        if workers != self._workers:
+            if len(workers) > self.n_shards:
+                logger.warning(
+                    'More workers ({}) than QUEUE_INDEX_SHARDS ({}): '
+                    'some workers will be idle'
+                    .format(len(workers), self.n_shards))
+            owners = self.get_shard_owners(workers)
+            if self._shard_owners is not None:
+                self.track_moved_domains(self._shard_owners, owners)
+            self._workers, self._shard_owners = workers, owners
+            self._my_shards = tuple(
+                shard for shard, owner in enumerate(owners)
+                if owner == self.worker_id)
+        return self._my_shards
+
+    def get_shard_owners(self, workers: Tuple[int, ...]) -> List[int]:
+        """ Return owner worker id for each shard.
+        With QUEUE_OWNERSHIP = 'modulo', almost all shards move to other
+        workers when one worker joins or leaves. With 'rendezvous'
+        (highest random weight) hashing, only about 1/N of them move.
+        """
+        if self.ownership == 'rendezvous':
+            return [max(workers, key=lambda w: _rendezvous_weight(shard, w))
+                    for shard in range(self.n_shards)]
+        else:
+            return [workers[shard % len(workers)]
+                    for shard in range(self.n_shards)]
+
+    def track_moved_domains(self, prev_owners: List[int], owners: List[int]):
+        """ Count domains that were moved to this worker
+        after a change of the worker set (summing over all workers gives
+        the total number of moved domains).
+        """
+        moved_in = [shard for shard, (prev_owner, owner)
+                    in enumerate(zip(prev_owners, owners))
+                    if owner == self.worker_id and prev_owner != owner]
+
+        def count(server):
+            pipe = server.pipeline(transaction=False)
+            for shard in moved_in:
+                pipe.zcard(self.shard_key(shard))
+            return sum(pipe.execute())
+
+        n_moved = sum(self._fan_out(count))
+        n_moved_shards = sum(p != o for p, o in zip(prev_owners, owners))
+        logger.info('Worker set changed: {} shards moved, {} shards with {} '
+                    'domains moved to this worker'
+                    .format(n_moved_shards, len(moved_in), n_moved))
+        stats = self.spider.crawler.stats
+        stats.inc_value('dd_crawler/queue/worker_set_changes')
+        stats.inc_value('dd_crawler/queue/moved_domains', n_moved)
+        stats.set_value('dd_crawler/queue/last_moved_domains', n_moved)
+
+    def shard_key(self, shard: int) -> str:
+        return self.fkey('queues-shard:{}'.format(shard))
+
+    def queue_shard_key(self, queue_key: Union[str, bytes]) -> str:
+        return self.shard_key(_queue_hash(queue_key) % self.n_shards)
+
+    def queue_partition(self, queue_key: Union[str, bytes]) -> int:
+        """ Index of the partition where given queue is stored.
+        """
+        return _queue_hash(queue_key) % len(self.partitions)
+
+    def queue_server(self, queue_key: Union[str, bytes]) -> StrictRedis:
+        return self.partitions[self.queue_partition(queue_key)]
+
+    def init_shards(self):
+        """ (Re)build shards from the global queues index if they were built
+        with a different number of shards, or not built at all
+        (e.g. when resuming a crawl started with an older version).
+        """
+        self._fan_out(self._init_partition_shards)
+
+    def _init_partition_shards(self, server: StrictRedis):
+        prev_n_shards = server.getset(self.n_shards_key, self.n_shards)
+        prev_n_shards = int(prev_n_shards) if prev_n_shards else 0
+        if prev_n_shards == self.n_shards:
+            return
+        logger.info('Building {} queue index shards (previously {})'
+                    .format(self.n_shards, prev_n_shards))
+        pipe = server.pipeline(transaction=False)
+        for shard in range(prev_n_shards):
+            pipe.delete(self.shard_key(shard))
+        for queue_key, score in server.zrange(
+                self.queues_key, 0, -1, withscores=True):
+            pipe.zadd(self.queue_shard_key(queue_key), score, queue_key)
+        pipe.execute()
+        pipe = server.pipeline()
+        pipe.multi()
+        self._log_index_changes(pipe, ['*'])
+        pipe.execute()
+
+    def discover(self) -> Tuple[int, ...]:
+        """ Return a sorted tuple of live worker ids.
         When workers connect or disconnect, this will cause re-distribution
         of domains between workers, but this is not an issue.
+        Heartbeat is sent (and live workers are refreshed) not more often
+        than each heartbeat_interval seconds.
         """
-        self.im_alive()
-        worker_ids = set(map(int, self.get_workers()))
-        for worker_id in list(worker_ids):
-            if not self.is_alive(worker_id):
-                self.server.srem(self.workers_key, worker_id)
-                worker_ids.remove(worker_id)
-        if self.worker_id in worker_ids:
-            worker_ids = sorted(worker_ids)
-            return worker_ids.index(self.worker_id), len(worker_ids)
+        self.heartbeat(force=self.skip_cache or self._live_workers is None)
+        if self.worker_id in self._live_workers:
+            return self._live_workers
         else:
             # This should not happen normally
             logger.warning('No live workers: selecting self!')
-            return 0, 1
-
-    def im_alive(self):
-        """ Tell the server that current worker is alive.
+            return self.worker_id,
+
+    def heartbeat(self, force=False):
+        """ Send a heartbeat if the last one was sent more than
+        heartbeat_interval seconds ago. Besides discover, this is called
+        on each pop and ack, and periodically by the scheduler,
+        so that a worker busy with a large batch of leased requests
+        is not considered dead by other workers.
+        """
+        if (force or
+                time.time() - self._last_heartbeat > self.heartbeat_interval):
+            self._live_workers = self.im_alive()
+
+    def im_alive(self) -> Tuple[int, ...]:
+        """ Tell the server that current worker is alive, remove workers
+        which did not send a heartbeat for alive_timeout seconds,
+        and return a sorted tuple of live worker ids, in one round-trip.
+        Heartbeats use local time, so clocks of workers should not differ
+        by more than a fraction of alive_timeout.
         """
+        self._last_heartbeat = time.time()
+        min_alive_time = self._last_heartbeat - self.alive_timeout
         pipe = self.server.pipeline()
         pipe.multi()
-        pipe.sadd(self.workers_key, self.worker_id)\
-            .set(self._worker_key(self.worker_id), 'ok', ex=self.alive_timeout)\
+        added, dead_workers, _, worker_ids = pipe\
+            .zadd(self.workers_key, self._last_heartbeat, self.worker_id)\
+            .zrangebyscore(self.workers_key, '-inf', min_alive_time)\
+            .zremrangebyscore(self.workers_key, '-inf', min_alive_time)\
+            .zrange(self.workers_key, 0, -1)\
             .execute()
-
-    def is_alive(self, worker_id) -> bool:
-        """ Return whether given worker is alive.
+        if added or dead_workers:
+            # workers read logs of all partitions, so one is enough
+            pipe = self.partitions[0].pipeline()
+            pipe.multi()
+            self._log_index_changes(pipe, ['w'])
+            pipe.execute()
+        for worker_id in dead_workers:
+            self.requeue_lease(int(worker_id))
+        return tuple(sorted(map(int, worker_ids)))
+
+    def leave(self):
+        """ Remove current worker from live workers, so that its shards
+        are re-assigned to other workers without waiting for alive_timeout.
         """
-        return bool(self.server.get(self._worker_key(worker_id)))
-
-    def _worker_key(self, worker_id) -> str:
-        return self.fkey('worker-{}'.format(worker_id))
+        if self.server.zrem(self.workers_key, self.worker_id):
+            pipe = self.partitions[0].pipeline()
+            pipe.multi()
+            self._log_index_changes(pipe, ['w'])
+            pipe.execute()
+        self._live_workers = ()
+
+    def _lease_key(self, worker_id: int) -> str:
+        return self.fkey('lease:{}'.format(worker_id))
+
+    def requeue_lease(self, worker_id: int):
+        """ Return requests leased by given (dead) worker
+        and not acknowledged back to their queues.
+        """
+        lease_key = self._lease_key(worker_id)
+
+        def claim(server):
+            pipe = server.pipeline()
+            pipe.multi()
+            leased, _ = pipe.hgetall(lease_key).delete(lease_key).execute()
+            return leased
+
+        leased = {}
+        for partition_leased in self._fan_out(claim):
+            leased.update(partition_leased)
+        if not leased:
+            return
+        queue_prefix = self.queue_key_prefix.encode('utf8')
+        by_queue = OrderedDict()
+        n_requeued = n_skipped = 0
+        for field, score in leased.items():
+            if field.startswith(queue_prefix):
+                queue_key, data = field.split(b'\t', 1)
+                queue_key = queue_key.decode('utf8')
+            else:  # leased by an older version, without queue key
+                data = field
+                request = self._decode_request_without_queue_key(data)
+                if request is None:
+                    n_skipped += 1
+                    continue
+                queue_key = self.url_queue_key(request.url)
+            by_queue.setdefault(queue_key, []).append((float(score), data))
+            n_requeued += 1
+        self._push_queues(by_queue, count_pushed=False)
+        if n_skipped:
+            logger.warning('Skipped {} requests leased by worker {}: '
+                           'they can not be decoded without queue key'
+                           .format(n_skipped, worker_id))
+        logger.info('Requeued {} requests leased by worker {}'
+                    .format(n_requeued, worker_id))
+        self.spider.crawler.stats.inc_value(
+            'dd_crawler/queue/requeued', n_requeued)
+
+    def ack(self, request: Request):
+        """ Acknowledge that leased request has been crawled
+        (or failed), so it won't be requeued. Acknowledgements are sent
+        in batches (see flush_acks).
+        """
+        self.heartbeat()
+        data = request.meta.get('queue_lease')
+        if data is not None:
+            queue_key, _ = data.split(b'\t', 1)
+            self._acks.append((self.queue_partition(queue_key), data))
+            if len(self._acks) >= 100:
+                self.flush_acks()
+
+    def flush_acks(self):
+        if self._acks:
+            by_partition = {}
+            for partition, data in self._acks:
+                by_partition.setdefault(partition, []).append(data)
+            for partition, acks in by_partition.items():
+                self.partitions[partition].hdel(self.lease_key, *acks)
+            self._acks = []
+
+    def close(self):
+        """ Flush pending acknowledgements and close the spill store.
+        Called by the scheduler when the spider is closed.
+        """
+        self.flush_acks()
+        if self.spill_store is not None:
+            self.spill_store.close()
 
     def pop_from_queue(self, queue_key: bytes, n: int) -> List[Request]:
         """ Pop values with highest priorities from the given queue.
         """
-        pipe = self.server.pipeline()
-        pipe.multi()
-        # Get one extra element to know new max score after pop
-        pipe.zrange(queue_key, 0, n, withscores=True)\
-            .zremrangebyrank(queue_key, 0, n - 1)
-        results, count = pipe.execute()
-        if results:
-            self.server.decr(self.len_key, count)
-            if len(results) == n + 1:
-                _, queue_score = results[-1]
-                self.server.zadd(self.queues_key, queue_score, queue_key)
-            else:
-                self.remove_queue(queue_key)
-            return [self._decode_request_priority(r, -s)
-                    for r, s in results[:n]]
-        else:
-            # queue was empty: remove it from queues set
-            self.remove_queue(queue_key)
-            return []
+        return self.pop_from_queues([(queue_key, n)])[0]
 
-    def add_queue(self, queue_key, queue_score: float):
-        added = self.server.zadd(self.queues_key, queue_score, queue_key)
-        self.update_queue_stats(update_domains=added)
-        if added:
-            logger.debug('ADD queue {}'.format(queue_key))
+    def pop_from_queues(self, queue_counts: List[Tuple[bytes, int]])\
+            -> List[List[Request]]:
+        """ Pop values with highest priorities from several queues at once,
+        given a list of (queue_key, number of values) pairs.
+        Queue scores and the total length are updated in the same script call.
+        """
+        if not queue_counts:
+            return []
+        self.flush_acks()
+        by_partition = OrderedDict()
+        for queue_key, n in queue_counts:
+            by_partition.setdefault(
+                self.queue_partition(queue_key), []).append((queue_key, n))
+
+        def pop(item):
+            partition, partition_counts = item
+            return self._pop_multi_script(
+                keys=[self.len_key, self.queues_key,
+                      self.index_generation_key, self.index_log_key,
+                      self.lease_key, self.queued_key, self.popped_key,
+                      self.counters_key] +
+                     [key for queue_key, _ in partition_counts
+                      for key in [queue_key, self.queue_shard_key(queue_key)]],
+                args=[int(self.use_leases)] + [n for _, n in partition_counts],
+                client=self.partitions[partition])
+
+        partition_items = list(by_partition.items())
+        if self._executor is None or len(partition_items) == 1:
+            partition_results = list(map(pop, partition_items))
+        else:
+            partition_results = list(self._executor.map(pop, partition_items))
+        removed_queues = [queue_key for removed, _ in partition_results
+                          for queue_key in removed]
+        popped_by_partition = {
+            partition: iter(popped) for (partition, _), (_, popped)
+            in zip(partition_items, partition_results)}
+        if removed_queues:
+            self.update_queue_stats()
+            self._send_domains_removed(removed_queues, reason='exhausted')
+            self.reload_spilled(removed_queues)
+        if self.domain_ids:
+            # domains are needed to decode domain-relative urls
+            self.queue_keys_domains([q for q, _ in queue_counts])
+        results = []
+        for queue_key, _ in queue_counts:
+            items = next(popped_by_partition[self.queue_partition(queue_key)])
+            if isinstance(queue_key, str):
+                queue_key = queue_key.encode('utf8')
+            requests = []
+            for data, score in zip(items[::2], items[1::2]):
+                request = self._decode_request_priority(
+                    data, -float(score), queue_key)
+                if self.use_leases:
+                    request.meta['queue_lease'] = queue_key + b'\t' + data
+                requests.append(request)
+            results.append(requests)
+        return results
+
+    def reload_spilled(self, queue_keys: Optional[List[bytes]]=None):
+        """ Move spilled requests back to redis for queues which have less
+        than spill_low_water requests there. Given queues (e.g. just
+        exhausted ones) are checked at once, and all queues with spilled
+        requests are checked in chunks of spill_check_chunk queues,
+        not more often than each spill_check_interval seconds.
+        """
+        if self.spill_store is None:
+            return
+        candidates = [q for q in queue_keys or [] if q in self.spill_store]
+        if time.time() - self._spill_check_time > self.spill_check_interval:
+            self._spill_check_time = time.time()
+            if not self._spill_check_keys:
+                self._spill_check_keys.extend(self.spill_store.queue_keys())
+            for _ in range(min(self.spill_check_chunk,
+                               len(self._spill_check_keys))):
+                queue_key = self._spill_check_keys.popleft()
+                if queue_key in self.spill_store:
+                    candidates.append(queue_key)
+        if not candidates:
+            return
+        candidates = list(OrderedDict.fromkeys(candidates))
+        pipes = {}
+        for queue_key in candidates:
+            partition = self.queue_partition(queue_key)
+            if partition not in pipes:
+                pipes[partition] = self.partitions[partition]\
+                    .pipeline(transaction=False)
+            pipes[partition].zcard(queue_key)
+        counts = {partition: iter(result) for partition, result
+                  in self._execute_pipelines(pipes).items()}
+        by_queue = OrderedDict()
+        for queue_key in candidates:
+            n_queued = next(counts[self.queue_partition(queue_key)])
+            if n_queued < self.spill_low_water:
+                by_queue[queue_key.decode('utf8')] = self.spill_store.take(
+                    queue_key, self.spill_high_water - n_queued)
+        if not by_queue:
+            return
+        results = self._push_queues(by_queue, count_pushed=False)
+        stats = self.spider.crawler.stats
+        stats.inc_value('dd_crawler/queue/reloaded',
+                        sum(len(items) for items in by_queue.values()))
+        # requests of queues removed by domain restriction are not pushed
+        n_dropped = sum(len(items) for items, (pushed, *_)
+                        in zip(by_queue.values(), results) if not pushed)
+        if n_dropped:
+            stats.inc_value('dd_crawler/queue/spill_dropped', n_dropped)
+        if any(queue_added for _, queue_added, *_ in results):
+            self.update_queue_stats()
 
     def remove_queue(self, queue_key: bytes) -> None:
-        removed = self.server.zrem(self.queues_key, queue_key)
+        shard_key = self.queue_shard_key(queue_key)
+        pipe = self.queue_server(queue_key).pipeline()
+        pipe.multi()
+        pipe.zrem(self.queues_key, queue_key).zrem(shard_key, queue_key)\
+            .zrem(self.queued_key, queue_key)
+        self._log_index_changes(
+            pipe, ['-\t{}\t{}'.format(shard_key, queue_key.decode('utf8'))])
+        removed, *_ = pipe.execute()
         self.update_queue_stats(update_domains=removed)
         if removed:
             logger.debug('REM queue {}'.format(queue_key))
+            self._send_domains_removed([queue_key], reason='exhausted')
 
     def url_queue_key(self, url: str) -> str:
         """ Key for request queue (based on it's SLD).
         """
-        return self.fkey('domain:{}'.format(get_domain(url)))
+        return self.url_queue_keys([url])[0]
+
+    def url_queue_keys(self, urls: List[str]) -> List[str]:
+        """ Keys for request queues of several urls.
+        With QUEUE_DOMAIN_IDS, queue keys contain integer domain ids instead
+        of domains, and unknown domains are resolved in one round-trip.
+        """
+        domains = [get_domain(url) for url in urls]
+        if not self.domain_ids:
+            return [self.queue_key_prefix + domain for domain in domains]
+        unknown = list(OrderedDict.fromkeys(
+            d for d in domains if d not in self._domain_queue_keys))
+        if unknown:
+            ids = self._domain_ids_script(
+                keys=[self.domain_ids_key, self.domain_names_key,
+                      self.domain_id_counter_key],
+                args=unknown, client=self.server)
+            for domain, domain_id in zip(unknown, ids):
+                queue_key = '{}{}'.format(self.queue_key_prefix, domain_id)
+                self._domain_queue_keys[domain] = queue_key
+                self._queue_key_domains[queue_key.encode('utf8')] = domain
+        return [self._domain_queue_keys[domain] for domain in domains]
 
     def queue_key_domain(self, queue_key: bytes) -> str:
-        queue_key = queue_key.decode('utf8')
-        prefix = self.fkey('domain:')
-        assert queue_key.startswith(prefix)
-        return queue_key[len(prefix):]
+        return self.queue_keys_domains([queue_key])[0]
+
+    def queue_keys_domains(self, queue_keys: List[Union[str, bytes]]
+                           ) -> List[str]:
+        """ Domains of several queues (unknown domain ids are resolved
+        in one round-trip).
+        """
+        queue_keys = [q.encode('utf8') if isinstance(q, str) else q
+                      for q in queue_keys]
+        prefix = self.queue_key_prefix.encode('utf8')
+        if not self.domain_ids:
+            domains = []
+            for queue_key in queue_keys:
+                assert queue_key.startswith(prefix)
+                domains.append(queue_key[len(prefix):].decode('utf8'))
+            return domains
+        unknown = list({q for q in queue_keys
+                        if q not in self._queue_key_domains})
+        if unknown:
+            names = self.server.hmget(
+                self.domain_names_key, [q[len(prefix):] for q in unknown])
+            for queue_key, domain in zip(unknown, names):
+                if domain is None:
+                    raise KeyError('Unknown domain id in {}'.format(queue_key))
+                domain = domain.decode('utf8')
+                self._queue_key_domains[queue_key] = domain
+                self._domain_queue_keys[domain] = queue_key.decode('utf8')
+        return [self._queue_key_domains[q] for q in queue_keys]
 
     def get_stats(self):
         """ Return all queue stats.
         """
         queues = self.get_queues(withscores=True)
+        pipes = {}
+        for name, _ in queues:
+            partition = self.queue_partition(name)
+            if partition not in pipes:
+                pipes[partition] = self.partitions[partition]\
+                    .pipeline(transaction=False)
+            pipes[partition].zcard(name)
+        counts = {partition: iter(result) for partition, result
+                  in self._execute_pipelines(pipes).items()}
+        trimmed = {}
+        for partition_trimmed in self._fan_out(
+                lambda server: server.hgetall(self.trimmed_key)):
+            trimmed.update((name.decode('utf8'), int(n))
+                           for name, n in partition_trimmed.items())
         return dict(
             len=len(self),
             n_domains=len(queues),
-            queues=[(name.decode('utf8'), -score, self.server.zcard(name))
+            queues=[(name.decode('utf8'), -score,
+                     next(counts[self.queue_partition(name)]))
                     for name, score in queues],
+            trimmed=trimmed,
+        )
+
+    def get_top_queues(self, n: int) -> Dict:
+        """ Return total pushed and popped counts and n longest queues,
+        reading only counters maintained by PUSH and POP_MULTI scripts,
+        so this is cheap even with a large number of queues.
+        """
+        def read(server):
+            pipe = server.pipeline(transaction=False)
+            pipe.hgetall(self.counters_key)
+            pipe.zcard(self.queued_key)
+            pipe.zrange(self.queued_key, 0, n - 1, desc=True, withscores=True)
+            return pipe.execute()
+
+        partition_results = self._fan_out(read)
+        top = heapq.nlargest(
+            n, (item for _, _, items in partition_results for item in items),
+            key=lambda x: x[1])
+        pipes = {}
+        for queue_key, _ in top:
+            partition = self.queue_partition(queue_key)
+            if partition not in pipes:
+                pipes[partition] = self.partitions[partition]\
+                    .pipeline(transaction=False)
+            pipes[partition].hget(self.pushed_key, queue_key)\
+                .hget(self.popped_key, queue_key)\
+                .zscore(self.relevant_queues_key, queue_key)
+        results = {partition: iter(result) for partition, result
+                   in self._execute_pipelines(pipes).items()}
+        queues = []
+        domains = self.queue_keys_domains([queue_key for queue_key, _ in top])
+        for (queue_key, n_queued), domain in zip(top, domains):
+            partition_results_iter = results[self.queue_partition(queue_key)]
+            pushed, popped, relevant_score = [
+                next(partition_results_iter) for _ in range(3)]
+            queues.append({
+                'domain': domain,
+                'queued': int(n_queued),
+                'pushed': int(pushed or 0),
+                'popped': int(popped or 0),
+                'relevance': (None if relevant_score is None
+                              else -float(relevant_score)),
+                'shard': _queue_hash(queue_key) % self.n_shards,
+            })
+        counters = [c for c, _, _ in partition_results]
+        return dict(
+            len=len(self),
+            n_domains=sum(n_queues for _, n_queues, _ in partition_results),
+            pushed=sum(int(c.get(b'pushed', 0)) for c in counters),
+            popped=sum(int(c.get(b'popped', 0)) for c in counters),
+            queues=queues,
         )
 
     def has_login_form(self, url):
@@ -369,43 +1304,202 @@ class BaseRequestQueue(Base):
     def fkey(self, s):
         return '{}:{}'.format(self.key, s)
 
+    def _decode_request(self, encoded_request: bytes,
+                        queue_key: Optional[bytes]=None) -> Request:
+        """ Decode request from the given queue: queue key is not needed here,
+        but more compact encodings (see CompactQueue) rely on it.
+        """
+        return super()._decode_request(encoded_request)
+
+    def _decode_request_without_queue_key(self, encoded_request: bytes
+                                          ) -> Optional[Request]:
+        """ Decode request if its encoding does not depend on the queue key,
+        else return None.
+        """
+        return self._decode_request(encoded_request)
+
     def _decode_request_priority(
-            self, encoded_request: bytes, priority: float) -> Request:
-        request = self._decode_request(encoded_request)
+            self, encoded_request: bytes, priority: float,
+            queue_key: Optional[bytes]=None) -> Request:
+        """ Decode popped request, setting its priority and download_slot:
+        requests are put into downloader slots by registered domain,
+        like they are put into queues, so that free slots of a queue
+        can be checked (see slot_is_free).
+        """
+        request = self._decode_request(encoded_request, queue_key)
         request.priority = int(priority)
+        if 'download_slot' not in request.meta:
+            request.meta['download_slot'] = (
+                self.queue_key_domain(queue_key) if queue_key is not None
+                else get_domain(request.url))
         return request
 
 
-# A custom table with symbols commonly occurring in URLs
-# Can be improved a bit (~2%) if built on a large and diverse URL sample.
+def _queue_hash(queue_key: Union[str, bytes]) -> int:
+    if isinstance(queue_key, str):
+        queue_key = queue_key.encode('utf8')
+    return crc32(queue_key)
+
+
+def _rendezvous_weight(shard: int, worker_id: int) -> bytes:
+    return hashlib.md5('{}:{}'.format(shard, worker_id).encode('ascii'))\
+        .digest()
+
+
+# A custom table with symbols commonly occurring in URLs, used by default.
+# It must stay as it is (including "wwww" typos) to decode existing entries:
+# use "scrapy train_url_table" command to build a better table for the crawl.
 smaz_decode = ["http://", "https://", "http://wwww.", "https://wwww.",
                ".com/", ".com", "?", "%"]
 smaz_decode += [x for x in smaz.DECODE if ' ' not in x and x not in smaz_decode]
-smaz_tree = smaz.make_tree(smaz_decode)
+default_url_table = UrlTable(smaz_decode)
 
 
-def url_compress(url: str) -> bytes:
-    return smaz.compress(url, compression_tree=smaz_tree).encode('latin1')
+def url_compress(url: str, table: Optional[UrlTable]=None) -> bytes:
+    return (table or default_url_table).compress(url)
 
 
-def url_decompress(data: bytes) -> str:
-    return smaz.decompress(data.decode('latin1'), decompress_table=smaz_decode)
+def url_decompress(data: bytes, table: Optional[UrlTable]=None) -> str:
+    return (table or default_url_table).decompress(data)
 
 
 class CompactQueue(BaseRequestQueue):
     """ A more compact request representation:
     preserve only url, depth and parent id.
     Priority is stored and set outside of this method.
+
+    Requests are encoded as flags byte, version byte, zigzag varint depth,
+    parent id (if present: 16 bytes, or SHORT_PARENT_ID_LENGTH bytes
+    with QUEUE_SHORT_PARENT_IDS) and smaz-compressed url.
+    The url is stored relative to the queue domain when possible:
+    without http or https scheme (which is kept in flags), and without
+    the domain itself (only subdomain, port, path, query and fragment).
+
+    Version 1 encoding (2 byte depth, 16 byte parent id and full url)
+    is still decoded: its second byte is the high byte of a non-negative
+    depth, so it never has the high bit set, unlike the version byte.
+
+    Urls are compressed with the default table, or with a table trained
+    on the crawl urls (see "scrapy train_url_table"): trained tables are
+    kept in redis, and their id is stored after the version byte,
+    so entries compressed with different tables can coexist.
     """
     no_parent = b'\x00' * 16
+    version = 0x82
+    flag_parent = 0x1
+    flag_url_table = 0x8
+    flag_short_parent = 0x10
+    schemes = ['http://', 'https://']  # scheme index is stored in flags
+    url_table_check_interval = 60  # seconds
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # hash with table ids as keys and json-encoded tables as values
+        self.url_tables_key = self.fkey('url-tables')
+        self.url_table_id_key = self.fkey('url-table-id')  # int
+        self._url_tables = {}  # type: Dict[int, UrlTable]
+        self._url_table_id = None  # type: Optional[int]
+        self._url_table_check_time = 0
+        self.short_parent_ids = self.spider.settings.getbool(
+            'QUEUE_SHORT_PARENT_IDS')
+
+    def save_url_table(self, decode: List[str]) -> int:
+        """ Save a new url table and make it current, return its id.
+        """
+        table_id = self.server.hlen(self.url_tables_key) + 1
+        if table_id > 255:
+            raise ValueError('Too many url tables')
+        pipe = self.server.pipeline()
+        pipe.multi()
+        pipe.hset(self.url_tables_key, table_id, json.dumps(decode))\
+            .set(self.url_table_id_key, table_id)\
+            .execute()
+        return table_id
+
+    def get_url_table(self, table_id: int) -> UrlTable:
+        if table_id not in self._url_tables:
+            decode = self.server.hget(self.url_tables_key, table_id)
+            if decode is None:
+                raise KeyError('Url table {} not found'.format(table_id))
+            self._url_tables[table_id] = UrlTable(
+                json.loads(decode.decode('utf8')))
+        return self._url_tables[table_id]
+
+    def current_url_table_id(self) -> int:
+        """ Id of the table used to compress urls (0 is the default table),
+        checked not more often than url_table_check_interval.
+        """
+        if (self._url_table_id is None or time.time() -
+                self._url_table_check_time > self.url_table_check_interval):
+            self._url_table_id = int(
+                self.server.get(self.url_table_id_key) or 0)
+            self._url_table_check_time = time.time()
+        return self._url_table_id
 
     def _encode_request(self, request: Request) -> bytes:
-        depth = max(-2**15, min(2**15 - 1, int(request.meta.get('depth', 0))))
-        parent = request.meta.get('parent') or self.no_parent
-        assert isinstance(parent, bytes) and len(parent) == 16
-        return struct.pack('h', depth) + parent + url_compress(request.url)
+        url = request.url
+        flags = 0
+        relative_url = domain_relative_url(url, get_domain(url))
+        if relative_url is not None:
+            scheme_idx, url = relative_url
+            flags |= (scheme_idx + 1) << 1
+        parent = request.meta.get('parent')
+        if parent:
+            assert isinstance(parent, bytes)
+            flags |= self.flag_parent
+            if self.short_parent_ids:
+                flags |= self.flag_short_parent
+                parent = parent[:SHORT_PARENT_ID_LENGTH]
+        header = [flags, self.version]
+        url_table = None
+        table_id = self.current_url_table_id()
+        if table_id:
+            header[0] |= self.flag_url_table
+            header.append(table_id)
+            url_table = self.get_url_table(table_id)
+        return b''.join([
+            bytes(header),
+            _varint_encode(int(request.meta.get('depth', 0))),
+            parent or b'',
+            url_compress(url, url_table),
+        ])
+
+    def _decode_request(self, data: bytes,
+                        queue_key: Optional[bytes]=None) -> Request:
+        if data[1] != self.version:
+            return self._decode_request_v1(data)
+        flags = data[0]
+        pos = 2
+        url_table = None
+        if flags & self.flag_url_table:
+            url_table = self.get_url_table(data[pos])
+            pos += 1
+        depth, pos = _varint_decode(data, pos)
+        parent = None
+        if flags & self.flag_parent:
+            parent_length = (SHORT_PARENT_ID_LENGTH
+                             if flags & self.flag_short_parent
+                             else len(self.no_parent))
+            parent = data[pos: pos + parent_length]
+            pos += parent_length
+        url = url_decompress(data[pos:], url_table)
+        scheme_idx = ((flags >> 1) & 0x3) - 1
+        if scheme_idx >= 0:
+            if queue_key is None:
+                raise ValueError('Queue key is required to decode a request '
+                                 'with a domain-relative url')
+            url = _absolute_url(
+                self.schemes[scheme_idx], url, self.queue_key_domain(queue_key))
+        return Request(url, meta={'depth': depth, 'parent': parent})
+
+    def _decode_request_without_queue_key(self, data: bytes
+                                          ) -> Optional[Request]:
+        """ Only version 1 encoding is independent of the queue key.
+        """
+        if data[1] != self.version:
+            return self._decode_request_v1(data)
 
-    def _decode_request(self, data: bytes) -> Request:
+    def _decode_request_v1(self, data: bytes) -> Request:
         depth_data, parent, url_data = data[:2], data[2:18], data[18:]
         depth, = struct.unpack('h', depth_data)
         if parent == self.no_parent:
@@ -414,14 +1508,82 @@ class CompactQueue(BaseRequestQueue):
         return Request(url, meta={'depth': depth, 'parent': parent})
 
 
+# Parent ids (md5 of the parent url) are truncated to this length
+# with QUEUE_SHORT_PARENT_IDS: 8 bytes are enough to make collisions
+# unlikely for billions of urls.
+SHORT_PARENT_ID_LENGTH = 8
+
+# Characters which end the host in an url without scheme
+_HOST_END_RE = re.compile(r'[/?#:]')
+
+
+def domain_relative_url(url: str, domain: str) -> Optional[Tuple[int, str]]:
+    """ Return index of url scheme in CompactQueue.schemes, and url without
+    the scheme and without the domain (subdomain is kept),
+    or None if url can not be stored relative to the domain.
+    """
+    for scheme_idx, scheme in enumerate(CompactQueue.schemes):
+        if url.startswith(scheme):
+            break
+    else:
+        return None
+    url = url[len(scheme):]
+    match = _HOST_END_RE.search(url)
+    host_end = match.start() if match else len(url)
+    host = url[:host_end]
+    if host == domain:
+        subdomain = ''
+    elif domain and host.endswith('.' + domain):
+        subdomain = host[:-len(domain)]
+    else:
+        return None
+    return scheme_idx, subdomain + url[host_end:]
+
+
+def _absolute_url(scheme: str, relative_url: str, domain: str) -> str:
+    match = _HOST_END_RE.search(relative_url)
+    host_end = match.start() if match else len(relative_url)
+    return ''.join(
+        [scheme, relative_url[:host_end], domain, relative_url[host_end:]])
+
+
+def _varint_encode(value: int) -> bytes:
+    """ Encode a signed integer as a zigzag varint.
+    """
+    value = (value << 1) ^ (value >> 63) if value < 0 else value << 1
+    if value < 0:  # outside of int64 range
+        raise ValueError('Value is too large: {}'.format(value))
+    result = bytearray()
+    while value >= 0x80:
+        result.append((value & 0x7f) | 0x80)
+        value >>= 7
+    result.append(value)
+    return bytes(result)
+
+
+def _varint_decode(data: bytes, pos: int) -> Tuple[int, int]:
+    """ Decode a zigzag varint starting at pos,
+    return decoded value and position after it.
+    """
+    value = shift = 0
+    while True:
+        byte = data[pos]
+        pos += 1
+        value |= (byte & 0x7f) << shift
+        shift += 7
+        if not byte & 0x80:
+            break
+    return (value >> 1) ^ -(value & 1), pos
+
+
 class SoftmaxQueue(CompactQueue):
-    def select_best_queue(self, idx: int, n_idx: int) -> Optional[bytes]:
+    def select_best_queue(self, shards: Tuple[int, ...]) -> Optional[bytes]:
         """ Select queue taking weights into account.
         """
-        available_queues, scores = self.get_available_queues(idx, n_idx)
+        available_queues, scores = self.get_available_queues(
+            shards, self.cache_version)
         if available_queues:
-            p = get_softmax_p(scores, self.spider.settings)
-            queue = np.random.choice(available_queues, p=p)
+            queue, = self.get_sampler(available_queues, scores).choice(1)
             slots = self.get_slots()
             if not self.has_free_slots(queue, slots):
                 # It's possible to sample more than one queue above and check
@@ -438,35 +1600,101 @@ def get_softmax_p(scores, settings):
     return softmax(-scores, t=temprature)
 
 
+class SoftmaxSampler:
+    """ Sample queues with probabilities given by softmax over their scores.
+    Probabilities and their cumulative sums are computed once, so each draw
+    is a binary search over the cumulative array, instead of a pass
+    over all probabilities with np.random.choice.
+    """
+    def __init__(self, queues: List[bytes], scores: np.ndarray, settings):
+        self.queues = queues
+        self.p = get_softmax_p(scores, settings)
+        self.cdf = np.cumsum(self.p)
+        self.cdf /= self.cdf[-1]
+
+    def sample(self, size: int) -> np.ndarray:
+        """ Return indices of size queues sampled with replacement.
+        """
+        indices = np.searchsorted(
+            self.cdf, np.random.random(size), side='right')
+        return np.minimum(indices, len(self.queues) - 1)
+
+    def choice(self, size: int) -> List[bytes]:
+        return [self.queues[idx] for idx in self.sample(size)]
+
+
 class BatchQueue(CompactQueue):
     """ Adds batching of requests during pop: a QUEUE_BATCH_SIZE requests are
     popped at once to the local queue, and are then used until the local queue
-    is empty.
+    is empty. Local queue is kept separately for each downloader slot,
+    and slots are used in a round-robin way, skipping slots without free
+    transfer slots, so that requests of one domain do not block the others.
     """
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
-        self.local_queue = []
+        # downloader slot key -> requests in priority order
+        self.local_queue = OrderedDict()  # type: Dict[str, deque]
+        self.local_queue_len = 0
 
     def __len__(self):
         # FIXME - this is not quite correct, because super().__len__ is total
         # queue size, but self.local_queue is for this worker only.
-        return super().__len__() + len(self.local_queue)
+        return super().__len__() + self.local_queue_len
 
     def pop(self, timeout=0) -> Optional[Request]:
+        self.heartbeat()
         self.update_queue_stats()
-        self.local_queue = self.local_queue or self.pop_multi()
-        if self.local_queue:
-            # TODO - take free slots into account
-            return self.local_queue.pop()
+        self.reload_spilled()
+        if not self.local_queue_len:
+            self.add_to_local_queue(self.pop_multi())
+        if self.local_queue_len:
+            request = self.pop_from_local_queue()
+            if request is None:
+                # All slots are busy: it's better to wait until they get free
+                self.spider.crawler.stats.inc_value(
+                    'dd_crawler/queue/deferred_pops')
+            return request
+
+    def add_to_local_queue(self, requests: List[Request]):
+        for request in requests:
+            slot_key = self.request_slot_key(request)
+            if slot_key not in self.local_queue:
+                self.local_queue[slot_key] = deque()
+            self.local_queue[slot_key].append(request)
+        self.local_queue_len += len(requests)
+
+    def pop_from_local_queue(self) -> Optional[Request]:
+        """ Pop request from the next slot with free transfer slots.
+        """
+        slots = self.get_slots()
+        for _ in range(len(self.local_queue)):
+            slot_key, requests = self.local_queue.popitem(last=False)
+            if self.slot_is_free(slot_key, slots):
+                request = requests.popleft()
+                self.local_queue_len -= 1
+                if requests:
+                    self.local_queue[slot_key] = requests
+                return request
+            self.local_queue[slot_key] = requests
+
+    def request_slot_key(self, request: Request) -> str:
+        """ Downloader slot key (without IP concurrency), the same as used
+        by scrapy downloader: download_slot set when the request is popped,
+        or hostname.
+        """
+        return (request.meta.get('download_slot') or
+                urlparse_cached(request).hostname or '')
 
     def pop_multi(self) -> List[Request]:
-        idx, n_idx = self.discover()
-        queues = self.select_best_queues(idx, n_idx)
-        queue_counts = Counter(queues)
+        """ Pop a batch of requests, requests from each queue
+        are in priority order.
+        """
+        queues = self.select_best_queues(self.get_my_shards())
+        queue_counts = list(Counter(queues).items())
         requests = []
         unique_queues = set()
-        for queue, n in queue_counts.items():
-            rs = reversed(self.pop_from_queue(queue, n))
+        for (queue, _), rs in zip(
+                queue_counts, self.pop_from_queues(queue_counts)):
             if rs:
                 requests.extend(rs)
                 unique_queues.add(queue)
@@ -474,11 +1702,11 @@ class BatchQueue(CompactQueue):
             len(requests), len(queues), len(unique_queues)))
         return requests
 
-    def select_best_queues(self, idx: int, n_idx: int) -> List[bytes]:
+    def select_best_queues(self, shards: Tuple[int, ...]) -> List[bytes]:
         """ Return a list of self.batch_size (if possible)
         queues with repetition.
         """
-        available_queues, scores = self.get_my_queues(idx, n_idx)
+        available_queues, scores = self.get_my_queues(shards)
         if available_queues:
             return list(
                 np.random.choice(available_queues, size=self.batch_size))
@@ -498,8 +1726,8 @@ class BatchSoftmaxQueue(BatchQueue):
         scores_log = self.spider.settings.get('QUEUE_SCORES_LOG')
         self.scores_log = gzip.open(scores_log, 'at') if scores_log else None
 
-    def select_best_queues(self, idx: int, n_idx: int) -> List[bytes]:
-        available_queues, scores = self.get_my_queues(idx, n_idx)
+    def select_best_queues(self, shards: Tuple[int, ...]) -> List[bytes]:
+        available_queues, scores = self.get_my_queues(shards)
         return self.select_queues_softmax(available_queues, scores) \
             if available_queues else []
 
@@ -509,12 +1737,12 @@ class BatchSoftmaxQueue(BatchQueue):
         """ Select self.batch_size queues (with repetition) using softmax.
         Try to select not greater than max_queue_n of each queue.
         """
-        p = get_softmax_p(scores, self.spider.settings)
+        sampler = self.get_sampler(available_queues, scores)
+        p = sampler.p
         max_queue_n = int(math.ceil(self.spider.settings.getint(
             'CONCURRENT_REQUESTS_PER_DOMAIN') * 0.5))
         min_n_queues = int(math.ceil(self.batch_size / max_queue_n))
-        queues = np.random.choice(
-            available_queues, p=p, size=self.batch_size)
+        queues = sampler.choice(self.batch_size)
         n_unique = len(set(queues))
         if n_unique < min_n_queues:
             logger.info(
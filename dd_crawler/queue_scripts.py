@@ -0,0 +1,391 @@
+""" Lua scripts used by dd_crawler.queue and dd_crawler.dupefilter:
+each of them does in one round-trip (and atomically) what would otherwise
+take several redis calls.
+"""
+
+# Max length of the index change log: workers which are further behind
+# re-read the whole index (only their shards).
+INDEX_LOG_LENGTH = 10000
+
+# Changes of queues in the index (but not changes of their scores) are
+# recorded in the index log, each change incrementing index generation,
+# so that workers can update their view of the index incrementally.
+# Log entries are tab-separated: operation ("+" for added queue, "-" for
+# removed queue, "*" to re-read the whole index, "w" for changed workers),
+# and for queue changes, shard key, queue key and (for added queues) score.
+_LOG_INDEX_CHANGE = """
+local function log_index_change(generation_key, log_key, entry)
+    redis.call('INCR', generation_key)
+    redis.call('RPUSH', log_key, entry)
+    redis.call('LTRIM', log_key, -""" + str(INDEX_LOG_LENGTH) + """, -1)
+end
+"""
+
+# Return index changes since given generation.
+# KEYS: generation_key, log_key
+# ARGV: generation
+# Returns {generation, {entries}}, or just {generation}
+# if the log does not go back far enough.
+INDEX_CHANGES = """
+local generation = tonumber(redis.call('GET', KEYS[1]) or '0')
+local n = generation - tonumber(ARGV[1])
+if n == 0 then
+    return {generation, {}}
+end
+if n < 0 or n > redis.call('LLEN', KEYS[2]) then
+    return {generation}
+end
+return {generation, redis.call('LRANGE', KEYS[2], -n, -1)}
+"""
+
+# Push requests into a domain queue.
+# KEYS: queue_key, queues_key, relevant_queues_key, len_key, did_restrict_key,
+#       shard_key, generation_key, log_key, trimmed_key, queued_key,
+#       pushed_key, counters_key, admitted_key
+# ARGV: max_domains (-1 means no limit), restrict_domains (0 or 1),
+#       max_per_domain (0 means no limit), spill_above (0 means no spilling),
+#       count_pushed (0 or 1), followed by score and data for each request
+# Returns {pushed, queue_added, n_trimmed, {data, score, ...} of spilled
+# requests}: admission checks are the same
+# for all requests, so either all or none are pushed. Queues admitted under
+# max_domains limit are kept in admitted_key set, so that they can be pushed
+# to after they become empty. If the queue becomes
+# longer than max_per_domain, requests with lowest priorities (which can
+# include just pushed ones) are dropped, and their number is added
+# to the queue counter in trimmed_key hash. If the queue is still longer
+# than spill_above after that, requests with lowest priorities are removed
+# in the same way, but returned, so that the caller can store them outside
+# of redis (see QUEUE_SPILL_DIR).
+# Queue length is stored in queued_key sorted set, number of pushed requests
+# in pushed_key hash, and total number of pushed requests in "pushed" field
+# of counters_key hash, so that stats can be read without scanning queues.
+# Pushed requests are counted only if count_pushed is 1: it is 0 when
+# requests are returned to the queue (e.g. requeued leases or reloaded
+# spilled requests), so that they are not counted twice.
+PUSH = _LOG_INDEX_CHANGE + """
+local queue_key = KEYS[1]
+local queues_key = KEYS[2]
+local relevant_queues_key = KEYS[3]
+local len_key = KEYS[4]
+local did_restrict_key = KEYS[5]
+local shard_key = KEYS[6]
+local generation_key = KEYS[7]
+local log_key = KEYS[8]
+local trimmed_key = KEYS[9]
+local queued_key = KEYS[10]
+local pushed_key = KEYS[11]
+local counters_key = KEYS[12]
+local admitted_key = KEYS[13]
+local max_domains = tonumber(ARGV[1])
+local restrict_domains = ARGV[2] == '1'
+local max_per_domain = tonumber(ARGV[3])
+local spill_above = tonumber(ARGV[4])
+local count_pushed = ARGV[5] == '1'
+
+if restrict_domains
+        and redis.call('GET', did_restrict_key)
+        and not redis.call('ZSCORE', relevant_queues_key, queue_key) then
+    -- Such requests could come from the time we selected
+    -- relevant domains: some requests were in fly or in batches.
+    return {0, 0, 0, {}}
+end
+if max_domains >= 0
+        and redis.call('SISMEMBER', admitted_key, queue_key) == 0 then
+    if redis.call('SCARD', admitted_key) >= max_domains then
+        -- Do not add new queue, limit has been reached
+        return {0, 0, 0, {}}
+    end
+    redis.call('SADD', admitted_key, queue_key)
+end
+
+local n_added = 0
+for i = 6, #ARGV, 2 do
+    n_added = n_added + redis.call('ZADD', queue_key, ARGV[i], ARGV[i + 1])
+end
+local n_trimmed = 0
+if max_per_domain > 0 and n_added > 0
+        and redis.call('ZCARD', queue_key) > max_per_domain then
+    -- Scores are negated priorities, so the tail has lowest priorities
+    n_trimmed = redis.call('ZREMRANGEBYRANK', queue_key, max_per_domain, -1)
+    redis.call('HINCRBY', trimmed_key, queue_key, n_trimmed)
+end
+-- Spill after trimming, so that trimmed requests are not spilled
+local spilled = {}
+if spill_above > 0 and n_added > 0
+        and redis.call('ZCARD', queue_key) > spill_above then
+    spilled = redis.call('ZRANGE', queue_key, spill_above, -1, 'WITHSCORES')
+    redis.call('ZREMRANGEBYRANK', queue_key, spill_above, -1)
+end
+local len_change = n_added - n_trimmed - #spilled / 2
+if len_change ~= 0 then
+    redis.call('INCRBY', len_key, len_change)
+end
+if count_pushed and n_added > 0 then
+    redis.call('HINCRBY', pushed_key, queue_key, n_added)
+    redis.call('HINCRBY', counters_key, 'pushed', n_added)
+end
+redis.call('ZADD', queued_key, redis.call('ZCARD', queue_key), queue_key)
+local top = redis.call('ZRANGE', queue_key, 0, 0, 'WITHSCORES')
+local queue_added = redis.call('ZADD', queues_key, top[2], queue_key)
+redis.call('ZADD', shard_key, top[2], queue_key)
+if queue_added == 1 then
+    log_index_change(generation_key, log_key,
+        '+\t' .. shard_key .. '\t' .. queue_key .. '\t' .. top[2])
+end
+return {1, queue_added, n_trimmed, spilled}
+"""
+
+# Admit queues under max_domains limit: already admitted queues stay
+# admitted, and new ones are admitted while there are less than max_domains
+# queues in admitted_key set. Used with QUEUE_REDIS_PARTITIONS, when the set
+# is kept on the main server, as PUSH can not check it atomically there.
+# KEYS: admitted_key
+# ARGV: max_domains, followed by queue keys
+# Returns a list with 1 for each admitted queue and 0 for each rejected one.
+ADMIT = """
+local admitted_key = KEYS[1]
+local max_domains = tonumber(ARGV[1])
+local n_admitted = redis.call('SCARD', admitted_key)
+local admitted = {}
+for i = 2, #ARGV do
+    if redis.call('SISMEMBER', admitted_key, ARGV[i]) == 1 then
+        admitted[i - 1] = 1
+    elseif n_admitted < max_domains then
+        redis.call('SADD', admitted_key, ARGV[i])
+        n_admitted = n_admitted + 1
+        admitted[i - 1] = 1
+    else
+        admitted[i - 1] = 0
+    end
+end
+return admitted
+"""
+
+# Pop requests with highest priorities from several domain queues.
+# KEYS: len_key, queues_key, generation_key, log_key, lease_key, queued_key,
+#       popped_key, counters_key,
+#       followed by queue key and shard key for each queue
+# ARGV: lease (0 or 1), followed by number of requests to pop from each queue
+# Returns {{removed queue keys}, {{data, score, ...} for each queue}}
+# If lease is 1, popped requests are also recorded in the lease_key hash
+# (with queue key and data, separated by a tab, as field, and score as value)
+# until they are acknowledged.
+# Counters are updated in the same way as in PUSH script.
+POP_MULTI = _LOG_INDEX_CHANGE + """
+local len_key = KEYS[1]
+local queues_key = KEYS[2]
+local generation_key = KEYS[3]
+local log_key = KEYS[4]
+local lease_key = KEYS[5]
+local queued_key = KEYS[6]
+local popped_key = KEYS[7]
+local counters_key = KEYS[8]
+local lease = ARGV[1] == '1'
+local popped = {}
+local n_popped = 0
+local removed_queues = {}
+for i = 9, #KEYS, 2 do
+    local queue_key = KEYS[i]
+    local shard_key = KEYS[i + 1]
+    local n = tonumber(ARGV[(i - 5) / 2])
+    -- Get one extra element to know new max score after pop
+    local items = redis.call('ZRANGE', queue_key, 0, n, 'WITHSCORES')
+    if #items > 2 * n then
+        redis.call('ZREMRANGEBYRANK', queue_key, 0, n - 1)
+        redis.call('ZADD', queues_key, items[#items], queue_key)
+        redis.call('ZADD', shard_key, items[#items], queue_key)
+        items[#items] = nil
+        items[#items] = nil
+        redis.call('ZADD', queued_key, redis.call('ZCARD', queue_key),
+                   queue_key)
+    else
+        if #items > 0 then
+            redis.call('DEL', queue_key)
+        end
+        redis.call('ZREM', queued_key, queue_key)
+        -- queue is empty now: remove it from queues set
+        if redis.call('ZREM', shard_key, queue_key) == 1 then
+            log_index_change(generation_key, log_key,
+                '-\t' .. shard_key .. '\t' .. queue_key)
+        end
+        if redis.call('ZREM', queues_key, queue_key) == 1 then
+            removed_queues[#removed_queues + 1] = queue_key
+        end
+    end
+    if lease then
+        for j = 1, #items, 2 do
+            redis.call('HSET', lease_key, queue_key .. '\t' .. items[j],
+                       items[j + 1])
+        end
+    end
+    if #items > 0 then
+        redis.call('HINCRBY', popped_key, queue_key, #items / 2)
+    end
+    n_popped = n_popped + #items / 2
+    popped[#popped + 1] = items
+end
+if n_popped > 0 then
+    redis.call('DECRBY', len_key, n_popped)
+    redis.call('HINCRBY', counters_key, 'popped', n_popped)
+end
+return {removed_queues, popped}
+"""
+
+# Remove domain queues (used for domain restriction): queues are removed
+# from the index and deleted (with UNLINK if it is supported, so that memory
+# is freed in the background), and len_key is decreased by their length.
+# Queue counters and admission under max_domains limit are removed too.
+# Removing a queue again has no effect, so the same queues can be removed
+# by several workers concurrently.
+# KEYS: len_key, queues_key, queued_key, generation_key, log_key,
+#       pushed_key, popped_key, trimmed_key, admitted_key,
+#       followed by queue key and shard key for each queue
+# Returns {{removed queue keys}, number of removed requests}
+REMOVE_QUEUES = _LOG_INDEX_CHANGE + """
+local len_key = KEYS[1]
+local queues_key = KEYS[2]
+local queued_key = KEYS[3]
+local generation_key = KEYS[4]
+local log_key = KEYS[5]
+local pushed_key = KEYS[6]
+local popped_key = KEYS[7]
+local trimmed_key = KEYS[8]
+local admitted_key = KEYS[9]
+local removed_queues = {}
+local n_removed = 0
+for i = 10, #KEYS, 2 do
+    local queue_key = KEYS[i]
+    local shard_key = KEYS[i + 1]
+    if redis.call('ZREM', queues_key, queue_key) == 1 then
+        removed_queues[#removed_queues + 1] = queue_key
+    end
+    if redis.call('ZREM', shard_key, queue_key) == 1 then
+        log_index_change(generation_key, log_key,
+            '-\t' .. shard_key .. '\t' .. queue_key)
+    end
+    redis.call('ZREM', queued_key, queue_key)
+    redis.call('HDEL', pushed_key, queue_key)
+    redis.call('HDEL', popped_key, queue_key)
+    redis.call('HDEL', trimmed_key, queue_key)
+    redis.call('SREM', admitted_key, queue_key)
+    n_removed = n_removed + redis.call('ZCARD', queue_key)
+    local result = redis.pcall('UNLINK', queue_key)
+    if type(result) == 'table' and result.err then  -- redis < 4.0
+        redis.call('DEL', queue_key)
+    end
+end
+if n_removed > 0 then
+    redis.call('DECRBY', len_key, n_removed)
+end
+return {removed_queues, n_removed}
+"""
+
+# Advance the domain restriction cursor after a chunk of the queues index
+# was scanned, unless another worker has already advanced it, so that each
+# chunk is counted once. Removed domains and requests are always counted,
+# as each queue is removed only once.
+# KEYS: progress_key
+# ARGV: cursor, next_cursor, n_scanned, n_removed_domains, n_removed_requests
+# Returns 1 if the cursor was advanced, 0 otherwise.
+ADVANCE_RESTRICTION = """
+local progress_key = KEYS[1]
+redis.call('HINCRBY', progress_key, 'removed_domains', ARGV[4])
+redis.call('HINCRBY', progress_key, 'removed_requests', ARGV[5])
+if redis.call('HGET', progress_key, 'done')
+        or (redis.call('HGET', progress_key, 'cursor') or '0') ~= ARGV[1] then
+    return 0
+end
+redis.call('HSET', progress_key, 'cursor', ARGV[2])
+redis.call('HINCRBY', progress_key, 'scanned', ARGV[3])
+if ARGV[2] == '0' then
+    redis.call('HSET', progress_key, 'done', 1)
+end
+return 1
+"""
+
+# Get integer ids of domains, assigning new ids to unknown domains.
+# KEYS: ids_key (hash domain -> id), names_key (hash id -> domain),
+#       counter_key (last assigned id)
+# ARGV: domains
+# Returns a list of ids
+DOMAIN_IDS = """
+local ids_key = KEYS[1]
+local names_key = KEYS[2]
+local counter_key = KEYS[3]
+local ids = {}
+for i = 1, #ARGV do
+    local domain_id = redis.call('HGET', ids_key, ARGV[i])
+    if not domain_id then
+        domain_id = redis.call('INCR', counter_key)
+        redis.call('HSET', ids_key, ARGV[i], domain_id)
+        redis.call('HSET', names_key, domain_id, ARGV[i])
+    end
+    ids[i] = tonumber(domain_id)
+end
+return ids
+"""
+
+# Check and add fingerprints to a scalable bloom filter: a series of bloom
+# filters, each next one with twice the capacity and half the error rate
+# of the previous one, so that the total error rate stays below error_rate.
+# Fingerprints are added to the last filter, which is replaced by a new one
+# when it reaches its capacity. Filter sizes are computed in the same way
+# as in dd_crawler.dupefilter.bloom_filter_params.
+# KEYS: meta_key (hash with number of filters and items in the last filter),
+#       filters are stored in bitmaps with meta_key:<filter index> keys
+# ARGV: capacity, error_rate, followed by two hashes for each fingerprint
+# Returns a list with 1 for each added fingerprint and 0 for each one seen.
+BLOOM_ADD = """
+local meta_key = KEYS[1]
+local capacity = tonumber(ARGV[1])
+local error_rate = tonumber(ARGV[2])
+local n_filters = tonumber(redis.call('HGET', meta_key, 'filters') or '1')
+local count = tonumber(redis.call('HGET', meta_key, 'count') or '0')
+
+local function filter_params(i)
+    local n = capacity * 2 ^ i
+    local p = error_rate * 0.5 ^ (i + 1)
+    local m = math.min(
+        math.ceil(-n * math.log(p) / math.log(2) ^ 2), 2 ^ 32)
+    local k = math.max(1, math.floor(m / n * math.log(2) + 0.5))
+    return n, m, k
+end
+
+local added = {}
+for a = 3, #ARGV, 2 do
+    local h1 = tonumber(ARGV[a])
+    local h2 = tonumber(ARGV[a + 1])
+    local seen = false
+    for i = n_filters - 1, 0, -1 do
+        local _, m, k = filter_params(i)
+        seen = true
+        for j = 0, k - 1 do
+            if redis.call('GETBIT', meta_key .. ':' .. i,
+                          (h1 + j * h2) % m) == 0 then
+                seen = false
+                break
+            end
+        end
+        if seen then
+            break
+        end
+    end
+    if seen then
+        added[#added + 1] = 0
+    else
+        local i = n_filters - 1
+        local n, m, k = filter_params(i)
+        for j = 0, k - 1 do
+            redis.call('SETBIT', meta_key .. ':' .. i, (h1 + j * h2) % m, 1)
+        end
+        count = count + 1
+        if count >= n then
+            n_filters = n_filters + 1
+            count = 0
+        end
+        added[#added + 1] = 1
+    end
+end
+redis.call('HMSET', meta_key, 'filters', n_filters, 'count', count)
+return added
+"""
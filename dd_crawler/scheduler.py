@@ -0,0 +1,29 @@
+from scrapy_redis.scheduler import Scheduler as RedisScheduler
+from twisted.internet import task
+
+
+class Scheduler(RedisScheduler):
+    """ scrapy-redis scheduler which also passes the spider
+    (and so the settings and stats) to the dupefilter,
+    as scrapy-redis creates it only with the server and key.
+    It also sends queue heartbeats periodically (even when the downloader
+    is busy and no requests are popped), and closes the queue,
+    flushing pending lease acknowledgements.
+    """
+    _heartbeat_task = None
+
+    def open(self, spider):
+        super().open(spider)
+        if hasattr(self.df, 'open_spider'):
+            self.df.open_spider(spider)
+        if hasattr(self.queue, 'heartbeat'):
+            self._heartbeat_task = task.LoopingCall(self.queue.heartbeat)
+            self._heartbeat_task.start(
+                self.queue.heartbeat_interval / 2, now=False)
+
+    def close(self, reason):
+        if self._heartbeat_task is not None and self._heartbeat_task.running:
+            self._heartbeat_task.stop()
+        super().close(reason)
+        if hasattr(self.queue, 'close'):
+            self.queue.close()
@@ -13,13 +13,28 @@ USER_AGENT = (
 
 # Scrapy-redis settings
 # Enables scheduling storing requests queue in redis.
-SCHEDULER = 'scrapy_redis.scheduler.Scheduler'
+SCHEDULER = 'dd_crawler.scheduler.Scheduler'
 DUPEFILTER_CLASS = 'dd_crawler.dupefilter.LoginAwareDupefilter'
+# Use a bloom filter instead of a set of fingerprints (see LoginAwareDupefilter)
+DUPEFILTER_BLOOM = False
+# Keep fingerprints per domain, so that they can be dropped with the domain
+DUPEFILTER_PER_DOMAIN = False
 # Don't cleanup redis queues, allows to pause/resume crawls.
 SCHEDULER_PERSIST = True
+# Uncomment to use embedded storage instead of redis for single-node crawls
+# REDIS_URL = 'sqlite:///frontier.db'
+# REDIS_PARAMS = {'redis_cls': 'dd_crawler.storage.SQLiteStorage'}
 # SCHEDULER_QUEUE_CLASS = 'dd_crawler.queue.CompactQueue'
 SCHEDULER_QUEUE_CLASS = 'dd_crawler.queue.BatchSoftmaxQueue'
 QUEUE_BATCH_SIZE = 100
+# Use integer domain ids in queue keys (can not be changed for a running crawl)
+QUEUE_DOMAIN_IDS = False
+# Spill low priority queue tails to local segment files (one dir per worker)
+# QUEUE_SPILL_DIR = 'spill'
+# Push all requests from one response at once (see BatchPushMiddleware)
+QUEUE_BATCH_PUSH = False
+# Keep popped requests in redis until they are crawled (see LeaseAckMiddleware)
+QUEUE_LEASES = False
 
 COMMANDS_MODULE = 'dd_crawler.commands'
 
@@ -46,6 +61,7 @@ DOWNLOADER_MIDDLEWARES = {
     'dd_crawler.middleware.DDAutologinMiddleware': 605,
     'scrapy.downloadermiddlewares.cookies.CookiesMiddleware': None,
     'autologin_middleware.ExposeCookiesMiddleware': 700,
+    'dd_crawler.middleware.lease.LeaseAckMiddleware': 950,
     'dd_crawler.middleware.domain_status.DomainStatusMiddleware': 1000,
 }
 
@@ -53,6 +69,7 @@ MAX_DUPLICATE_PATH_SEGMENTS = 5
 MAX_DUPLICATE_QUERY_SEGMENTS = 3
 
 SPIDER_MIDDLEWARES = {
+    'dd_crawler.middleware.batch_push.BatchPushMiddleware': 10,
     'dd_crawler.middleware.domains.DomainControlMiddleware': 550,
     'dd_crawler.middleware.log.RequestLogMiddleware': 600,
     'dd_crawler.middleware.dupesegments.DupeSegmentsMiddleware': 750,
@@ -88,6 +105,7 @@ RANDOMIZE_DOWNLOAD_DELAY = False
 
 # Concurrency
 CONCURRENT_REQUESTS = 64
+# Applies to registered domains (with subdomains): queues set download_slot
 CONCURRENT_REQUESTS_PER_DOMAIN = 10
 DOWNLOAD_DELAY = 0.0
 
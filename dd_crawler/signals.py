@@ -1 +1,4 @@
 queues_changed = object()
+# Sent with "domains" (a list of domains) and "reason" ("restricted"
+# or "exhausted") when domain queues are removed from the index.
+domains_removed = object()
@@ -0,0 +1,334 @@
+""" Crawl frontier snapshots (see "scrapy frontier_dump" and
+"scrapy frontier_load" commands): all redis keys of the request queue
+(domain queues, index, relevant domains, counters, leases, workers
+and login state) and of the dupefilter, on the main server and on all
+queue partitions, are streamed into one gzip-compressed file.
+
+The file starts with MAGIC and a json header (prefixed with its length),
+followed by records: each record has a header with server index
+(0 is the main server, followed by partitions), value type and flags,
+key length, number of values and body length, and a body with the key
+and values, each value prefixed with its length. Large keys are split
+over several records: the first one has FLAG_FIRST set, and the key
+is deleted before it is loaded, so that a key returned twice by SCAN
+is still loaded correctly.
+"""
+import gzip
+import json
+import os
+import struct
+import sys
+import time
+from typing import BinaryIO, Dict, Iterator, List, Optional, Tuple
+
+from redis.client import StrictRedis
+from scrapy_redis import connection, defaults
+
+
+MAGIC = b'DDFRONT1'
+VERSION = 1
+
+_LENGTH = struct.Struct('<I')
+# server index, type and flags, key length, number of values, body length
+_RECORD_HEADER = struct.Struct('<HBIII')
+
+STRING, LIST, SET, ZSET, HASH = range(1, 6)
+FLAG_FIRST = 0x80
+_TYPES = {b'string': STRING, b'list': LIST, b'set': SET, b'zset': ZSET,
+          b'hash': HASH}
+# Commands used to read the size of a key of each type
+_SIZE_COMMANDS = {STRING: 'STRLEN', LIST: 'LLEN', SET: 'SCARD', ZSET: 'ZCARD',
+                  HASH: 'HLEN'}
+# Strings (e.g. bloom filters) are read in chunks of this size
+STRING_CHUNK_SIZE = 2**24
+
+
+def snapshot_servers(settings) -> List[StrictRedis]:
+    """ Main redis server followed by queue partitions
+    (see QUEUE_REDIS_PARTITIONS), without opening the queue.
+    """
+    server = connection.from_settings(settings)
+    return [server] + [type(server).from_url(url)
+                       for url in settings.getlist('QUEUE_REDIS_PARTITIONS')]
+
+
+def snapshot_patterns(settings, spider_name: str) -> List[str]:
+    """ SCAN patterns matching all queue and dupefilter keys of the spider.
+    """
+    return [settings.get(name, default) % {'spider': spider_name} + '*'
+            for name, default in [
+                ('SCHEDULER_QUEUE_KEY', defaults.SCHEDULER_QUEUE_KEY),
+                ('SCHEDULER_DUPEFILTER_KEY',
+                 defaults.SCHEDULER_DUPEFILTER_KEY)]]
+
+
+class Progress:
+    """ Print number of keys, values and bytes, and throughput,
+    not more often than each interval seconds.
+    """
+    def __init__(self, action: str, interval: float=5, out=sys.stdout):
+        self.action = action
+        self.interval = interval
+        self.out = out
+        self.n_keys = self.n_values = self.n_bytes = 0
+        self.start_time = self._report_time = time.time()
+
+    def update(self, n_keys: int=0, n_values: int=0, n_bytes: int=None):
+        self.n_keys += n_keys
+        self.n_values += n_values
+        if n_bytes is not None:
+            self.n_bytes = n_bytes
+        if time.time() - self._report_time > self.interval:
+            self.report()
+
+    def report(self):
+        self._report_time = time.time()
+        elapsed = max(self._report_time - self.start_time, 1e-6)
+        print('{} {:,} keys, {:,} values, {:.1f} MB in {:.0f} s '
+              '({:,.0f} values/s, {:.1f} MB/s)'.format(
+                  self.action, self.n_keys, self.n_values,
+                  self.n_bytes / 2**20, elapsed, self.n_values / elapsed,
+                  self.n_bytes / 2**20 / elapsed),
+              file=self.out)
+        self.out.flush()
+
+
+def dump(servers: List[StrictRedis], patterns: List[str], path: str,
+         header: Dict, chunk_size: int=1000, compress_level: int=3,
+         progress: Optional[Progress]=None):
+    """ Dump keys matching patterns from all servers into a file at path.
+    Servers connected to the same redis are dumped only once.
+    """
+    header = dict(header, version=VERSION, n_servers=len(servers),
+                  time=time.time())
+    header_data = json.dumps(header).encode('utf8')
+    with open(path, 'wb') as raw:
+        with gzip.GzipFile(fileobj=raw, mode='wb',
+                           compresslevel=compress_level) as f:
+            f.write(MAGIC + _LENGTH.pack(len(header_data)) + header_data)
+            seen = set()
+            for idx, server in enumerate(servers):
+                identity = _server_identity(server)
+                if identity in seen:
+                    continue
+                seen.add(identity)
+                for pattern in patterns:
+                    for keys in _scan_chunks(server, pattern, chunk_size):
+                        n_values = 0
+                        for type_, key, first, values in _read_keys(
+                                server, keys, chunk_size):
+                            f.write(_encode_record(
+                                idx, type_, key, first, values))
+                            n_values += len(values)
+                        if progress:
+                            progress.update(len(keys), n_values, raw.tell())
+    if progress:
+        progress.update(n_bytes=os.path.getsize(path))
+        progress.report()
+
+
+def read_header(path: str) -> Dict:
+    with gzip.open(path, 'rb') as f:
+        return _read_header(f)
+
+
+def load(servers: List[StrictRedis], path: str, chunk_size: int=1000,
+         progress: Optional[Progress]=None) -> Dict:
+    """ Load a snapshot from path with pipelined writes,
+    flushed each chunk_size commands. Return snapshot header.
+    """
+    with open(path, 'rb') as raw:
+        with gzip.GzipFile(fileobj=raw, mode='rb') as f:
+            header = _read_header(f)
+            if header['n_servers'] != len(servers):
+                raise ValueError(
+                    'Snapshot has {} servers (main and partitions), '
+                    'but {} are configured'
+                    .format(header['n_servers'], len(servers)))
+            pipes = {}  # type: Dict[int, object]
+            n_commands = n_keys = n_values = 0
+            for idx, type_, key, first, values in _read_records(f):
+                if idx not in pipes:
+                    pipes[idx] = servers[idx].pipeline(transaction=False)
+                pipe = pipes[idx]
+                if first:
+                    pipe.delete(key)
+                    n_keys += 1
+                    n_commands += 1
+                if values:
+                    pipe.execute_command(_load_command(type_), key, *values)
+                    n_commands += 1
+                    n_values += len(values)
+                if n_commands >= chunk_size:
+                    for pipe in pipes.values():
+                        pipe.execute()
+                    n_commands = 0
+                    if progress:
+                        progress.update(n_keys, n_values, raw.tell())
+                        n_keys = n_values = 0
+            for pipe in pipes.values():
+                pipe.execute()
+            if progress:
+                progress.update(n_keys, n_values, raw.tell())
+                progress.report()
+    return header
+
+
+def existing_keys(servers: List[StrictRedis], patterns: List[str]
+                  ) -> Iterator[Tuple[StrictRedis, bytes]]:
+    for server in servers:
+        for pattern in patterns:
+            for key in server.scan_iter(match=pattern, count=1000):
+                yield server, key
+
+
+def _load_command(type_: int) -> str:
+    return {STRING: 'APPEND', LIST: 'RPUSH', SET: 'SADD', ZSET: 'ZADD',
+            HASH: 'HMSET'}[type_]
+
+
+def _server_identity(server: StrictRedis) -> Tuple:
+    kwargs = server.connection_pool.connection_kwargs
+    return tuple(kwargs.get(name) for name in ['host', 'port', 'db', 'path'])
+
+
+def _scan_chunks(server: StrictRedis, pattern: str, chunk_size: int
+                 ) -> Iterator[List[bytes]]:
+    cursor = None
+    while cursor != 0:
+        cursor, keys = server.scan(
+            cursor or 0, match=pattern, count=chunk_size)
+        if keys:
+            yield keys
+
+
+def _read_keys(server: StrictRedis, keys: List[bytes], chunk_size: int
+               ) -> Iterator[Tuple[int, bytes, bool, List[bytes]]]:
+    """ Read given keys, yielding (type, key, first, values) chunks:
+    types and sizes of keys and values of small keys are read
+    in pipelines, and large keys are read in chunks.
+    """
+    pipe = server.pipeline(transaction=False)
+    for key in keys:
+        pipe.type(key)
+    typed_keys = [(_TYPES.get(type_), key)
+                  for key, type_ in zip(keys, pipe.execute())]
+    typed_keys = [(type_, key) for type_, key in typed_keys if type_]
+    for type_, key in typed_keys:
+        pipe.execute_command(_SIZE_COMMANDS[type_], key)
+    sizes = pipe.execute()
+    small, large = [], []
+    for (type_, key), size in zip(typed_keys, sizes):
+        if (size <= STRING_CHUNK_SIZE if type_ == STRING
+                else size <= chunk_size):
+            small.append((type_, key))
+        else:
+            large.append((type_, key))
+    for type_, key in small:
+        if type_ == STRING:
+            pipe.get(key)
+        elif type_ == LIST:
+            pipe.lrange(key, 0, -1)
+        elif type_ == SET:
+            pipe.smembers(key)
+        elif type_ == ZSET:
+            pipe.zrange(key, 0, -1, withscores=True, score_cast_func=bytes)
+        elif type_ == HASH:
+            pipe.hgetall(key)
+    for (type_, key), value in zip(small, pipe.execute()):
+        yield type_, key, True, _flatten(type_, value)
+    for type_, key in large:
+        first = True
+        for values in _read_large_key(server, type_, key, chunk_size):
+            yield type_, key, first, values
+            first = False
+
+
+def _read_large_key(server: StrictRedis, type_: int, key: bytes,
+                    chunk_size: int) -> Iterator[List[bytes]]:
+    if type_ == STRING:
+        start = 0
+        while True:
+            value = server.getrange(key, start, start + STRING_CHUNK_SIZE - 1)
+            if not value:
+                break
+            yield [value]
+            start += len(value)
+    elif type_ == LIST:
+        start = 0
+        while True:
+            values = server.lrange(key, start, start + chunk_size - 1)
+            if not values:
+                break
+            yield values
+            start += len(values)
+    else:
+        scan = {SET: server.sscan, ZSET: server.zscan,
+                HASH: server.hscan}[type_]
+        kwargs = {'score_cast_func': bytes} if type_ == ZSET else {}
+        cursor = None
+        while cursor != 0:
+            cursor, values = scan(key, cursor or 0, count=chunk_size, **kwargs)
+            if values:
+                yield _flatten(type_, values)
+
+
+def _flatten(type_: int, value) -> List[bytes]:
+    """ Values of a key in the order expected by the load command.
+    """
+    if type_ == STRING:
+        return [value]
+    elif type_ in {LIST, SET}:
+        return list(value)
+    elif type_ == ZSET:
+        return [x for member, score in value for x in [score, member]]
+    else:
+        items = value.items() if isinstance(value, dict) else value
+        return [x for field, v in items for x in [field, v]]
+
+
+def _encode_record(idx: int, type_: int, key: bytes, first: bool,
+                   values: List[bytes]) -> bytes:
+    body = [key]
+    for value in values:
+        body.extend([_LENGTH.pack(len(value)), value])
+    body = b''.join(body)
+    return _RECORD_HEADER.pack(
+        idx, type_ | (FLAG_FIRST if first else 0), len(key), len(values),
+        len(body)) + body
+
+
+def _read_header(f: BinaryIO) -> Dict:
+    if f.read(len(MAGIC)) != MAGIC:
+        raise ValueError('Not a frontier snapshot')
+    length, = _LENGTH.unpack(f.read(_LENGTH.size))
+    header = json.loads(f.read(length).decode('utf8'))
+    if header.get('version') != VERSION:
+        raise ValueError('Unsupported snapshot version: {}'
+                         .format(header.get('version')))
+    return header
+
+
+def _read_records(f: BinaryIO
+                  ) -> Iterator[Tuple[int, int, bytes, bool, List[bytes]]]:
+    while True:
+        record_header = f.read(_RECORD_HEADER.size)
+        if not record_header:
+            break
+        if len(record_header) != _RECORD_HEADER.size:
+            raise ValueError('Truncated snapshot')
+        idx, type_flags, key_length, n_values, body_length = \
+            _RECORD_HEADER.unpack(record_header)
+        body = f.read(body_length)
+        if len(body) != body_length:
+            raise ValueError('Truncated snapshot')
+        key = body[:key_length]
+        pos = key_length
+        values = []
+        for _ in range(n_values):
+            length, = _LENGTH.unpack_from(body, pos)
+            pos += _LENGTH.size
+            values.append(body[pos: pos + length])
+            pos += length
+        yield (idx, type_flags & ~FLAG_FIRST, key,
+               bool(type_flags & FLAG_FIRST), values)
@@ -0,0 +1,209 @@
+""" Local storage for queue tails spilled from redis (see QUEUE_SPILL_DIR):
+append-only segment files with zlib-compressed blocks of requests,
+indexed in memory by queue key and score.
+"""
+import heapq
+import logging
+import os
+import re
+import struct
+import zlib
+from typing import Dict, List, Tuple
+
+
+logger = logging.getLogger(__name__)
+
+
+# Block header: queue key length, number of requests, payload length
+# and min score of requests in the block, followed by the queue key
+# and zlib-compressed payload.
+_BLOCK_HEADER = struct.Struct('<HIId')
+# Payload item header: score and data length, followed by data.
+_ITEM_HEADER = struct.Struct('<dI')
+# Offsets of reloaded blocks are appended to ".consumed" file of the segment
+_OFFSET = struct.Struct('<Q')
+
+_SEGMENT_RE = re.compile(r'^segment-(\d+)\.bin$')
+
+
+class SpillStore:
+    """ Requests are spilled in blocks: all requests cut from one queue
+    in one PUSH call form a block, and blocks are appended to the current
+    segment file, which is rotated once it is larger than segment_size.
+    Blocks are reloaded whole, in order of their min score (so the highest
+    priority requests are reloaded first), and their offsets are recorded
+    in a ".consumed" file, so that they are not reloaded again after restart.
+    Segment files without live blocks are deleted.
+
+    Each worker must use its own directory.
+    """
+    def __init__(self, path: str, segment_size: int=64 * 2**20):
+        self.path = path
+        self.segment_size = segment_size
+        os.makedirs(path, exist_ok=True)
+        # queue key -> heap of (min score, segment id, offset, n requests)
+        self._blocks = {}  # type: Dict[bytes, List[Tuple]]
+        self._segment_live = {}  # type: Dict[int, int]
+        self.n_requests = 0
+        self._load()
+        self._segment_id = max(self._segment_live, default=0) + 1
+        self._segment_live[self._segment_id] = 0
+        self._segment = open(self._segment_path(self._segment_id), 'ab')
+
+    def __len__(self):
+        return self.n_requests
+
+    def __contains__(self, queue_key: bytes) -> bool:
+        return queue_key in self._blocks
+
+    def queue_keys(self) -> List[bytes]:
+        return list(self._blocks)
+
+    def queue_len(self, queue_key: bytes) -> int:
+        return sum(n for _, _, _, n in self._blocks.get(queue_key, []))
+
+    def append(self, queue_key: bytes, items: List[Tuple[float, bytes]]):
+        """ Append a block with (score, data) requests of given queue.
+        """
+        if not items:
+            return
+        payload = zlib.compress(b''.join(
+            _ITEM_HEADER.pack(score, len(data)) + data
+            for score, data in items))
+        min_score = min(score for score, _ in items)
+        offset = self._segment.tell()
+        self._segment.write(b''.join([
+            _BLOCK_HEADER.pack(
+                len(queue_key), len(items), len(payload), min_score),
+            queue_key, payload]))
+        self._segment.flush()
+        self._add_block(queue_key, min_score, self._segment_id, offset,
+                        len(items))
+        if self._segment.tell() >= self.segment_size:
+            self._rotate()
+
+    def take(self, queue_key: bytes, n: int) -> List[Tuple[float, bytes]]:
+        """ Remove and return at least n (score, data) requests
+        of given queue, or all of them if there are less:
+        blocks are taken whole, starting from the highest priority one.
+        """
+        blocks = self._blocks.get(queue_key)
+        items = []
+        while blocks and len(items) < n:
+            _, segment_id, offset, n_block = heapq.heappop(blocks)
+            items.extend(self._read_block(segment_id, offset))
+            self._consume(segment_id, offset, n_block)
+        if blocks is not None and not blocks:
+            del self._blocks[queue_key]
+        return items
+
+    def clear(self):
+        self._segment.close()
+        for segment_id in list(self._segment_live):
+            self._remove_segment(segment_id)
+        self._blocks.clear()
+        self._segment_live.clear()
+        self.n_requests = 0
+        self._segment_id += 1
+        self._segment_live[self._segment_id] = 0
+        self._segment = open(self._segment_path(self._segment_id), 'ab')
+
+    def close(self):
+        self._segment.close()
+
+    def _add_block(self, queue_key: bytes, min_score: float,
+                   segment_id: int, offset: int, n: int):
+        heapq.heappush(self._blocks.setdefault(queue_key, []),
+                       (min_score, segment_id, offset, n))
+        self._segment_live[segment_id] += 1
+        self.n_requests += n
+
+    def _read_block(self, segment_id: int, offset: int
+                    ) -> List[Tuple[float, bytes]]:
+        with open(self._segment_path(segment_id), 'rb') as f:
+            f.seek(offset)
+            key_length, n, payload_length, _ = _BLOCK_HEADER.unpack(
+                f.read(_BLOCK_HEADER.size))
+            f.seek(key_length, os.SEEK_CUR)
+            payload = zlib.decompress(f.read(payload_length))
+        items = []
+        pos = 0
+        for _ in range(n):
+            score, length = _ITEM_HEADER.unpack_from(payload, pos)
+            pos += _ITEM_HEADER.size
+            items.append((score, payload[pos: pos + length]))
+            pos += length
+        return items
+
+    def _consume(self, segment_id: int, offset: int, n: int):
+        self.n_requests -= n
+        self._segment_live[segment_id] -= 1
+        if (self._segment_live[segment_id] == 0 and
+                segment_id != self._segment_id):
+            self._remove_segment(segment_id)
+            del self._segment_live[segment_id]
+        else:
+            with open(self._consumed_path(segment_id), 'ab') as f:
+                f.write(_OFFSET.pack(offset))
+
+    def _rotate(self):
+        self._segment.close()
+        if self._segment_live[self._segment_id] == 0:
+            self._remove_segment(self._segment_id)
+            del self._segment_live[self._segment_id]
+        self._segment_id += 1
+        self._segment_live[self._segment_id] = 0
+        self._segment = open(self._segment_path(self._segment_id), 'ab')
+
+    def _load(self):
+        """ Rebuild the index from existing segments (left from a previous
+        run), skipping consumed blocks and a partially written last block.
+        """
+        segment_ids = sorted(
+            int(m.group(1))
+            for m in map(_SEGMENT_RE.match, os.listdir(self.path)) if m)
+        for segment_id in segment_ids:
+            self._segment_live[segment_id] = 0
+            consumed = set()
+            if os.path.exists(self._consumed_path(segment_id)):
+                with open(self._consumed_path(segment_id), 'rb') as f:
+                    data = f.read()
+                consumed.update(offset for offset, in _OFFSET.iter_unpack(
+                    data[:len(data) - len(data) % _OFFSET.size]))
+            path = self._segment_path(segment_id)
+            size = os.path.getsize(path)
+            with open(path, 'rb') as f:
+                offset = 0
+                while offset + _BLOCK_HEADER.size <= size:
+                    key_length, n, payload_length, min_score = \
+                        _BLOCK_HEADER.unpack(f.read(_BLOCK_HEADER.size))
+                    end = (offset + _BLOCK_HEADER.size + key_length +
+                           payload_length)
+                    if end > size:
+                        logger.warning('Truncated block at {} in {}'
+                                       .format(offset, path))
+                        break
+                    queue_key = f.read(key_length)
+                    if offset not in consumed:
+                        self._add_block(queue_key, min_score, segment_id,
+                                        offset, n)
+                    f.seek(end)
+                    offset = end
+            if self._segment_live[segment_id] == 0:
+                self._remove_segment(segment_id)
+                del self._segment_live[segment_id]
+        if self.n_requests:
+            logger.info('Loaded {:,} spilled requests of {:,} queues from {}'
+                        .format(self.n_requests, len(self._blocks), self.path))
+
+    def _remove_segment(self, segment_id: int):
+        for path in [self._segment_path(segment_id),
+                     self._consumed_path(segment_id)]:
+            if os.path.exists(path):
+                os.remove(path)
+
+    def _segment_path(self, segment_id: int) -> str:
+        return os.path.join(self.path, 'segment-{:06d}.bin'.format(segment_id))
+
+    def _consumed_path(self, segment_id: int) -> str:
+        return self._segment_path(segment_id) + '.consumed'
@@ -0,0 +1,684 @@
+""" Embedded frontier storage: a subset of the redis API used by dd_crawler,
+implemented on top of SQLite in WAL mode, so that single-node crawls
+(and tests) can run without a redis server, and queue operations do not
+cross a socket. Several worker processes on one machine can share a file.
+
+Enable it with::
+
+    REDIS_URL = 'sqlite:////path/to/frontier.db'  # or 'sqlite://' for memory
+    REDIS_PARAMS = {'redis_cls': 'dd_crawler.storage.SQLiteStorage'}
+
+Lua scripts from dd_crawler.queue_scripts are executed by their Python
+equivalents defined below, in one SQLite transaction.
+"""
+import contextlib
+from fnmatch import fnmatchcase
+import functools
+import sqlite3
+import threading
+from typing import Any, Callable, Dict, List, Optional, Union
+from urllib.parse import urlsplit
+
+from . import queue_scripts
+
+
+Key = Union[str, bytes]
+
+
+_SCHEMA = [
+    'CREATE TABLE IF NOT EXISTS strings ('
+    'key TEXT PRIMARY KEY, value BLOB NOT NULL) WITHOUT ROWID',
+    'CREATE TABLE IF NOT EXISTS zsets ('
+    'key TEXT, member BLOB, score REAL NOT NULL, '
+    'PRIMARY KEY (key, member)) WITHOUT ROWID',
+    'CREATE INDEX IF NOT EXISTS zsets_score ON zsets (key, score, member)',
+    'CREATE TABLE IF NOT EXISTS hashes ('
+    'key TEXT, field BLOB, value BLOB NOT NULL, '
+    'PRIMARY KEY (key, field)) WITHOUT ROWID',
+    'CREATE TABLE IF NOT EXISTS sets ('
+    'key TEXT, member BLOB, PRIMARY KEY (key, member)) WITHOUT ROWID',
+    'CREATE TABLE IF NOT EXISTS lists ('
+    'key TEXT, idx INTEGER, value BLOB NOT NULL, '
+    'PRIMARY KEY (key, idx)) WITHOUT ROWID',
+]
+
+_TABLES = ['strings', 'zsets', 'hashes', 'sets', 'lists']
+
+
+def _command(fn):
+    """ Run storage command in a transaction (nested commands, e.g. in
+    pipelines or scripts, share the outer transaction).
+    """
+    @functools.wraps(fn)
+    def inner(self, *args, **kwargs):
+        with self._transaction():
+            return fn(self, *args, **kwargs)
+    return inner
+
+
+class SQLiteStorage:
+    """ Redis-compatible (for commands used by dd_crawler) storage
+    backed by SQLite. Values are returned as bytes, like in StrictRedis.
+    """
+    def __init__(self, path: str=':memory:', **kwargs):
+        self.path = path
+        self._lock = threading.RLock()
+        self._depth = 0
+        self._conn = sqlite3.connect(
+            path, timeout=60, isolation_level=None, check_same_thread=False)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        with self._transaction():
+            for statement in _SCHEMA:
+                self._conn.execute(statement)
+
+    @classmethod
+    def from_url(cls, url: str, **kwargs) -> 'SQLiteStorage':
+        """ Create storage from sqlite:///relative/path, sqlite:////abs/path
+        or sqlite:// (in-memory) url. Redis connection options are ignored.
+        """
+        parsed = urlsplit(url)
+        if parsed.scheme != 'sqlite':
+            raise ValueError('Expected sqlite:// url, got {}'.format(url))
+        return cls(parsed.path[1:] or ':memory:')
+
+    def __repr__(self):
+        return '{}<{}>'.format(type(self).__name__, self.path)
+
+    @contextlib.contextmanager
+    def _transaction(self):
+        with self._lock:
+            if self._depth == 0:
+                self._conn.execute('BEGIN IMMEDIATE')
+            self._depth += 1
+            try:
+                yield
+            except BaseException:
+                self._depth -= 1
+                if self._depth == 0:
+                    self._conn.execute('ROLLBACK')
+                raise
+            else:
+                self._depth -= 1
+                if self._depth == 0:
+                    self._conn.execute('COMMIT')
+
+    def _execute(self, sql: str, params=()) -> sqlite3.Cursor:
+        return self._conn.execute(sql, params)
+
+    def pipeline(self, transaction=True, shard_hint=None) -> 'SQLitePipeline':
+        return SQLitePipeline(self)
+
+    def register_script(self, script: str) -> 'SQLiteScript':
+        return SQLiteScript(self, script)
+
+    @_command
+    def _eval(self, fn: Callable, keys: List[Key], args: List[Any]) -> Any:
+        return fn(self, list(keys), list(args))
+
+    def ping(self) -> bool:
+        return True
+
+    # Generic commands
+
+    @_command
+    def delete(self, *names: Key) -> int:
+        n_deleted = 0
+        for name in map(_key, names):
+            for table in _TABLES:
+                if self._execute('DELETE FROM {} WHERE key = ?'.format(table),
+                                 (name,)).rowcount > 0:
+                    n_deleted += 1
+        return n_deleted
+
+    @_command
+    def exists(self, name: Key) -> bool:
+        return any(self._execute(
+            'SELECT 1 FROM {} WHERE key = ? LIMIT 1'.format(table),
+            (_key(name),)).fetchone() for table in _TABLES)
+
+    @_command
+    def keys(self, pattern: Key='*') -> List[bytes]:
+        pattern = _key(pattern)
+        query = ' UNION '.join(
+            'SELECT DISTINCT key FROM {}'.format(table) for table in _TABLES)
+        return [key.encode('utf8') for key, in self._execute(query)
+                if fnmatchcase(key, pattern)]
+
+    def scan_iter(self, match: Optional[Key]=None, count=None):
+        return iter(self.keys(match or '*'))
+
+    @_command
+    def flushdb(self) -> bool:
+        for table in _TABLES:
+            self._execute('DELETE FROM {}'.format(table))
+        return True
+
+    # Strings
+
+    @_command
+    def get(self, name: Key) -> Optional[bytes]:
+        row = self._execute('SELECT value FROM strings WHERE key = ?',
+                            (_key(name),)).fetchone()
+        return row[0] if row else None
+
+    @_command
+    def set(self, name: Key, value) -> bool:
+        self._execute('INSERT OR REPLACE INTO strings VALUES (?, ?)',
+                      (_key(name), _value(value)))
+        return True
+
+    @_command
+    def getset(self, name: Key, value) -> Optional[bytes]:
+        old_value = self.get(name)
+        self.set(name, value)
+        return old_value
+
+    @_command
+    def incrby(self, name: Key, amount: int=1) -> int:
+        value = int(self.get(name) or 0) + int(amount)
+        self.set(name, value)
+        return value
+
+    incr = incrby
+
+    def decrby(self, name: Key, amount: int=1) -> int:
+        return self.incrby(name, -int(amount))
+
+    decr = decrby
+
+    # Hashes
+
+    @_command
+    def hset(self, name: Key, key, value) -> int:
+        added = self.hget(name, key) is None
+        self._execute('INSERT OR REPLACE INTO hashes VALUES (?, ?, ?)',
+                      (_key(name), _value(key), _value(value)))
+        return int(added)
+
+    @_command
+    def hget(self, name: Key, key) -> Optional[bytes]:
+        row = self._execute(
+            'SELECT value FROM hashes WHERE key = ? AND field = ?',
+            (_key(name), _value(key))).fetchone()
+        return row[0] if row else None
+
+    @_command
+    def hmget(self, name: Key, keys, *args) -> List[Optional[bytes]]:
+        if isinstance(keys, (str, bytes)):
+            keys = [keys]
+        return [self.hget(name, key) for key in list(keys) + list(args)]
+
+    @_command
+    def hgetall(self, name: Key) -> Dict[bytes, bytes]:
+        return dict(self._execute(
+            'SELECT field, value FROM hashes WHERE key = ?', (_key(name),)))
+
+    @_command
+    def hdel(self, name: Key, *keys) -> int:
+        return sum(self._execute(
+            'DELETE FROM hashes WHERE key = ? AND field = ?',
+            (_key(name), _value(key))).rowcount for key in keys)
+
+    @_command
+    def hlen(self, name: Key) -> int:
+        return self._execute('SELECT COUNT(*) FROM hashes WHERE key = ?',
+                             (_key(name),)).fetchone()[0]
+
+    @_command
+    def hincrby(self, name: Key, key, amount: int=1) -> int:
+        value = int(self.hget(name, key) or 0) + int(amount)
+        self.hset(name, key, value)
+        return value
+
+    # Sets
+
+    @_command
+    def sadd(self, name: Key, *values) -> int:
+        return sum(self._execute(
+            'INSERT OR IGNORE INTO sets VALUES (?, ?)',
+            (_key(name), _value(value))).rowcount for value in values)
+
+    @_command
+    def srem(self, name: Key, *values) -> int:
+        return sum(self._execute(
+            'DELETE FROM sets WHERE key = ? AND member = ?',
+            (_key(name), _value(value))).rowcount for value in values)
+
+    @_command
+    def sismember(self, name: Key, value) -> bool:
+        return self._execute(
+            'SELECT 1 FROM sets WHERE key = ? AND member = ?',
+            (_key(name), _value(value))).fetchone() is not None
+
+    @_command
+    def smembers(self, name: Key) -> set:
+        return {member for member, in self._execute(
+            'SELECT member FROM sets WHERE key = ?', (_key(name),))}
+
+    @_command
+    def scard(self, name: Key) -> int:
+        return self._execute('SELECT COUNT(*) FROM sets WHERE key = ?',
+                             (_key(name),)).fetchone()[0]
+
+    # Lists (only appending and trimming are supported)
+
+    @_command
+    def rpush(self, name: Key, *values) -> int:
+        name = _key(name)
+        last_idx, = self._execute(
+            'SELECT MAX(idx) FROM lists WHERE key = ?', (name,)).fetchone()
+        first_idx = 0 if last_idx is None else last_idx + 1
+        self._conn.executemany(
+            'INSERT INTO lists VALUES (?, ?, ?)',
+            [(name, first_idx + i, _value(value))
+             for i, value in enumerate(values)])
+        return self.llen(name)
+
+    @_command
+    def llen(self, name: Key) -> int:
+        return self._execute('SELECT COUNT(*) FROM lists WHERE key = ?',
+                             (_key(name),)).fetchone()[0]
+
+    @_command
+    def lrange(self, name: Key, start: int, end: int) -> List[bytes]:
+        offset, limit = _rank_range(start, end, self.llen(name))
+        return [value for value, in self._execute(
+            'SELECT value FROM lists WHERE key = ? ORDER BY idx '
+            'LIMIT ? OFFSET ?', (_key(name), limit, offset))]
+
+    @_command
+    def ltrim(self, name: Key, start: int, end: int) -> bool:
+        name = _key(name)
+        offset, limit = _rank_range(start, end, self.llen(name))
+        self._execute(
+            'DELETE FROM lists WHERE key = ? AND idx NOT IN ('
+            'SELECT idx FROM lists WHERE key = ? ORDER BY idx '
+            'LIMIT ? OFFSET ?)', (name, name, limit, offset))
+        return True
+
+    # Sorted sets
+
+    @_command
+    def zadd(self, name: Key, *args, **kwargs) -> int:
+        if len(args) % 2 != 0:
+            raise ValueError('zadd requires an equal number of '
+                             'values and scores')
+        pairs = list(zip(args[1::2], args[::2])) + list(kwargs.items())
+        n_added = 0
+        for member, score in pairs:
+            n_added += self.zscore(name, member) is None
+            self._execute('INSERT OR REPLACE INTO zsets VALUES (?, ?, ?)',
+                          (_key(name), _value(member), float(score)))
+        return n_added
+
+    @_command
+    def zincrby(self, name: Key, value, amount: float=1) -> float:
+        score = (self.zscore(name, value) or 0) + float(amount)
+        self.zadd(name, score, value)
+        return score
+
+    @_command
+    def zscore(self, name: Key, value) -> Optional[float]:
+        row = self._execute(
+            'SELECT score FROM zsets WHERE key = ? AND member = ?',
+            (_key(name), _value(value))).fetchone()
+        return row[0] if row else None
+
+    @_command
+    def zcard(self, name: Key) -> int:
+        return self._execute('SELECT COUNT(*) FROM zsets WHERE key = ?',
+                             (_key(name),)).fetchone()[0]
+
+    @_command
+    def zrem(self, name: Key, *values) -> int:
+        return sum(self._execute(
+            'DELETE FROM zsets WHERE key = ? AND member = ?',
+            (_key(name), _value(value))).rowcount for value in values)
+
+    @_command
+    def zrange(self, name: Key, start: int, end: int, desc=False,
+               withscores=False, score_cast_func=float):
+        offset, limit = _rank_range(start, end, self.zcard(name))
+        order = 'DESC' if desc else 'ASC'
+        rows = self._execute(
+            'SELECT member, score FROM zsets WHERE key = ? '
+            'ORDER BY score {0}, member {0} LIMIT ? OFFSET ?'.format(order),
+            (_key(name), limit, offset))
+        return _zresult(rows, withscores, score_cast_func)
+
+    @_command
+    def zrangebyscore(self, name: Key, min, max, start=None, num=None,
+                      withscores=False, score_cast_func=float):
+        where, params = _score_range(min, max)
+        limit = num if num is not None else -1
+        rows = self._execute(
+            'SELECT member, score FROM zsets WHERE key = ? AND {} '
+            'ORDER BY score, member LIMIT ? OFFSET ?'.format(where),
+            [_key(name)] + params + [limit, start or 0])
+        return _zresult(rows, withscores, score_cast_func)
+
+    @_command
+    def zremrangebyscore(self, name: Key, min, max) -> int:
+        where, params = _score_range(min, max)
+        return self._execute(
+            'DELETE FROM zsets WHERE key = ? AND {}'.format(where),
+            [_key(name)] + params).rowcount
+
+    @_command
+    def zremrangebyrank(self, name: Key, min: int, max: int) -> int:
+        members = self.zrange(name, min, max)
+        return self.zrem(name, *members) if members else 0
+
+    def zscan(self, name: Key, cursor: int=0, match=None, count=None):
+        """ All members are returned at once (count is only a hint in redis
+        too), so the returned cursor is always 0.
+        """
+        items = self.zrange(name, 0, -1, withscores=True)
+        if match is not None:
+            items = [(member, score) for member, score in items
+                     if fnmatchcase(member.decode('utf8'), _key(match))]
+        return 0, items
+
+
+class SQLitePipeline:
+    """ Commands are buffered and executed in one transaction,
+    so there is no difference between transactional and plain pipelines.
+    """
+    def __init__(self, storage: SQLiteStorage):
+        self.storage = storage
+        self.command_stack = []
+
+    def __getattr__(self, name):
+        method = getattr(self.storage, name)
+
+        def buffered(*args, **kwargs):
+            self.command_stack.append((method, args, kwargs))
+            return self
+        return buffered
+
+    def __len__(self):
+        return len(self.command_stack)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.reset()
+
+    def _eval(self, fn: Callable, keys: List[Key], args: List[Any]):
+        self.command_stack.append((self.storage._eval, (fn, keys, args), {}))
+        return self
+
+    def multi(self):
+        pass
+
+    def reset(self):
+        self.command_stack = []
+
+    def execute(self) -> List[Any]:
+        commands, self.command_stack = self.command_stack, []
+        with self.storage._transaction():
+            return [method(*args, **kwargs)
+                    for method, args, kwargs in commands]
+
+
+class SQLiteScript:
+    """ Python equivalent of one of dd_crawler.queue_scripts,
+    called in the same way as redis Script.
+    """
+    def __init__(self, registered_client: SQLiteStorage, script: str):
+        self.registered_client = registered_client
+        try:
+            self.fn = _SCRIPTS[script]
+        except KeyError:
+            raise NotImplementedError(
+                'Only dd_crawler.queue_scripts are supported by {}'
+                .format(type(registered_client).__name__))
+
+    def __call__(self, keys=(), args=(), client=None):
+        if client is None:
+            client = self.registered_client
+        return client._eval(self.fn, keys, args)
+
+
+def _key(name: Key) -> str:
+    return name.decode('utf8') if isinstance(name, bytes) else str(name)
+
+
+def _value(value) -> bytes:
+    """ Encode value in the same way as redis-py does.
+    """
+    if isinstance(value, bytes):
+        return value
+    elif isinstance(value, float):
+        return repr(value).encode('ascii')
+    elif not isinstance(value, str):
+        value = str(value)
+    return value.encode('utf8')
+
+
+def _format_score(score: float) -> bytes:
+    """ Score formatted as redis returns it to Lua scripts.
+    """
+    return '{:.17g}'.format(score).encode('ascii')
+
+
+def _rank_range(start: int, end: int, length: int):
+    """ Convert redis inclusive start and end indices (possibly negative)
+    to SQL offset and limit.
+    """
+    start, end = int(start), int(end)
+    if start < 0:
+        start = max(0, start + length)
+    if end < 0:
+        end += length
+    end = min(end, length - 1)
+    return start, max(0, end - start + 1)
+
+
+def _score_range(min, max):
+    conditions, params = [], []
+    for value, op, exclusive_op in [(min, '>=', '>'), (max, '<=', '<')]:
+        value = _key(value) if isinstance(value, (str, bytes)) else value
+        if isinstance(value, str) and value.startswith('('):
+            op, value = exclusive_op, value[1:]
+        conditions.append('score {} ?'.format(op))
+        params.append(float(value))
+    return ' AND '.join(conditions), params
+
+
+def _zresult(rows, withscores: bool, score_cast_func: Callable):
+    if withscores:
+        return [(member, score_cast_func(score)) for member, score in rows]
+    else:
+        return [member for member, _ in rows]
+
+
+# Python equivalents of queue_scripts (see them for description).
+# Arguments are passed as they are (not as strings), and return values
+# are converted in the same way as redis converts Lua values.
+
+
+def _log_index_change(db: SQLiteStorage, generation_key, log_key, entry):
+    db.incr(generation_key)
+    db.rpush(log_key, entry)
+    db.ltrim(log_key, -queue_scripts.INDEX_LOG_LENGTH, -1)
+
+
+def _index_changes(db: SQLiteStorage, keys, args):
+    generation_key, log_key = keys
+    generation = int(db.get(generation_key) or 0)
+    n = generation - int(args[0])
+    if n == 0:
+        return [generation, []]
+    if n < 0 or n > db.llen(log_key):
+        return [generation]
+    return [generation, db.lrange(log_key, -n, -1)]
+
+
+def _push(db: SQLiteStorage, keys, args):
+    (queue_key, queues_key, relevant_queues_key, len_key, did_restrict_key,
+     shard_key, generation_key, log_key, trimmed_key, queued_key, pushed_key,
+     counters_key, admitted_key) = keys
+    max_domains = int(args[0])
+    restrict_domains = int(args[1]) == 1
+    max_per_domain = int(args[2])
+    spill_above = int(args[3])
+    count_pushed = int(args[4]) == 1
+    if (restrict_domains
+            and db.get(did_restrict_key)
+            and db.zscore(relevant_queues_key, queue_key) is None):
+        return [0, 0, 0, []]
+    if max_domains >= 0 and not db.sismember(admitted_key, queue_key):
+        if db.scard(admitted_key) >= max_domains:
+            return [0, 0, 0, []]
+        db.sadd(admitted_key, queue_key)
+    n_added = sum(db.zadd(queue_key, score, data)
+                  for score, data in zip(args[5::2], args[6::2]))
+    n_trimmed = 0
+    if (max_per_domain > 0 and n_added > 0
+            and db.zcard(queue_key) > max_per_domain):
+        n_trimmed = db.zremrangebyrank(queue_key, max_per_domain, -1)
+        db.hincrby(trimmed_key, queue_key, n_trimmed)
+    spilled = []
+    if spill_above > 0 and n_added > 0 and db.zcard(queue_key) > spill_above:
+        for data, score in db.zrange(queue_key, spill_above, -1,
+                                     withscores=True):
+            spilled.extend([data, _format_score(score)])
+        db.zremrangebyrank(queue_key, spill_above, -1)
+    len_change = n_added - n_trimmed - len(spilled) // 2
+    if len_change != 0:
+        db.incrby(len_key, len_change)
+    if count_pushed and n_added > 0:
+        db.hincrby(pushed_key, queue_key, n_added)
+        db.hincrby(counters_key, 'pushed', n_added)
+    db.zadd(queued_key, db.zcard(queue_key), queue_key)
+    (_, top), = db.zrange(queue_key, 0, 0, withscores=True)
+    queue_added = db.zadd(queues_key, top, queue_key)
+    db.zadd(shard_key, top, queue_key)
+    if queue_added == 1:
+        _log_index_change(db, generation_key, log_key, '+\t{}\t{}\t{}'.format(
+            _key(shard_key), _key(queue_key), _format_score(top).decode()))
+    return [1, queue_added, n_trimmed, spilled]
+
+
+def _admit(db: SQLiteStorage, keys, args):
+    admitted_key, = keys
+    max_domains = int(args[0])
+    n_admitted = db.scard(admitted_key)
+    admitted = []
+    for queue_key in args[1:]:
+        if db.sismember(admitted_key, queue_key):
+            admitted.append(1)
+        elif n_admitted < max_domains:
+            db.sadd(admitted_key, queue_key)
+            n_admitted += 1
+            admitted.append(1)
+        else:
+            admitted.append(0)
+    return admitted
+
+
+def _pop_multi(db: SQLiteStorage, keys, args):
+    (len_key, queues_key, generation_key, log_key, lease_key, queued_key,
+     popped_key, counters_key) = keys[:8]
+    lease = int(args[0]) == 1
+    popped = []
+    removed_queues = []
+    n_popped = 0
+    for queue_key, shard_key, n in zip(keys[8::2], keys[9::2], args[1:]):
+        n = int(n)
+        # Get one extra element to know new max score after pop
+        items = db.zrange(queue_key, 0, n, withscores=True)
+        if len(items) > n:
+            db.zremrangebyrank(queue_key, 0, n - 1)
+            _, top = items.pop()
+            db.zadd(queues_key, top, queue_key)
+            db.zadd(shard_key, top, queue_key)
+            db.zadd(queued_key, db.zcard(queue_key), queue_key)
+        else:
+            if items:
+                db.delete(queue_key)
+            db.zrem(queued_key, queue_key)
+            if db.zrem(shard_key, queue_key) == 1:
+                _log_index_change(db, generation_key, log_key, '-\t{}\t{}'
+                                  .format(_key(shard_key), _key(queue_key)))
+            if db.zrem(queues_key, queue_key) == 1:
+                removed_queues.append(_value(queue_key))
+        result = []
+        for data, score in items:
+            score = _format_score(score)
+            if lease:
+                db.hset(lease_key, _value(queue_key) + b'\t' + data, score)
+            result.extend([data, score])
+        if items:
+            db.hincrby(popped_key, queue_key, len(items))
+        n_popped += len(items)
+        popped.append(result)
+    if n_popped > 0:
+        db.decrby(len_key, n_popped)
+        db.hincrby(counters_key, 'popped', n_popped)
+    return [removed_queues, popped]
+
+
+def _remove_queues(db: SQLiteStorage, keys, args):
+    (len_key, queues_key, queued_key, generation_key, log_key,
+     pushed_key, popped_key, trimmed_key, admitted_key) = keys[:9]
+    removed_queues = []
+    n_removed = 0
+    for queue_key, shard_key in zip(keys[9::2], keys[10::2]):
+        if db.zrem(queues_key, queue_key) == 1:
+            removed_queues.append(_value(queue_key))
+        if db.zrem(shard_key, queue_key) == 1:
+            _log_index_change(db, generation_key, log_key, '-\t{}\t{}'
+                              .format(_key(shard_key), _key(queue_key)))
+        db.zrem(queued_key, queue_key)
+        for counter_key in [pushed_key, popped_key, trimmed_key]:
+            db.hdel(counter_key, queue_key)
+        db.srem(admitted_key, queue_key)
+        n_removed += db.zcard(queue_key)
+        db.delete(queue_key)
+    if n_removed > 0:
+        db.decrby(len_key, n_removed)
+    return [removed_queues, n_removed]
+
+
+def _advance_restriction(db: SQLiteStorage, keys, args):
+    progress_key, = keys
+    cursor, next_cursor, n_scanned, n_removed_domains, n_removed_requests = \
+        args
+    db.hincrby(progress_key, 'removed_domains', int(n_removed_domains))
+    db.hincrby(progress_key, 'removed_requests', int(n_removed_requests))
+    if (db.hget(progress_key, 'done') or
+            (db.hget(progress_key, 'cursor') or b'0') != _value(cursor)):
+        return 0
+    db.hset(progress_key, 'cursor', next_cursor)
+    db.hincrby(progress_key, 'scanned', int(n_scanned))
+    if _value(next_cursor) == b'0':
+        db.hset(progress_key, 'done', 1)
+    return 1
+
+
+def _domain_ids(db: SQLiteStorage, keys, args):
+    ids_key, names_key, counter_key = keys
+    ids = []
+    for domain in args:
+        domain_id = db.hget(ids_key, domain)
+        if domain_id is None:
+            domain_id = db.incr(counter_key)
+            db.hset(ids_key, domain, domain_id)
+            db.hset(names_key, domain_id, domain)
+        ids.append(int(domain_id))
+    return ids
+
+
+_SCRIPTS = {
+    queue_scripts.INDEX_CHANGES: _index_changes,
+    queue_scripts.PUSH: _push,
+    queue_scripts.ADMIT: _admit,
+    queue_scripts.POP_MULTI: _pop_multi,
+    queue_scripts.REMOVE_QUEUES: _remove_queues,
+    queue_scripts.ADVANCE_RESTRICTION: _advance_restriction,
+    queue_scripts.DOMAIN_IDS: _domain_ids,
+}
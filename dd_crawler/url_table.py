@@ -0,0 +1,94 @@
+""" Url compression tables: smaz tables (a list of up to 254 strings,
+each encoded with one byte) and training of such tables on url samples.
+"""
+from collections import Counter
+import re
+import time
+from typing import Dict, List
+
+import lib.smaz as smaz
+
+
+# Codes 254 and 255 are used by smaz for verbatim characters
+MAX_TABLE_SIZE = 254
+
+
+class UrlTable:
+    def __init__(self, decode: List[str]):
+        if len(decode) > MAX_TABLE_SIZE:
+            raise ValueError('Table is too large: {} > {}'.format(
+                len(decode), MAX_TABLE_SIZE))
+        self.decode = decode
+        self.tree = smaz.make_tree(decode)
+
+    def compress(self, url: str) -> bytes:
+        return smaz.compress(url, compression_tree=self.tree).encode('latin1')
+
+    def decompress(self, data: bytes) -> str:
+        return smaz.decompress(data.decode('latin1'),
+                               decompress_table=self.decode)
+
+
+def train_url_table(urls: List[str], size: int=MAX_TABLE_SIZE,
+                    max_length: int=12, n_rounds: int=8) -> List[str]:
+    """ Build a compression table for given urls (or url parts):
+    in each round, substrings are counted in parts of urls
+    not covered by already selected strings, and the ones saving most bytes
+    are added to the table.
+    """
+    table = []
+    per_round = -(-size // n_rounds)
+    while len(table) < size:
+        counts = Counter()
+        for url in urls:
+            for part in _uncovered_parts(url, table):
+                counts.update(part[i:j] for i in range(len(part))
+                              for j in range(i + 1,
+                                             min(len(part), i + max_length) + 1))
+        candidates = sorted(
+            ((count * max(1, len(s) - 1), s) for s, count in counts.items()
+             if count > 1 and s not in table),
+            reverse=True)
+        if not candidates:
+            break
+        selected = []
+        for _, s in candidates:
+            if len(selected) == per_round or len(table) == size:
+                break
+            # counts of overlapping strings are not independent
+            if not any(s in other or other in s for other in selected):
+                selected.append(s)
+                table.append(s)
+    return table
+
+
+def _uncovered_parts(url: str, table: List[str]) -> List[str]:
+    if not table:
+        return [url]
+    pattern = '|'.join(
+        map(re.escape, sorted(table, key=len, reverse=True)))
+    return [part for part in re.split(pattern, url) if part]
+
+
+def compression_report(urls: List[str], tables: Dict[str, UrlTable])\
+        -> List[Dict]:
+    """ Compression ratio (compressed size / original size)
+    and encode and decode speed of each table on given urls.
+    """
+    total_size = sum(len(url.encode('utf8')) for url in urls)
+    report = []
+    for name, table in tables.items():
+        t0 = time.time()
+        compressed = [table.compress(url) for url in urls]
+        encode_time = time.time() - t0
+        t0 = time.time()
+        decompressed = [table.decompress(data) for data in compressed]
+        decode_time = time.time() - t0
+        assert decompressed == urls
+        report.append({
+            'table': name,
+            'ratio': sum(map(len, compressed)) / total_size,
+            'encode_us': 1e6 * encode_time / len(urls),
+            'decode_us': 1e6 * decode_time / len(urls),
+        })
+    return report
@@ -0,0 +1,137 @@
+import pytest
+from redis.client import StrictRedis
+from scrapy import Request, Spider
+from scrapy.crawler import Crawler
+
+from dd_crawler.dupefilter import LoginAwareDupefilter, bloom_filter_params
+from .test_queue import server, REDIS_CLS  # fixture
+
+
+requires_redis = pytest.mark.skipif(
+    REDIS_CLS is not StrictRedis,
+    reason='bloom filter is supported only for redis')
+
+
+def make_dupefilter(server, settings=None, clear=True) -> LoginAwareDupefilter:
+    spider = Spider.from_crawler(
+        Crawler(Spider, settings=settings), 'test_dd_spider')
+    df = LoginAwareDupefilter(server=server, key='test_dd_spider:dupefilter')
+    if clear:
+        df.clear()
+    df.open_spider(spider)
+    return df
+
+
+def test_set(server):
+    df = make_dupefilter(server)
+    assert not df.request_seen(Request('http://example.com'))
+    assert df.request_seen(Request('http://example.com'))
+    assert df.requests_seen([
+        Request('http://example.com/1'), Request('http://example.com'),
+        Request('http://example.com/1')]) == [False, True, True]
+    assert server.scard(df.key) == 2
+
+
+def test_local_cache(server):
+    df = make_dupefilter(server, settings={'DUPEFILTER_LOCAL_CACHE_SIZE': 2})
+    urls = ['http://example.com/{}'.format(i) for i in range(3)]
+    assert df.requests_seen([Request(url) for url in urls]) == [False] * 3
+    assert len(df.local_cache) == 2
+    server.delete(df.key)
+    # cached requests are not checked in redis, others are
+    assert df.requests_seen([Request(url) for url in urls]) == \
+        [False, True, True]
+    stats = df.stats.get_stats()
+    assert stats['dd_crawler/dupefilter/local_cache_hits'] == 2
+    assert stats['dd_crawler/dupefilter/local_cache_misses'] == 4
+
+
+def test_per_domain_local_cache(server):
+    df = make_dupefilter(server, settings={'DUPEFILTER_PER_DOMAIN': True,
+                                           'DUPEFILTER_LOCAL_CACHE_SIZE': 2})
+    urls = ['http://domain-{}.com/{}'.format(i % 2, i) for i in range(3)]
+    assert df.requests_seen([Request(url) for url in urls]) == [False] * 3
+    assert len(df.local_cache) == 2
+    # expired domains are evicted from the local cache too
+    assert df.reclaim_domains(['domain-0.com'], reason='expired') == 2
+    assert set(df.local_cache_domains) == {'domain-1.com'}
+    assert df.requests_seen([Request(url) for url in urls]) == \
+        [False, True, False]
+
+    # domains reclaimed by other workers are evicted on the next check
+    assert df.requests_seen([Request(urls[1])]) == [True]
+    assert 'domain-1.com' in df.local_cache_domains
+    other_df = make_dupefilter(
+        server, settings={'DUPEFILTER_PER_DOMAIN': True}, clear=False)
+    assert other_df.reclaim_domains(['domain-1.com'], reason='expired') == 1
+    df.last_reclaim_check = 0
+    assert df.requests_seen([Request(urls[1])]) == [False]
+    assert 'domain-1.com' not in df.local_cache_domains
+
+
+def test_per_domain(server):
+    df = make_dupefilter(server, settings={'DUPEFILTER_PER_DOMAIN': True,
+                                           'DUPEFILTER_LOCAL_CACHE_SIZE': 0})
+    urls = ['http://domain-{}.com/{}'.format(i % 2, i) for i in range(5)]
+    assert df.requests_seen([Request(url) for url in urls]) == [False] * 5
+    assert df.requests_seen([Request(url) for url in urls[:2]]) == \
+        [True, True]
+    assert server.scard(df.domain_key('domain-0.com')) == 3
+    assert not server.exists(df.key)
+    assert sorted((s['domain'], s['fingerprints'])
+                  for s in df.domain_stats()) == [
+        ('domain-0.com', 3), ('domain-1.com', 2)]
+
+    # exhausted domains are kept by default
+    df.on_domains_removed(['domain-0.com'], reason='exhausted')
+    assert server.scard(df.domain_key('domain-0.com')) == 3
+    df.on_domains_removed(['domain-0.com'], reason='restricted')
+    assert not server.exists(df.domain_key('domain-0.com'))
+    assert df.requests_seen([Request(urls[0])]) == [False]
+    assert df.expire_domains(ttl=3600) == 0
+    assert df.expire_domains(ttl=0) == 3
+    assert df.domain_stats() == []
+
+
+@requires_redis
+def test_bloom(server):
+    df = make_dupefilter(server, settings={
+        'DUPEFILTER_BLOOM': True, 'DUPEFILTER_BLOOM_CAPACITY': 100})
+    urls = ['http://example.com/{}'.format(i) for i in range(500)]
+    assert not any(df.requests_seen([Request(url) for url in urls]))
+    assert all(df.requests_seen([Request(url) for url in urls]))
+    assert not server.exists(df.key)
+    stats = df.bloom_stats()
+    assert stats['filters'] == 3
+    assert stats['items'] == 500
+    assert 0 < stats['fill_ratio'] < 1
+    assert stats['fp_rate'] < 0.002
+    df.clear()
+    assert not df.request_seen(Request(urls[0]))
+
+
+@requires_redis
+def test_migrate_to_bloom(server):
+    df = make_dupefilter(server)
+    urls = ['http://example.com/{}'.format(i) for i in range(10)]
+    df.requests_seen([Request(url) for url in urls])
+    df = make_dupefilter(server, settings={'DUPEFILTER_BLOOM': True},
+                         clear=False)
+    assert df.migrate_to_bloom(delete=True) == 10
+    assert not server.exists(df.key)
+    assert all(df.requests_seen([Request(url) for url in urls]))
+
+
+@pytest.mark.skipif(REDIS_CLS is StrictRedis, reason='SQLite only')
+def test_bloom_sqlite(server):
+    with pytest.raises(ValueError):
+        make_dupefilter(server, settings={'DUPEFILTER_BLOOM': True})
+
+
+def test_bloom_filter_params():
+    n, m, k = bloom_filter_params(1000, 0.01, 0)
+    assert n == 1000
+    assert 11000 < m < 11100  # ~11 bits per item for 0.005 error rate
+    assert k == 8
+    n1, m1, _ = bloom_filter_params(1000, 0.01, 1)
+    assert n1 == 2000 and m1 > 2 * m
@@ -0,0 +1,45 @@
+import pytest
+from redis.client import StrictRedis
+from scrapy import Request
+
+from dd_crawler.queue import BaseRequestQueue
+from dd_crawler.snapshot import dump, load, read_header
+from .test_dupefilter import make_dupefilter
+from .test_queue import server, make_queue, REDIS_CLS  # fixture
+
+
+PATTERNS = ['test_dd_spider:requests*', 'test_dd_spider:dupefilter*']
+
+
+@pytest.mark.skipif(REDIS_CLS is not StrictRedis,
+                    reason='snapshots are supported only for redis')
+def test_dump_load(server, tmpdir):
+    q = make_queue(server, BaseRequestQueue)
+    df = make_dupefilter(server)
+    requests = [Request('http://domain-{}.com/{}'.format(i % 3, i), priority=i)
+                for i in range(10)]
+    assert not any(df.requests_seen(requests))
+    assert all(q.push_many(requests))
+    q.add_login_credentials('http://domain-1.com', 'admin', 'secret')
+    path = str(tmpdir.join('frontier.gz'))
+    dump([server], PATTERNS, path, header={'spider': 'test_dd_spider'},
+         chunk_size=2)
+    assert read_header(path)['spider'] == 'test_dd_spider'
+
+    server.delete(*server.keys('test_dd_spider:*'))
+    load([server], path, chunk_size=3)
+    # workers of the dumped crawl are not running
+    server.delete(q.workers_key)
+    q = make_queue(server, BaseRequestQueue)
+    df = make_dupefilter(server, clear=False)
+    assert len(q) == 10
+    assert all(df.requests_seen(requests))
+    assert q.get_login_credentials('http://domain-1.com/login') == {
+        'url': 'http://domain-1.com', 'login': 'admin', 'password': 'secret'}
+    urls = set()
+    while True:
+        r = q.pop()
+        if r is None:
+            break
+        urls.add(r.url)
+    assert urls == {r.url for r in requests}
@@ -0,0 +1,129 @@
+from dd_crawler import queue_scripts
+from dd_crawler.storage import SQLiteStorage
+
+
+def test_sorted_sets():
+    s = SQLiteStorage()
+    assert s.zadd('z', 1, 'a', 2, b'b', 0.5, 'c') == 3
+    assert s.zadd('z', 3, 'a') == 0
+    assert s.zrange('z', 0, -1, withscores=True) == [
+        (b'c', 0.5), (b'b', 2), (b'a', 3)]
+    assert s.zrange('z', -2, -1) == [b'b', b'a']
+    assert s.zrange('z', 5, 10) == []
+    assert s.zrangebyscore('z', '-inf', 2) == [b'c', b'b']
+    assert s.zremrangebyscore('z', '(0.5', 2) == 1
+    assert s.zincrby('z', 'c', -1) == -0.5
+    assert s.zrem('z', 'a', 'x') == 1
+    assert s.zcard('z') == 1
+    assert s.zscore('z', 'x') is None
+
+
+def test_strings_hashes_lists():
+    s = SQLiteStorage()
+    assert s.incr('n') == 1
+    assert s.getset('n', 10) == b'1'
+    assert s.incrby('n', 5) == 15
+    assert s.hset('h', b'f', 1) == 1
+    assert s.hgetall('h') == {b'f': b'1'}
+    assert s.rpush('l', 'a', 'b', 'c') == 3
+    s.ltrim('l', -2, -1)
+    assert s.lrange('l', 0, -1) == [b'b', b'c']
+    assert sorted(s.keys()) == [b'h', b'l', b'n']
+    assert s.delete('h', 'l', 'x') == 2
+    assert not s.exists('h')
+
+
+def test_pipeline():
+    s = SQLiteStorage()
+    pipe = s.pipeline()
+    pipe.multi()
+    assert pipe.sadd('s', 'a').sadd('s', 'a').scard('s').execute() == [1, 0, 1]
+    assert pipe.execute() == []
+
+
+def test_scripts():
+    s = SQLiteStorage()
+    push = s.register_script(queue_scripts.PUSH)
+    pop = s.register_script(queue_scripts.POP_MULTI)
+    keys = ['q', 'queues', 'relevant', 'len', 'did-restrict', 'shard', 'gen',
+            'log', 'trimmed', 'queued', 'pushed', 'counters', 'admitted']
+    assert push(keys=keys, args=[-1, 0, 0, 0, 1, -10, b'r1', -5, b'r2']
+                ) == [1, 1, 0, []]
+    assert push(keys=keys, args=[-1, 0, 0, 0, 1, -20, b'r3']) == [1, 0, 0, []]
+    assert s.zrange('queues', 0, -1, withscores=True) == [(b'q', -20)]
+    assert s.lrange('log', 0, -1) == [b'+\tshard\tq\t-10']
+    assert pop(keys=['len', 'queues', 'gen', 'log', 'lease', 'queued',
+                     'popped', 'counters', 'q', 'shard'],
+               args=[1, 2]) == [[], [[b'r3', b'-20', b'r1', b'-10']]]
+    assert s.hgetall('lease') == {b'q\tr3': b'-20', b'q\tr1': b'-10'}
+    assert s.zrange('queues', 0, -1, withscores=True) == [(b'q', -5)]
+    assert s.get('len') == b'1'
+    assert s.zrange('queued', 0, -1, withscores=True) == [(b'q', 1)]
+    assert s.hgetall('counters') == {b'pushed': b'3', b'popped': b'2'}
+    # requests returned to the queue are not counted as pushed again
+    assert push(keys=keys, args=[-1, 0, 0, 0, 0, -20, b'r3']
+                ) == [1, 0, 0, []]
+    assert s.get('len') == b'2'
+    assert s.hgetall('counters') == {b'pushed': b'3', b'popped': b'2'}
+
+
+def test_admit():
+    s = SQLiteStorage()
+    admit = s.register_script(queue_scripts.ADMIT)
+    assert admit(keys=['admitted'], args=[2, b'q1', b'q2', b'q3']) == [1, 1, 0]
+    assert admit(keys=['admitted'], args=[2, b'q3', b'q2']) == [0, 1]
+    assert s.smembers('admitted') == {b'q1', b'q2'}
+
+
+def test_remove_queues():
+    s = SQLiteStorage()
+    push = s.register_script(queue_scripts.PUSH)
+    remove = s.register_script(queue_scripts.REMOVE_QUEUES)
+    keys = ['q', 'queues', 'relevant', 'len', 'did-restrict', 'shard', 'gen',
+            'log', 'trimmed', 'queued', 'pushed', 'counters', 'admitted']
+    assert push(keys=keys, args=[10, 0, 1, 0, 1, -10, b'r1', -5, b'r2']
+                ) == [1, 1, 1, []]
+    remove_keys = ['len', 'queues', 'queued', 'gen', 'log', 'pushed',
+                   'popped', 'trimmed', 'admitted', 'q', 'shard']
+    assert remove(keys=remove_keys) == [[b'q'], 1]
+    assert s.get('len') == b'0'
+    for key in ['q', 'queues', 'shard', 'queued', 'pushed', 'trimmed',
+                'admitted']:
+        assert not s.exists(key)
+    # removing again has no effect
+    assert remove(keys=remove_keys) == [[], 0]
+    assert s.get('len') == b'0'
+
+
+def test_advance_restriction():
+    s = SQLiteStorage()
+    advance = s.register_script(queue_scripts.ADVANCE_RESTRICTION)
+    assert advance(keys=['progress'], args=[0, 5, 2, 1, 3]) == 1
+    # another worker scanned the same chunk
+    assert advance(keys=['progress'], args=[0, 5, 2, 0, 0]) == 0
+    assert advance(keys=['progress'], args=[5, 0, 1, 0, 0]) == 1
+    assert advance(keys=['progress'], args=[5, 0, 1, 0, 0]) == 0
+    assert s.hgetall('progress') == {
+        b'cursor': b'0', b'scanned': b'3', b'done': b'1',
+        b'removed_domains': b'1', b'removed_requests': b'3'}
+
+
+def test_push_spill():
+    s = SQLiteStorage()
+    push = s.register_script(queue_scripts.PUSH)
+    keys = ['q', 'queues', 'relevant', 'len', 'did-restrict', 'shard', 'gen',
+            'log', 'trimmed', 'queued', 'pushed', 'counters', 'admitted']
+    assert push(keys=keys,
+                args=[-1, 0, 0, 2, 1, -10, b'r1', -5, b'r2', -20, b'r3']
+                ) == [1, 1, 0, [b'r2', b'-5']]
+    assert push(keys=keys, args=[-1, 0, 0, 2, 1, -30, b'r4']
+                ) == [1, 0, 0, [b'r1', b'-10']]
+    assert s.zrange('q', 0, -1) == [b'r4', b'r3']
+    assert s.get('len') == b'2'
+    assert s.hgetall('pushed') == {b'q': b'4'}
+    # requests above max_per_domain are trimmed before spilling
+    assert push(keys=keys, args=[-1, 0, 3, 2, 1, -1, b'r5', -2, b'r6']
+                ) == [1, 0, 1, [b'r6', b'-2']]
+    assert s.zrange('q', 0, -1) == [b'r4', b'r3']
+    assert s.hgetall('trimmed') == {b'q': b'1'}
+    assert s.get('len') == b'2'